@@ -1,5 +1,6 @@
 import torch
 import spaces
+import functools
 import tempfile
 import soundfile as sf
 import gradio as gr
@@ -10,7 +11,8 @@ import matplotlib.pyplot as plt
 from model.arch.cleanmel import CleanMel
 from model.vocos.offline.pretrained import Vocos
 from model.io.stft import InputSTFT, TargetMel
-from huggingface_hub import hf_hub_download
+from model.io.registry import get_frontend
+from model.utils.ckpt_store import load_checkpoint
 
 DEVICE = torch.device("cuda")
 
@@ -25,7 +27,9 @@ def read_audio(file_path):
     return torch.tensor(audio).float().squeeze().unsqueeze(0)
 
 def stft(audio):
-    transform = InputSTFT(
+    transform = get_frontend(
+            InputSTFT,
+            device=DEVICE,
             n_fft=512,
             n_win=512,
             n_hop=128,
@@ -33,11 +37,13 @@ def stft(audio):
             center=True,
             onesided=True,
             online=False
-        ).eval().to(DEVICE)
+        )
     return transform(audio)
 
 def mel_transform(audio, X_norm):
-    transform = TargetMel(
+    transform = get_frontend(
+        TargetMel,
+        device=DEVICE,
         sample_rate=16000,
         n_fft=512,
         n_win=512,
@@ -53,23 +59,21 @@ def mel_transform(audio, X_norm):
         mel_scale="slaney",
         librosa_mel=True,
         online=False
-    ).eval().to(DEVICE)
+    )
     return transform(audio, X_norm)
 
+@functools.lru_cache(maxsize=2)  # the map and mask models of the demo
 def load_cleanmel(model_name):
     model_config = f"./configs/model/cleanmel_offline.yaml"
     model_config = yaml.safe_load(open(model_config, "r"))["model"]["arch"]["init_args"]
     cleanmel = CleanMel(**model_config)
-    REPO_ID = "WestlakeAudioLab/CleanMel"
-    arch_ckpt = hf_hub_download(repo_id=REPO_ID, filename=f"ckpts/CleanMel/{model_name}")
-    cleanmel.load_state_dict(torch.load(arch_ckpt))
+    cleanmel.load_state_dict(load_checkpoint(f"HF!ckpts/CleanMel/{model_name}"), assign=True)
     return cleanmel.eval()
 
+@functools.lru_cache(maxsize=1)
 def load_vocos():
     vocos = Vocos.from_hparams(config_path="./configs/model/vocos_offline.yaml")
-    REPO_ID = "WestlakeAudioLab/CleanMel"
-    vocos_ckpt = hf_hub_download(repo_id=REPO_ID, filename="ckpts/Vocos/vocos_offline.pt")
-    vocos = Vocos.from_pretrained(None, vocos_ckpt, model=vocos)
+    vocos = Vocos.from_pretrained(None, "HF!ckpts/Vocos/vocos_offline.pt", model=vocos)
     return vocos.eval()
 
 def get_mrm_pred(Y_hat, x, X_norm):
@@ -22,7 +22,12 @@ from copy import deepcopy
 from pytorch_lightning import LightningDataModule
 from pytorch_lightning.utilities.rank_zero import rank_zero_info # type: ignore
 from torch.utils.data import DataLoader, Dataset
-from data_loader.utils.collate_func import default_collate_func
+from data_loader.utils.batch_mix import BatchMixer
+from data_loader.utils.collate_func import default_collate_func, pad_collate_func
+from data_loader.utils.energy_index import EnergyIndex
+from data_loader.utils.manifest import AudioManifest
+from data_loader.utils.rir_store import RIRStore
+from data_loader.utils.segment_reader import read_segment
 from data_loader.utils.mix import *
 from data_loader.utils.my_distributed_sampler import MyDistributedSampler
 
@@ -37,7 +42,8 @@ class CleanMelDataset(Dataset):
         audio_time_len: float = 4.0,
         sample_rate: int = 16000,
         no_reverb_prob: float = 0.2,
-        dataset_len=None
+        dataset_len=None,
+        batched_mixing: bool = False,  # return the raw segments, mixed for the batch by BatchMixer (see simulate)
     ) -> None:
         super().__init__()
         assert dataset in ['SimTrain', 'SimVal', 'SimTest'], dataset
@@ -48,11 +54,17 @@ class CleanMelDataset(Dataset):
         self.sample_rate = sample_rate
         self.dataset_len = dataset_len
         self.no_reverb_prob = no_reverb_prob
+        self.batched_mixing = batched_mixing
 
         # scan uttrss
         self.speech_dir = speech_dir + {'SimTrain': '/train/', 'SimVal': '/val/', 'SimTest': '/test/'}[dataset]
-        self.uttrs = glob(f"{self.speech_dir}/*.wav") + glob(f"{self.speech_dir}/*.flac")
-        self.uttrs.sort()
+        # the files and their durations are indexed in a manifest, see AudioManifest
+        self.uttr_manifest = AudioManifest.scan([f"{self.speech_dir}/*.wav", f"{self.speech_dir}/*.flac"])
+        self.uttrs = list(self.uttr_manifest.paths)
+        # the frames are used to read only the cut window of the files (see step 3 and 5), kept in sync with self.uttrs/self.noises
+        self.uttr_frames, self.uttr_srs = self.uttr_manifest.frames.tolist(), self.uttr_manifest.samplerate.tolist()
+        # the energy envelopes of the uttrs (see data_loader.utils.energy_index), to read only the max-energy chunk of the long uttrs
+        self.uttr_energy = EnergyIndex.for_manifest(self.uttr_manifest)
         
         # scan rirs
         self.rir_csv = rir_dir + {'SimTrain': 'train.csv', 'SimVal': 'val.csv', 'SimTest': 'test.csv'}[dataset]
@@ -61,11 +73,18 @@ class CleanMelDataset(Dataset):
         self.rir_t60_dict = {x.split("/")[-1]: y for x, y in zip(rir_csv["filename"], rir_csv["t60"])}
         self.rirs.sort()
         self.rir_wav = True
+        # the packed RIRs of the csv (see data_loader.utils.rir_store), the RIR files are read per item if not packed
+        self.rir_store = RIRStore.for_csv(self.rir_csv)
+        assert self.rir_store is None or self.rir_store.filenames == self.rirs, f"the packed rirs of {self.rir_csv} are outdated"
+        # the FFT convolution of the rirs, the block size is fixed by audio_time_len (4 s blocks for the full-length utterances)
+        self.convolver = RIRConvolver(block_size=int(sample_rate * (audio_time_len or 4.0)))
 
         # scan noise
         self.noise_dir = noise_dir + {'SimTrain': '/train/', 'SimVal': '/val/', 'SimTest': '/test/'}[dataset]
-        self.noises = glob(f"{self.noise_dir}/*.wav")
-        self.noises.sort()
+        self.noise_manifest = AudioManifest.scan([f"{self.noise_dir}/*.wav"])
+        self.noises = list(self.noise_manifest.paths)
+        self.noise_frames, self.noise_srs = self.noise_manifest.frames.tolist(), self.noise_manifest.samplerate.tolist()
+        self.noise_channels = self.noise_manifest.channels.tolist()
         self.snr = snr
         
         # check
@@ -73,84 +92,137 @@ class CleanMelDataset(Dataset):
             'dir does not exist or is empty', self.speech_dir, len(self.uttrs), self.noise_dir, len(self.noises)
             )
         
-        rank_zero_info(f"{dataset} speech duration: {sum([sf.info(x).duration for x in self.uttrs]) / 3600:.2f}")
-        rank_zero_info(f"{dataset} noise duration: {sum([sf.info(x).duration for x in self.noises]) / 3600:.2f}")
-        rank_zero_info(f"{dataset} num of rirs: {len(self.rirs)}")
+        rank_zero_info(f"{dataset} speech duration: {self.uttr_manifest.duration().sum() / 3600:.2f}" + (" (energy indexed)" if self.uttr_energy is not None else ""))
+        rank_zero_info(f"{dataset} noise duration: {self.noise_manifest.duration().sum() / 3600:.2f}")
+        rank_zero_info(f"{dataset} num of rirs: {len(self.rirs)}" + (" (packed)" if self.rir_store is not None else ""))
         
     def __getitem__(self, index_seed: tuple[int, int]):
+        return self.simulate(index_seed, raw=self.batched_mixing)
+
+    def simulate(self, index_seed: tuple[int, int], raw: bool = False):
+        """simulate the item of (index, seed): (mix, target, paras), or with raw=True, the raw segments (clean, noise, rir, rir_target,
+        paras) mixed by `BatchMixer`, i.e. the steps 4 to 6 are left to the batch: the rir is cut to the samples reaching the target_len
+        outputs, and paras has the drawn reverb (bool) and snr_target, the snr being the real one of the mixing"""
         index, seed = index_seed
         rng = np.random.default_rng(np.random.PCG64(seed))
         
         uttr_id = rng.integers(low=0, high=len(self.uttrs))
         
-        # step 1: load clean speech
-        org_src, sr_src = sf.read(self.uttrs[uttr_id], dtype='float32')
-        if len(org_src) == 0 or np.abs(org_src).sum() == 0:
+        # step 1: check clean speech (it is read in step 3)
+        if self.uttr_frames[uttr_id] == 0:
             # handle empty file
-            del self.uttrs[uttr_id]
-            return self.__getitem__(index_seed=(rng.integers(low=0, high=len(self)), rng.integers(low=0, high=9999999999)))
-        assert sr_src == 16000, f"Wrong source sampling rate! {sr_src}"
+            self._del_uttr(uttr_id)
+            return self.simulate(index_seed=(rng.integers(low=0, high=len(self)), rng.integers(low=0, high=9999999999)), raw=raw)
+        assert self.uttr_srs[uttr_id] == 16000, f"Wrong source sampling rate! {self.uttr_srs[uttr_id]}"
+        # the rng state to resample from if the file turns out to be silent in step 3
+        rng_state = deepcopy(rng.bit_generator.state)
 
         # step 2: load rirs
-        rir_name = self.rirs[rng.integers(low=0, high=len(self.rirs))]
-        t60 = self.rir_t60_dict[rir_name.split("/")[-1]]
-        rir_real, rir_fs = sf.read(rir_name)
-        assert rir_fs == 16000, f"Wrong rir sampling rate! {rir_fs}"
-        if rir_real.ndim > 1:
-            # handle multi-channel rir
-            rir_idx = np.random.randint(0, rir_real.shape[1])
-            rir_real = rir_real[:, rir_idx]
-        peek_index = int(np.argmax(np.abs(rir_real)))
-        dp_start = max(0, peek_index-32)
-        rir = rir_real[np.newaxis, dp_start: ]
-        rir_target = rir_real[np.newaxis, dp_start: peek_index+32]
+        rir_id = rng.integers(low=0, high=len(self.rirs))
+        if self.rir_store is not None:
+            # the channel of a multi-channel rir is drawn from rng
+            rir, rir_target, t60, rir_key = self.rir_store.get(rir_id, rng)
+        else:
+            rir_name = self.rirs[rir_id]
+            t60 = self.rir_t60_dict[rir_name.split("/")[-1]]
+            rir_real, rir_fs = sf.read(rir_name)
+            assert rir_fs == 16000, f"Wrong rir sampling rate! {rir_fs}"
+            rir_key = rir_name
+            if rir_real.ndim > 1:
+                # handle multi-channel rir
+                rir_idx = np.random.randint(0, rir_real.shape[1])
+                rir_real = rir_real[:, rir_idx]
+                rir_key = (rir_name, rir_idx)
+            peek_index = int(np.argmax(np.abs(rir_real)))
+            dp_start = max(0, peek_index-32)
+            rir = rir_real[np.newaxis, dp_start: ]
+            rir_target = rir_real[np.newaxis, dp_start: peek_index+32]
         
         # step 3: adjust clean speech length
-        target_len = int(self.sample_rate * self.audio_time_len) if self.audio_time_len is not None else len(org_src)
-        clean = pad_or_cut_sample(wav=org_src, length=target_len, rng=rng)
+        target_len = int(self.sample_rate * self.audio_time_len) if self.audio_time_len is not None else self.uttr_frames[uttr_id]
+        # only the cut window is read if it is drawn at random (the same draw as pad_or_cut_sample); the whole file is read if the
+        # file is repeated, or if the max-energy chunk is cut and the energy envelopes are not indexed, or to check the silence of a
+        # silent window
+        start = crop_window(num_frames=self.uttr_frames[uttr_id], length=target_len, rng=rng)
+        clean = None
+        if start is not None:
+            clean = read_segment(self.uttrs[uttr_id], start=start, frames=target_len)[0]
+        elif self.uttr_energy is not None and self.uttr_frames[uttr_id] > target_len:
+            # the max-energy chunk, computed on the chunks which may be the max-energy one by the envelope (mostly one)
+            candidates = self.uttr_energy.max_energy_candidates(self.uttrs[uttr_id], length=target_len)
+            if candidates is not None:
+                candidates, seg_start, seg_end = candidates
+                segment = read_segment(self.uttrs[uttr_id], start=seg_start, frames=seg_end - seg_start)[0]
+                start = max_energy_chunk(segment, length=target_len, starts=candidates, offset=seg_start)
+                clean = segment[start - seg_start:start - seg_start + target_len]
+        if clean is None or np.abs(clean).sum() == 0:
+            org_src = read_segment(self.uttrs[uttr_id])[0]
+            if np.abs(org_src).sum() == 0:
+                # handle empty file
+                self._del_uttr(uttr_id)
+                rng.bit_generator.state = rng_state
+                return self.simulate(index_seed=(rng.integers(low=0, high=len(self)), rng.integers(low=0, high=9999999999)), raw=raw)
+            if clean is None:
+                clean = pad_or_cut_sample(wav=org_src, length=target_len, rng=rng)
         
         # step 4: convolve rir and clean speech
-        if rng.random() < 0.2:
+        reverb = not rng.random() < 0.2
+        if not reverb:
             # no rir case
             mix = deepcopy(clean[np.newaxis, :target_len])
             target = deepcopy(clean[np.newaxis, :target_len])
             t60 = 0
-        else:
-            mix, target = convolve(wav=clean, rir=rir, rir_target=rir_target, ref_channel=0, align=False)
-            mix = mix[:, :target_len]
-            target = target[:, :target_len]
-        assert len(mix[0]) == len(target[0]), (len(mix[0]), len(target[0]), len(rir[0]), len(rir_target[0]))
+        elif not raw:
+            # only the first target_len samples are computed, with the cached spectra of the rir
+            mix, target = self.convolver.convolve(wav=clean, filters=[rir, rir_target], out_len=target_len, key=rir_key)
+            assert len(mix[0]) == len(target[0]), (len(mix[0]), len(target[0]), len(rir[0]), len(rir_target[0]))
         
         # step 5: add noise
         nidx = rng.integers(low=0, high=len(self.noises))
         noise_path = self.noises[nidx]
-        noise, sr_noise = sf.read(noise_path, dtype='float32', always_2d=True)  # [T, num_mic]
-        noise = noise[:, rng.choice(noise.shape[1])]    # random select one mic
-        if np.abs(noise).sum() == 0:
-            # handle empty file
-            del self.noises[nidx]
-            return self.__getitem__(index_seed=(rng.integers(low=0, high=len(self)), rng.integers(low=0, high=9999999999)))
-        assert sr_noise == self.sample_rate, (sr_noise, self.sample_rate)
-        
-        # adjust noise length
-        if noise.shape[0] < target_len:
-            noise = pad_or_cut_sample(wav=noise, length=target_len, rng=rng)
-
-        istart = rng.integers(low=0, high=max(noise.shape[0]-target_len, 1))
-        noise = noise[istart:istart+target_len, np.newaxis].T
+        mic = rng.choice(int(self.noise_channels[nidx]))    # random select one mic
+        rng_state = deepcopy(rng.bit_generator.state)
+        assert self.noise_srs[nidx] == self.sample_rate, (self.noise_srs[nidx], self.sample_rate)
+        # read only the target_len samples of the mic from istart, unless the noise is shorter than target_len
+        noise = None
+        if self.noise_frames[nidx] >= target_len:
+            istart = rng.integers(low=0, high=max(self.noise_frames[nidx]-target_len, 1))
+            noise = read_segment(noise_path, start=istart, frames=target_len, channel=mic)[0]
+        if noise is None or np.abs(noise).sum() == 0:
+            noise_full = read_segment(noise_path, channel=mic)[0]
+            if np.abs(noise_full).sum() == 0:
+                # handle empty file
+                self._del_noise(nidx)
+                rng.bit_generator.state = rng_state
+                return self.simulate(index_seed=(rng.integers(low=0, high=len(self)), rng.integers(low=0, high=9999999999)), raw=raw)
+            if noise is None:
+                # adjust noise length
+                noise = pad_or_cut_sample(wav=noise_full, length=target_len, rng=rng)
+                istart = rng.integers(low=0, high=max(noise.shape[0]-target_len, 1))
+                noise = noise[istart:istart+target_len]
+        noise = noise[:, np.newaxis].T
         
         # adjust snr
         snr_this = rng.uniform(low=self.snr[0], high=self.snr[1])
+        if raw:
+            # the rest is done by BatchMixer, which flags the items failing the checks on the mix for a per-item simulation
+            ae2 = np.sum(noise**2) / np.prod(noise.shape)
+            if ae2 == 0 or not np.isfinite(ae2):
+                return self.simulate(index_seed=(rng.integers(low=0, high=len(self)), rng.integers(low=0, high=9999999999)), raw=raw)
+            paras = self._paras(index, seed, snr=None, t60=t60)
+            paras.update(reverb=reverb, snr_target=float(snr_this))
+            clean, noise = torch.as_tensor(clean[:target_len], dtype=torch.float32), torch.as_tensor(noise[0], dtype=torch.float32)
+            return clean, noise, torch.as_tensor(rir[0, :target_len], dtype=torch.float32), torch.as_tensor(rir_target[0], dtype=torch.float32), paras
         coeff = cal_coeff_for_adjusting_relative_energy(wav1=mix, wav2=noise, target_dB=snr_this)
         if coeff is None:
-            return self.__getitem__(index_seed=(rng.integers(low=0, high=len(self)), rng.integers(low=0, high=9999999999)))
+            return self.simulate(index_seed=(rng.integers(low=0, high=len(self)), rng.integers(low=0, high=9999999999)), raw=raw)
         else:
             noise *= coeff
         # compute real snr (allow slightly different from snr_this)
         snr_real = 10 * np.log10(np.sum(mix**2) / np.sum(noise**2))
         if not np.isclose(snr_this, snr_real, atol=0.1):  # something wrong happen, skip this item
             warnings.warn(f'skip CleanMel/{self.dataset} item ({index},{seed})')
-            return self.__getitem__(index_seed=(rng.integers(low=0, high=len(self)), rng.integers(low=0, high=9999999999)))
+            return self.simulate(index_seed=(rng.integers(low=0, high=len(self)), rng.integers(low=0, high=9999999999)), raw=raw)
         assert np.isclose(snr_this, snr_real, atol=0.1), (snr_this, snr_real)
         
         # add noise
@@ -161,17 +233,26 @@ class CleanMelDataset(Dataset):
         scale_value = 0.9 / max(np.max(np.abs(mix)), np.max(np.abs(target)))
         mix *= scale_value
         target *= scale_value
-        paras = {
+        paras = self._paras(index, seed, snr=float(snr_real) if snr_real is not None else None, t60=t60)
+        return torch.as_tensor(mix, dtype=torch.float32).squeeze(), torch.as_tensor(target, dtype=torch.float32).squeeze(), paras
+
+    def _paras(self, index: int, seed: int, snr: Optional[float], t60: float):
+        return {
             'index': str(index),
             'seed': str(seed),
             'sample_rate': 16000,
             'dataset': f'CleanMel/{self.dataset}',
             'saveto': f"{index}.wav",
-            'snr': float(snr_real) if snr_real is not None else None,
+            'snr': snr,
             't60': t60,
             'audio_time_len': self.audio_time_len
         }
-        return torch.as_tensor(mix, dtype=torch.float32).squeeze(), torch.as_tensor(target, dtype=torch.float32).squeeze(), paras
+
+    def _del_uttr(self, uttr_id: int):
+        del self.uttrs[uttr_id], self.uttr_frames[uttr_id], self.uttr_srs[uttr_id]
+
+    def _del_noise(self, nidx: int):
+        del self.noises[nidx], self.noise_frames[nidx], self.noise_srs[nidx], self.noise_channels[nidx]
 
     def __len__(self):
         if self.dataset_len is None:
@@ -198,7 +279,8 @@ class CleanMelDataModule(LightningDataModule):
         prefetch_factor: int = 5,
         persistent_workers: bool = False,
         dataset_len = None,
-        no_reverb_prob: float = 0.2
+        no_reverb_prob: float = 0.2,
+        batched_mixing: bool = False,  # mix the raw segments of the workers for the batch on its device, see BatchMixer
     ):
         super().__init__()
         self.speech_dir = speech_dir
@@ -210,6 +292,9 @@ class CleanMelDataModule(LightningDataModule):
         self.persistent_workers = persistent_workers
         self.dataset_len = dataset_len
         self.no_reverb_prob = no_reverb_prob
+        self.batched_mixing = batched_mixing
+        self.mixer = BatchMixer()
+        self.simulated_datasets = dict()  # the datasets by paras['dataset'], for the items the mixer rejects
 
         self.batch_size = batch_size
         assert len(batch_size) == 2, batch_size
@@ -242,20 +327,46 @@ class CleanMelDataModule(LightningDataModule):
             snr=self.snr,
             audio_time_len=audio_time_len,
             dataset_len=self.dataset_len,
-            no_reverb_prob=self.no_reverb_prob
+            no_reverb_prob=self.no_reverb_prob,
+            batched_mixing=self.batched_mixing,
         )
+        self.simulated_datasets[f'CleanMel/{dataset}'] = ds
 
         return DataLoader(
             ds,
             sampler=MyDistributedSampler(ds, seed=seed, shuffle=shuffle),  #
             batch_size=batch_size,  #
-            collate_fn=collate_fn,  #
+            collate_fn=pad_collate_func if self.batched_mixing else collate_fn,  # the rirs of the raw items have different lengths
             num_workers=self.num_workers,
             prefetch_factor=self.prefetch_factor,
             pin_memory=self.pin_memory,
             persistent_workers=self.persistent_workers,
         )
 
+    def mix_batch(self, batch):
+        """mix the raw batch (clean, noise, rir, rir_target, paras, lengths) of `batched_mixing` into [mix, target, paras], on the
+        device of the batch; the items whose mixing fails the checks of CleanMelDataset are replaced as the per-item simulation does"""
+        if not self.batched_mixing:
+            return batch
+        clean, noise, rir, rir_target, paras, lengths = batch
+        assert (lengths == lengths[0]).all(), "batched_mixing needs the items of a batch to have the same length, i.e. an audio_time_len"
+        paras = list(paras)
+        reverb = torch.tensor([p.pop('reverb') for p in paras], device=clean.device)
+        snr = torch.tensor([p.pop('snr_target') for p in paras], dtype=torch.float64, device=clean.device)
+        mix, target, snr_real, valid = self.mixer(clean, noise, rir, rir_target, reverb, snr)
+        for i, (snr_i, valid_i) in enumerate(zip(snr_real.tolist(), valid.tolist())):
+            if valid_i:
+                paras[i]['snr'] = snr_i
+                continue
+            ds = self.simulated_datasets[paras[i]['dataset']]
+            warnings.warn(f"skip {paras[i]['dataset']} item ({paras[i]['index']},{paras[i]['seed']})")
+            mix_i, target_i, paras[i] = ds.simulate((int(paras[i]['index']), int(paras[i]['seed'])), raw=False)
+            mix[i], target[i] = mix_i.to(mix.device), target_i.to(target.device)
+        return [mix, target, paras]
+
+    def on_after_batch_transfer(self, batch, dataloader_idx: int):
+        return self.mix_batch(batch)
+
     def train_dataloader(self) -> DataLoader:
         return self.construct_dataloader(
             dataset=self.datasets[0],
@@ -324,7 +435,7 @@ if __name__ == '__main__':
         print(f'{idx}/{len(dataloader)}')
         
         # write target to dir
-        noisy, tar, paras = packs
+        noisy, tar, paras = datamodule.mix_batch(packs)
         tar_path = Path(f"{args.save_dir}/{paras[0]['dataset']}/target").expanduser()
         noisy_path = Path(f"{args.save_dir}/{paras[0]['dataset']}/noisy").expanduser()
         param_path = Path(f"{args.save_dir}/{paras[0]['dataset']}/param").expanduser()
@@ -0,0 +1,236 @@
+##############################################################################################################
+# Pre-computed CleanMel features: the simulated mixtures of CleanMelDataset are turned into (noisy STFT, X_norm,
+# target log-mel) once, and stored in memory-mapped shards, so that the training/validation steps skip the simulation
+# (wav reading, RIR convolution, noise mixing) and the STFTs.
+#
+# Layout of a split dir (e.g. <feature_dir>/val/):
+#   meta.json                  the frontend configs, the dtype and the number of items
+#   shard_00000.X.npy          [sum of T, F, 2], the normalized noisy STFT of the items (time-major, items concatenated)
+#   shard_00000.X_norm.npy     [num items, 1] (offline, the soxnorm factor) or [sum of T, 1] (online, per frame)
+#   shard_00000.Y.npy          [sum of T, M], the target log-mel
+#   shard_00000.offsets.npy    [num items + 1], the frame offsets of the items
+#   shard_00000.paras.json     the paras of the items
+##############################################################################################################
+
+if __name__ == '__main__':
+    import os
+    import sys
+    parent_dir = os.path.abspath(os.path.dirname(__file__))
+    sys.path.append(os.path.dirname(parent_dir))
+    __package__ = os.path.basename(parent_dir)
+
+import json
+import os
+from glob import glob
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from pytorch_lightning import LightningDataModule
+from pytorch_lightning.utilities.rank_zero import rank_zero_info  # type: ignore
+from torch import Tensor
+from torch.utils.data import DataLoader, Dataset
+
+from data_loader.utils.collate_func import default_collate_func
+from data_loader.utils.my_distributed_sampler import MyDistributedSampler
+
+# the floor of the stored target log-mel (below the log_eps of the trainers)
+LOG_FLOOR = 1e-10
+
+
+def write_shard(path: str, items: List[Tuple[Tensor, Tensor, Tensor, Dict[str, Any]]], online: bool, dtype: str) -> None:
+    """write the features (X [F,T,2], X_norm, Y [M,T], paras) of some items to the shard `path`.*"""
+    offsets = np.cumsum([0] + [X.shape[1] for X, _, _, _ in items])
+    np.save(f"{path}.X.npy", np.concatenate([X.permute(1, 0, 2).cpu().numpy() for X, _, _, _ in items]).astype(dtype))
+    if online:
+        X_norm = np.concatenate([X_norm.reshape(-1, 1).cpu().numpy() for _, X_norm, _, _ in items])
+    else:
+        X_norm = np.stack([X_norm.reshape(1).cpu().numpy() for _, X_norm, _, _ in items])
+    np.save(f"{path}.X_norm.npy", X_norm.astype(np.float32))  # the normalization factors are kept in float32
+    np.save(f"{path}.Y.npy", np.concatenate([Y.T.cpu().numpy() for _, _, Y, _ in items]).astype(dtype))
+    np.save(f"{path}.offsets.npy", offsets)
+    json.dump([paras for _, _, _, paras in items], open(f"{path}.paras.json", 'w'))
+
+
+@torch.no_grad()
+def prepare_features(
+    dataloader: DataLoader,
+    input_stft: torch.nn.Module,
+    target_stft: torch.nn.Module,
+    save_dir: str,
+    num_items: Optional[int] = None,
+    shard_size: int = 512,
+    dtype: str = 'float16',
+    device: str = 'cpu',
+    meta: Dict[str, Any] = dict(),
+) -> None:
+    """compute the features of the (noisy, target, paras) items of `dataloader` (batch size 1) and write them as shards
+
+    Args:
+        dataloader: the dataloader of a CleanMelDataset, whose (index, seed) order fixes the mixtures
+        input_stft, target_stft: the frontends of the trainer (`InputSTFT`, `TargetMel`). They are used in their current mode,
+            i.e. in training mode the random soxnorm gain of the offline frontend is sampled per item
+        save_dir: the split dir
+        num_items: the number of items to prepare, all the items of the dataloader if None (e.g. a bounded pool of training mixtures)
+        shard_size: the number of items per shard
+        dtype: the dtype of the stored STFT and log-mel, float16 or float32
+    """
+    assert dtype in ['float16', 'float32'], dtype
+    os.makedirs(save_dir, exist_ok=True)
+    input_stft, target_stft = input_stft.to(device), target_stft.to(device)
+    items, num_shards, num_done = [], 0, 0
+    for noisy, target, paras in dataloader:
+        assert noisy.shape[0] == 1, "the features are prepared one item at a time"
+        x, y = noisy.to(device), target.to(device)
+        X, X_norm = input_stft(x)
+        Y = torch.log(torch.clip(target_stft(y, X_norm), min=LOG_FLOOR))
+        items.append((X[0], X_norm[0], Y[0], paras[0]))
+        num_done += 1
+        if len(items) == shard_size:
+            write_shard(f"{save_dir}/shard_{num_shards:05d}", items, input_stft.online, dtype)
+            items, num_shards = [], num_shards + 1
+            rank_zero_info(f"{num_done} items prepared")
+        if num_items is not None and num_done >= num_items:
+            break
+    if len(items) > 0:
+        write_shard(f"{save_dir}/shard_{num_shards:05d}", items, input_stft.online, dtype)
+    json.dump({**meta, 'online': input_stft.online, 'dtype': dtype, 'num_items': num_done}, open(f"{save_dir}/meta.json", 'w'), indent=4)
+
+
+class FeatureShardDataset(Dataset):
+    """the items of the shards written by `prepare_features`: (X [F,T,2], X_norm, Y [M,T], paras)
+
+    The shards are memory-mapped (copy-on-write, the files are never modified), and the items are `torch.from_numpy` views of
+    them, i.e. no copy is made before the collate function. The seed of (index, seed) is not used, as the mixtures are fixed.
+    """
+
+    def __init__(self, split_dir: str) -> None:
+        super().__init__()
+        self.split_dir = split_dir
+        self.meta = json.load(open(f"{split_dir}/meta.json", 'r'))
+        self.online = self.meta['online']
+        self.shards = []
+        self.index = []  # (shard, item in shard)
+        for s, path in enumerate(sorted(glob(f"{split_dir}/shard_*.offsets.npy"))):
+            path = path[:-len('.offsets.npy')]
+            shard = {k: np.load(f"{path}.{k}.npy", mmap_mode='c') for k in ['X', 'X_norm', 'Y']}
+            shard['offsets'] = np.load(f"{path}.offsets.npy")
+            shard['paras'] = json.load(open(f"{path}.paras.json", 'r'))
+            self.shards.append(shard)
+            self.index += [(s, i) for i in range(len(shard['offsets']) - 1)]
+        assert len(self.index) == self.meta['num_items'], (split_dir, len(self.index), self.meta['num_items'])
+
+    def __getitem__(self, index_seed: Tuple[int, int]):
+        shard_id, i = self.index[index_seed[0]]
+        shard = self.shards[shard_id]
+        st, ed = shard['offsets'][i], shard['offsets'][i + 1]
+        X = torch.from_numpy(shard['X'][st:ed]).permute(1, 0, 2)  # [F,T,2]
+        X_norm = torch.from_numpy(shard['X_norm'][st:ed]).T if self.online else torch.from_numpy(shard['X_norm'][i])  # [1,T] or [1]
+        Y = torch.from_numpy(shard['Y'][st:ed]).T  # [M,T]
+        return X, X_norm, Y, shard['paras'][i]
+
+    def __len__(self):
+        return len(self.index)
+
+
+class FeatureShardDataModule(LightningDataModule):
+    """DataModule of the pre-computed features of the splits in `feature_dir` (see `prepare_features`)
+
+    The batches are (X [B,F,T,2], X_norm, Y [B,M,T], paras), which the trainers feed to CleanMel directly (see `forward_features`).
+    Only train/val: the test steps need the waveforms (for Vocos and the metrics), so test with the waveform datamodule.
+    """
+
+    def __init__(
+        self,
+        feature_dir: str = 'dataset/CleanMelFeatures',  # a dir contains [train, val]
+        splits: Tuple[str, str] = ('train', 'val'),  # the split dirs for train/val
+        batch_size: List[int] = [2, 1],
+        num_workers: int = 4,
+        collate_func: Callable = default_collate_func,
+        seeds: Tuple[Optional[int], int] = [None, 2],  # random seeds for the shuffling of train, and for val
+        pin_memory: bool = True,
+        prefetch_factor: int = 5,
+        persistent_workers: bool = False,
+    ):
+        super().__init__()
+        self.feature_dir = feature_dir
+        self.splits = splits
+        self.batch_size = list(batch_size) + [1] * (2 - len(batch_size))
+        self.num_workers = num_workers
+        self.collate_func = collate_func
+        self.seeds = [seed if seed is not None else np.random.randint(0, 1000000) for seed in seeds]
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
+        self.persistent_workers = persistent_workers
+        rank_zero_info(f"dataset: pre-computed features in {feature_dir}, splits={splits}")
+
+    def setup(self, stage=None):
+        self.current_stage = stage
+
+    def construct_dataloader(self, split, seed, shuffle, batch_size):
+        ds = FeatureShardDataset(f"{self.feature_dir}/{split}")
+        return DataLoader(
+            ds,
+            sampler=MyDistributedSampler(ds, seed=seed, shuffle=shuffle),  #
+            batch_size=batch_size,  #
+            collate_fn=self.collate_func,  #
+            num_workers=self.num_workers,
+            prefetch_factor=self.prefetch_factor if self.num_workers > 0 else None,
+            pin_memory=self.pin_memory,
+            persistent_workers=self.persistent_workers,
+        )
+
+    def train_dataloader(self) -> DataLoader:
+        return self.construct_dataloader(self.splits[0], seed=self.seeds[0], shuffle=True, batch_size=self.batch_size[0])
+
+    def val_dataloader(self) -> DataLoader:
+        return self.construct_dataloader(self.splits[1], seed=self.seeds[1], shuffle=False, batch_size=self.batch_size[1])
+
+
+if __name__ == '__main__':
+    """To prepare the features of the validation set of configs/dataset/train.yaml for the offline model:
+        python -m data_loader.feature_shards --model_config configs/model/cleanmel_offline.yaml --data_config configs/dataset/train.yaml --split val --save_dir dataset/CleanMelFeatures/offline
+    """
+    import argparse
+    import importlib
+    import yaml
+
+    from data_loader.SPencn_NSdns_RIRreal import CleanMelDataModule
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_config', type=str, default='configs/model/cleanmel_offline.yaml', help='for the input_stft and target_stft')
+    parser.add_argument('--data_config', type=str, default='configs/dataset/train.yaml', help='the config of CleanMelDataModule')
+    parser.add_argument('--split', type=str, default='val', choices=['train', 'val'])
+    parser.add_argument('--save_dir', type=str, default='dataset/CleanMelFeatures')
+    parser.add_argument('--num_items', type=int, default=None, help='the number of items, e.g. the size of a training pool')
+    parser.add_argument('--shard_size', type=int, default=512)
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'float32'])
+    parser.add_argument('--seed', type=int, default=None, help='the seed of the split, the one of the data config if not given')
+    parser.add_argument('--device', type=str, default='cpu')
+    args = parser.parse_args()
+
+    def instantiate(config):
+        module, name = config['class_path'].rsplit('.', 1)
+        return getattr(importlib.import_module(module), name)(**config.get('init_args', {}))
+
+    model_config = yaml.safe_load(open(args.model_config, 'r'))['model']
+    input_stft, target_stft = instantiate(model_config['input_stft']), instantiate(model_config['target_stft'])
+    # the training pool is prepared with the training-mode frontend (random soxnorm gain), val with the eval-mode one
+    input_stft.train(args.split == 'train')
+    target_stft.train(args.split == 'train')
+
+    data_args = yaml.safe_load(open(args.data_config, 'r'))['data']['init_args']
+    data_args.update(num_workers=0, prefetch_factor=None, batched_mixing=False)
+    datamodule = CleanMelDataModule(**data_args)
+    split_id = ['train', 'val'].index(args.split)
+    seed = args.seed if args.seed is not None else datamodule.seeds[split_id]
+    dataloader = datamodule.construct_dataloader(
+        dataset=datamodule.datasets[split_id],
+        audio_time_len=datamodule.audio_time_len[split_id],
+        seed=seed,
+        shuffle=False,
+        batch_size=1,
+        collate_fn=datamodule.collate_func,
+    )
+    meta = {'input_stft': model_config['input_stft'], 'target_stft': model_config['target_stft'], 'seed': seed}
+    prepare_features(dataloader, input_stft, target_stft, f"{args.save_dir}/{args.split}", args.num_items, args.shard_size, args.dtype, args.device, meta)
@@ -1,24 +1,27 @@
 import torch
 import numpy as np
 import soundfile as sf
-from glob import glob
-from typing import Callable
+from typing import Callable, Optional
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader, Dataset
-from data_loader.utils.collate_func import default_collate_func
+from data_loader.utils.collate_func import pad_collate_func
+from data_loader.utils.manifest import AudioManifest
 from data_loader.utils.my_distributed_sampler import MyDistributedSampler
+from data_loader.utils.length_bucket_sampler import LengthBucketBatchSampler
 
 
 class InferenceDataset(Dataset):
     def __init__(self, speech_dir: str, sample_rate: int) -> None:
         super().__init__()
         self.speech_dir = speech_dir
-        self.uttrs = glob(f"{self.speech_dir}/**/*.wav", recursive=True) + glob(f"{self.speech_dir}/**/*.flac", recursive=True)
-        self.uttrs.sort()
+        # the files and their headers are indexed in a manifest, see AudioManifest
+        manifest = AudioManifest.scan([f"{self.speech_dir}/**/*.wav", f"{self.speech_dir}/**/*.flac"])
+        self.uttrs = manifest.paths
         
         # sanity check
-        for uttr in self.uttrs:
-            assert sf.info(uttr).samplerate == sample_rate, f"{uttr} has wrong sample rate"
+        wrong = np.flatnonzero(manifest.samplerate != sample_rate)
+        assert len(wrong) == 0, f"{self.uttrs[wrong[0]]} has wrong sample rate"
+        self.lengths = manifest.frames.tolist()
         
     def __getitem__(self, index_seed: tuple[int, int]):
         uttr_id = index_seed[0]
@@ -38,8 +41,9 @@ class InferenceDataModule(LightningDataModule):
         self,
         speech_dir: str = './src/demos/',  # a dir contains [train-clean-100, train-clean-360]
         batch_size: int = 1,
+        max_batch_samples: Optional[int] = None,  # the max number of padded samples per batch, see LengthBucketBatchSampler
         num_workers: int = 2,
-        collate_func: Callable = default_collate_func,
+        collate_func: Callable = pad_collate_func,
         seed: int = 2,  # random seeds for train, val and test sets
         pin_memory: bool = True,
         prefetch_factor: int = 5,
@@ -50,6 +54,7 @@ class InferenceDataModule(LightningDataModule):
         self.speech_dir = speech_dir
         self.persistent_workers = persistent_workers
         self.batch_size = batch_size
+        self.max_batch_samples = max_batch_samples
         self.num_workers = num_workers
         self.collate_func = collate_func
         self.seed = seed
@@ -59,10 +64,14 @@ class InferenceDataModule(LightningDataModule):
 
     def construct_dataloader(self):
         ds = InferenceDataset(speech_dir=self.speech_dir, sample_rate=self.sample_rate)
+        if self.batch_size > 1:
+            # batch the utterances of similar lengths, padded by pad_collate_func
+            sampler = dict(batch_sampler=LengthBucketBatchSampler(ds.lengths, batch_size=self.batch_size, max_batch_samples=self.max_batch_samples, seed=self.seed))
+        else:
+            sampler = dict(sampler=MyDistributedSampler(ds, seed=self.seed, shuffle=False), batch_size=1)
         return DataLoader(
             ds,
-            sampler=MyDistributedSampler(ds, seed=self.seed, shuffle=False),  #
-            batch_size=self.batch_size,  #
+            **sampler,  #
             collate_fn=self.collate_func,  #
             num_workers=self.num_workers,
             prefetch_factor=self.prefetch_factor,
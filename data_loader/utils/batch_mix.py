@@ -0,0 +1,63 @@
+from typing import Tuple
+
+import scipy.fft as sfft
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+
+class BatchMixer(nn.Module):
+    """The mixing of `CleanMelDataset` (step 4 to 6) for a batch, on the device of the batch: the convolution of the clean speech
+    with the RIR and its direct-path part, the SNR scaling of the noise, the check of the SNR, and the peak normalization.
+
+    The inputs are the raw segments returned by the dataset with `batched_mixing` (see `CleanMelDataset.simulate`), the RIRs being
+    zero-padded to the longest one of the batch. The mixtures are the ones of the per-item mixing up to the FFT round-off; the items
+    whose SNR check fails (the per-item mixing resamples them) are flagged by `valid`.
+    """
+
+    def __init__(self, snr_atol: float = 0.1) -> None:
+        super().__init__()
+        self.snr_atol = snr_atol
+
+    @staticmethod
+    def convolve(wav: Tensor, filters: Tensor) -> Tensor:
+        """the first T samples of the convolution of wav [B, T] with the filters [B, K, L], i.e. [B, K, T]"""
+        T = wav.shape[-1]
+        filters = filters[..., :T]  # the later taps do not reach the output
+        n = sfft.next_fast_len(T + filters.shape[-1] - 1, real=True)
+        y = torch.fft.irfft(torch.fft.rfft(wav, n=n).unsqueeze(1) * torch.fft.rfft(filters, n=n), n=n)
+        return y[..., :T]
+
+    def forward(self, clean: Tensor, noise: Tensor, rir: Tensor, rir_target: Tensor, reverb: Tensor, snr: Tensor) -> Tuple[Tensor, Tensor, Tensor, Tensor]:
+        """
+        Args:
+            clean: [B, T], the clean speech cut to T
+            noise: [B, T], the noise cut to T
+            rir: [B, L], the RIRs starting at the direct path
+            rir_target: [B, L'], the direct-path RIRs
+            reverb: [B], whether the clean speech is convolved with the RIRs (else the mixture and the target are the dry speech)
+            snr: [B], the SNRs (dB)
+
+        Returns:
+            mix [B, T], target [B, T], the real SNRs [B], and whether the items are valid [B]
+        """
+        L = max(rir.shape[-1], rir_target.shape[-1])
+        filters = torch.stack([nn.functional.pad(rir, (0, L - rir.shape[-1])), nn.functional.pad(rir_target, (0, L - rir_target.shape[-1]))], dim=1)
+        rvbt = self.convolve(clean, filters.to(clean.dtype))
+        reverb = reverb.bool().unsqueeze(-1)
+        mix, target = torch.where(reverb, rvbt[:, 0], clean), torch.where(reverb, rvbt[:, 1], clean)
+
+        # adjust snr, as cal_coeff_for_adjusting_relative_energy
+        snr = snr.to(torch.float64)
+        ae1, ae2 = mix.square().mean(dim=-1).to(torch.float64), noise.square().mean(dim=-1).to(torch.float64)
+        valid = (ae1 > 0) & (ae2 > 0) & ae1.isfinite() & ae2.isfinite()
+        coeff = torch.sqrt(ae1 / ae2 * torch.pow(10, -snr / 10))
+        noise = noise * torch.where(valid, coeff, 0).to(noise.dtype).unsqueeze(-1)
+        # compute real snr (allow slightly different from snr)
+        snr_real = 10 * torch.log10(mix.square().sum(dim=-1) / noise.square().sum(dim=-1)).to(torch.float64)
+        valid &= torch.isclose(snr, snr_real, atol=self.snr_atol)
+
+        # add noise, and normalize (only for avoiding overflow/underflow)
+        mix = mix + noise
+        scale_value = 0.9 / torch.maximum(mix.abs().amax(dim=-1), target.abs().amax(dim=-1))
+        return mix * scale_value.unsqueeze(-1), target * scale_value.unsqueeze(-1), snr_real, valid
@@ -14,3 +14,21 @@ def default_collate_func(batches: List[Tuple[Tensor, Tensor, Dict[str, Any]]]) -
             x = torch.stack(x)
         mini_batch.append(x)
     return mini_batch
+
+
+def pad_collate_func(batches: List[Tuple[Tensor, Any]]) -> List[Any]:
+    """collate utterances of different lengths: the tensors are zero-padded at the end (of the last dim) to the longest one,
+    and the lengths [B] of the first tensor item are appended to the mini-batch, e.g. (x, wavename) -> (x, wavename, lengths)
+    """
+    mini_batch, lengths = [], None
+    for x in zip(*batches):
+        if isinstance(x[0], np.ndarray):
+            x = [torch.tensor(x[i]) for i in range(len(x))]
+        if isinstance(x[0], Tensor):
+            if lengths is None:
+                lengths = torch.tensor([xi.shape[-1] for xi in x], dtype=torch.long)
+            max_len = max(xi.shape[-1] for xi in x)
+            x = torch.stack([torch.nn.functional.pad(xi, (0, max_len - xi.shape[-1])) for xi in x])
+        mini_batch.append(x)
+    mini_batch.append(lengths)
+    return mini_batch
@@ -0,0 +1,134 @@
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+
+from data_loader.utils.manifest import AudioManifest
+from data_loader.utils.mix import max_energy_starts
+
+# the frames of the energy envelopes, 100 Hz at 16 kHz
+HOP = 160
+# the relative error allowed for the float32 chunk energies of `pad_or_cut_sample` when comparing them with the envelope bounds
+MARGIN = 1e-4
+
+
+def build_energy_index(manifest: AudioManifest, hop: int = HOP, save_to: Optional[str] = None) -> str:
+    """index the energy envelopes of the files of `manifest`: the energy (the sum of the squared samples, over the channels) of the
+    frames of `hop` samples of every file, stored as cumulative sums (float64) in one flat array `<save_to>.data.npy`, and
+    `<save_to>.index.npy` records per file: the path, the offset of its cumulative sums, its frames and its mtime/size when indexed
+
+    Returns:
+        the prefix `save_to` of the index, `<manifest>.energy` by default
+    """
+    assert manifest.path is not None or save_to is not None, 'the manifest is not stored, please give save_to'
+    save_to = save_to or os.path.splitext(manifest.path)[0] + '.energy'
+    num_hops = (manifest.frames + hop - 1) // hop
+    data = np.lib.format.open_memmap(f"{save_to}.data.npy", mode='w+', dtype=np.float64, shape=(int(np.sum(num_hops + 1)),))
+    offsets = np.concatenate([[0], np.cumsum(num_hops + 1)[:-1]]).astype(np.int64)
+    for i, path in enumerate(manifest.paths):
+        wav, _ = sf.read(path, dtype='float32', always_2d=True)
+        energy = np.sum(wav.astype(np.float64)**2, axis=1)
+        energy = np.pad(energy, (0, num_hops[i] * hop - len(energy))).reshape(num_hops[i], hop).sum(axis=1)
+        data[offsets[i]] = 0
+        data[offsets[i] + 1:offsets[i] + 1 + num_hops[i]] = np.cumsum(energy)
+    data.flush()
+    del data
+    index = np.zeros(len(manifest), dtype=[('path', manifest.table['path'].dtype), ('offset', np.int64), ('frames', np.int64), ('mtime_ns', np.int64), ('size', np.int64)])
+    for k in ['path', 'frames', 'mtime_ns', 'size']:
+        index[k] = manifest.table[k]
+    index['offset'] = offsets
+    np.save(f"{save_to}.index.npy", index)
+    json.dump({'manifest': manifest.path, 'hop': hop}, open(f"{save_to}.json", 'w'), indent=4)
+    return save_to
+
+
+class EnergyIndex:
+    """The energy envelopes indexed by `build_energy_index`, memory-mapped, to find the max-energy chunk of `pad_or_cut_sample` from
+    the metadata: the chunk energies are bounded by the sums of the frames inside/overlapping the chunks, and the chunks whose upper
+    bound is below the largest lower bound can not be the max-energy one. Only the span of the remaining chunks needs to be read to
+    compute their exact energies, which is the chunk itself when it is unique.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.hop: int = json.load(open(f"{path}.json", 'r'))['hop']
+        self.data = np.load(f"{path}.data.npy", mmap_mode='r')
+        self.index = np.load(f"{path}.index.npy")
+        self.rows: Dict[str, int] = {p.decode(): i for i, p in enumerate(self.index['path'])}
+
+    @classmethod
+    def for_manifest(cls, manifest: AudioManifest) -> Optional['EnergyIndex']:
+        """the energy index of `manifest` if it was built, else None"""
+        if manifest.path is None:
+            return None
+        path = os.path.splitext(manifest.path)[0] + '.energy'
+        return cls(path) if os.path.exists(f"{path}.json") else None
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def envelope(self, path: str) -> Optional[np.ndarray]:
+        """the cumulative frame energies of `path`, None if not indexed or changed since (by mtime and size)"""
+        i = self.rows.get(path, None)
+        if i is None:
+            return None
+        e = self.index[i]
+        st = os.stat(path)
+        if (st.st_mtime_ns, st.st_size) != (e['mtime_ns'], e['size']):
+            return None
+        return self.data[e['offset']:e['offset'] + (e['frames'] + self.hop - 1) // self.hop + 1]
+
+    def max_energy_candidates(self, path: str, length: int) -> Optional[Tuple[List[int], int, int]]:
+        """the starts of the chunks of `pad_or_cut_sample` (for a wav longer than `length` + length // 4) which may be the max-energy
+        one, and the span [start, end) of the file containing them; None if the file is not indexed"""
+        cums = self.envelope(path)
+        if cums is None:
+            return None
+        num_frames = int(self.index[self.rows[path]]['frames'])
+        starts = np.asarray(max_energy_starts(num_frames, length))
+        ends, hop = starts + length, self.hop
+        # the frames inside the chunk: [ceil(start / hop), floor(end / hop)); overlapping: [floor(start / hop), ceil(end / hop))
+        lower = np.maximum(cums[ends // hop] - cums[np.minimum(-(-starts // hop), ends // hop)], 0)
+        upper = cums[-(-ends // hop)] - cums[starts // hop]
+        keep = upper * (1 + MARGIN) >= lower.max() * (1 - MARGIN)
+        candidates = starts[keep].tolist()
+        return candidates, candidates[0], candidates[-1] + length
+
+
+if __name__ == '__main__':
+    """To index the energy envelopes of the speech of the train/val/test sets:
+        python -m data_loader.utils.energy_index --speech_dir YOUR_SPEECH_DIR"""
+    import argparse
+    import time
+
+    from data_loader.utils.mix import max_energy_chunk, pad_or_cut_sample
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--speech_dir', type=str, required=True, help='a dir contains [train, val, test]')
+    parser.add_argument('--length', type=float, default=4.0, help='the audio_time_len (seconds) for the report')
+    args = parser.parse_args()
+    for split in ['train', 'val', 'test']:
+        d = f"{args.speech_dir}/{split}/"
+        if not os.path.isdir(d):
+            continue
+        # the patterns of CleanMelDataset
+        manifest = AudioManifest.scan([f"{d}/*.wav", f"{d}/*.flac"])
+        ts = time.perf_counter()
+        index = EnergyIndex(build_energy_index(manifest))
+        print(f"{d}: {len(index)} files indexed in {time.perf_counter() - ts:.1f}s -> {index.path}.*")
+
+        # check the max-energy chunks of the long files against pad_or_cut_sample, and count the samples read
+        length = int(args.length * manifest.samplerate[0]) if len(manifest) > 0 else 0
+        num, read_index, read_full = 0, 0, 0
+        for path, frames in zip(manifest.paths, manifest.frames):
+            if frames - length <= length // 4:
+                continue
+            candidates, start, end = index.max_energy_candidates(path, length)
+            wav, _ = sf.read(path, dtype='float32')
+            chunk = max_energy_chunk(wav[start:end], length, candidates, offset=start)
+            assert np.array_equal(wav[chunk:chunk + length], pad_or_cut_sample(wav, length, rng=None)), path
+            num, read_index, read_full = num + 1, read_index + end - start, read_full + frames
+        if num > 0:
+            print(f"  {num} files cut to the max-energy chunk: {read_index / read_full * 100:.1f}% of the samples read")
@@ -0,0 +1,83 @@
+##############################################################################################################
+# Batch utterances of similar lengths, so that a padded batch of N utterances costs about one forward pass.
+##############################################################################################################
+
+from typing import Iterator, List, Optional, Tuple
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import BatchSampler, Sampler
+
+
+class LengthBucketBatchSampler(BatchSampler):
+    r"""Batch sampler grouping the utterances sorted by length, for the padded batches of `pad_collate_func`.
+
+    The utterances are sorted by length (longest first), and consecutive ones are grouped into batches of at most `batch_size`
+    utterances and at most `max_batch_samples` padded samples. The batches are dealt round-robin to the replicas. Like
+    `MyDistributedSampler`, each index is given with a random seed, i.e. the items are tuples (index, seed).
+
+    It is a `BatchSampler` because Lightning re-creates the batch sampler of the predict dataloader with a `sampler` and
+    `drop_last=False` injected: both are accepted, and the batches depend on `lengths` only.
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        batch_size: int,
+        max_batch_samples: Optional[int] = None,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        seed: int = 0,
+        sampler: Optional[Sampler] = None,
+        drop_last: bool = False,
+    ) -> None:
+        """
+        Args:
+            lengths: the lengths (samples) of the utterances of the dataset
+            batch_size: the max number of utterances per batch
+            max_batch_samples: the max number of padded samples per batch (batch size x longest length), None for no limit.
+                An utterance longer than it gets its own batch.
+            num_replicas, rank: the distributed setting, taken from the default process group if not given
+            sampler: ignored, as the order of the utterances is given by their lengths
+            drop_last: not supported (the last batch is never dropped), for the interface of BatchSampler
+        """
+        assert not drop_last, 'drop_last is not supported by LengthBucketBatchSampler'
+        # BatchSampler.__init__ is not called, as it requires a sampler
+        self.sampler = sampler
+        self.drop_last = drop_last
+        if num_replicas is None or rank is None:
+            if dist.is_available() and dist.is_initialized():
+                num_replicas, rank = dist.get_world_size(), dist.get_rank()
+            else:
+                # single process
+                num_replicas, rank = 1, 0
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.max_batch_samples = max_batch_samples
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.batches = self._make_batches()
+
+    def _make_batches(self) -> List[List[int]]:
+        order = sorted(range(len(self.lengths)), key=lambda i: self.lengths[i], reverse=True)
+        batches, batch = [], []
+        for i in order:
+            # the first utterance of a batch is the longest one
+            if batch and (len(batch) >= self.batch_size or (self.max_batch_samples is not None and (len(batch) + 1) * self.lengths[batch[0]] > self.max_batch_samples)):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self) -> Iterator[List[Tuple[int, int]]]:
+        g = torch.Generator()
+        g.manual_seed(self.seed)
+        for batch in self.batches:
+            seeds = torch.randint(high=9999999999, size=(len(batch),), generator=g).tolist()
+            yield list(zip(batch, seeds))
+
+    def __len__(self) -> int:
+        return len(self.batches)
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import tempfile
+from glob import glob
+from typing import Dict, List, Optional
+
+import numpy as np
+import soundfile as sf
+
+# the default dir of the manifests, shared by the ranks and workers of a host
+MANIFEST_DIR = os.environ.get('CLEANMEL_MANIFEST_DIR', '~/.cache/cleanmel/manifests')
+
+
+class AudioManifest:
+    """An index of audio files: path, frames, sample rate, channels, and the mtime/size of the file when it was indexed.
+
+    `scan` globs the files and only calls `sf.info` on the files which are new or changed since the last scan (by mtime and size);
+    and if the globbed dirs did not change since (by mtime, for non-recursive patterns), the globbing is skipped as well, but the
+    files are still stat'ed, as a file rewritten in place does not change the mtime of its dir. The table
+    is stored as a structured .npy in `manifest_dir`, written atomically, and memory-mapped read-only, so that the ranks and workers
+    of a host share it instead of re-reading the headers of every file.
+    """
+
+    def __init__(self, table: np.ndarray, path: Optional[str] = None) -> None:
+        self.table = table
+        self.path = path  # the .npy of the table, if stored
+        self.paths: List[str] = [p.decode() for p in table['path']]
+
+    @property
+    def frames(self) -> np.ndarray:
+        return self.table['frames']
+
+    @property
+    def samplerate(self) -> np.ndarray:
+        return self.table['samplerate']
+
+    @property
+    def channels(self) -> np.ndarray:
+        return self.table['channels']
+
+    def duration(self) -> np.ndarray:
+        """the durations in seconds"""
+        return self.frames / self.samplerate
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    @staticmethod
+    def _dir_mtimes(patterns: List[str]) -> Optional[Dict[str, int]]:
+        """the mtimes of the dirs of the (non-recursive) patterns, which change when files are added or removed"""
+        if any('**' in p for p in patterns):
+            return None
+        dirs = sorted(set(os.path.dirname(p) for p in patterns))
+        return {d: os.stat(d).st_mtime_ns if os.path.isdir(d) else -1 for d in dirs}
+
+    @staticmethod
+    def _unchanged(table: np.ndarray) -> bool:
+        """whether the files of the table still have their indexed mtime and size"""
+        for p, mtime_ns, size in zip(table['path'], table['mtime_ns'], table['size']):
+            try:
+                st = os.stat(p.decode())
+            except FileNotFoundError:
+                return False
+            if st.st_mtime_ns != mtime_ns or st.st_size != size:
+                return False
+        return True
+
+    @classmethod
+    def scan(cls, patterns: List[str], manifest_dir: Optional[str] = None) -> 'AudioManifest':
+        """the manifest of the files matching the glob `patterns` (sorted by path), updated incrementally"""
+        manifest_dir = os.path.expanduser(manifest_dir or MANIFEST_DIR)
+        os.makedirs(manifest_dir, exist_ok=True)
+        key = hashlib.sha1(json.dumps([os.path.abspath(p) for p in patterns]).encode()).hexdigest()
+        path, meta_path = f"{manifest_dir}/{key}.npy", f"{manifest_dir}/{key}.json"
+
+        old, dir_mtimes = None, cls._dir_mtimes(patterns)
+        if os.path.exists(path) and os.path.exists(meta_path):
+            old = np.load(path, mmap_mode='r')
+            if dir_mtimes is not None and json.load(open(meta_path, 'r')).get('dir_mtimes') == dir_mtimes and cls._unchanged(old):
+                return cls(old, path)  # no file was added, removed or rewritten
+
+        files = sorted(set(f for p in patterns for f in glob(p, recursive=True)))
+        known = {} if old is None else {p.decode(): i for i, p in enumerate(old['path'])}
+        rows, changed = [], old is None or len(files) != len(old)
+        for f in files:
+            st = os.stat(f)
+            i = known.get(f, None)
+            if i is not None and old['mtime_ns'][i] == st.st_mtime_ns and old['size'][i] == st.st_size:
+                rows.append((f.encode(), old['frames'][i], old['samplerate'][i], old['channels'][i], st.st_mtime_ns, st.st_size))
+                continue
+            info = sf.info(f)
+            rows.append((f.encode(), info.frames, info.samplerate, info.channels, st.st_mtime_ns, st.st_size))
+            changed = True
+
+        if old is not None and not changed:
+            table = old
+        else:
+            width = max([len(r[0]) for r in rows], default=1)
+            dtype = [('path', f'S{width}'), ('frames', np.int64), ('samplerate', np.int32), ('channels', np.int16), ('mtime_ns', np.int64), ('size', np.int64)]
+            table = np.array(rows, dtype=dtype)
+            fd, tmp = tempfile.mkstemp(dir=manifest_dir, suffix='.npy')
+            with os.fdopen(fd, 'wb') as fp:
+                np.save(fp, table)
+            os.replace(tmp, path)
+            table = np.load(path, mmap_mode='r')
+        fd, tmp = tempfile.mkstemp(dir=manifest_dir, suffix='.json')
+        with os.fdopen(fd, 'w') as fp:
+            json.dump({'patterns': patterns, 'dir_mtimes': dir_mtimes}, fp)
+        os.replace(tmp, meta_path)
+        return cls(table, path)
+
+
+if __name__ == '__main__':
+    # compare the scan of a dir of wavs with sf.info on every file, cold (first scan) and warm (the manifest is up to date)
+    # python -m data_loader.utils.manifest --num 2000
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num', type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        os.makedirs(f"{d}/wavs")
+        for i in range(args.num):
+            sf.write(f"{d}/wavs/{i:06d}.wav", np.zeros(1600 + i, dtype=np.float32), 16000)
+        patterns = [f"{d}/wavs/*.wav", f"{d}/wavs/*.flac"]
+        ts = time.perf_counter()
+        files = sorted(glob(patterns[0]) + glob(patterns[1]))
+        hours = sum([sf.info(x).duration for x in files]) / 3600
+        t_info = time.perf_counter() - ts
+        ts = time.perf_counter()
+        m = AudioManifest.scan(patterns, manifest_dir=f"{d}/manifests")
+        t_cold = time.perf_counter() - ts
+        ts = time.perf_counter()
+        m = AudioManifest.scan(patterns, manifest_dir=f"{d}/manifests")
+        t_warm = time.perf_counter() - ts
+        # a file rewritten in place (the dir mtime is unchanged) is re-indexed
+        dir_mtime = os.stat(f"{d}/wavs").st_mtime_ns
+        sf.write(f"{d}/wavs/{0:06d}.wav", np.zeros(800, dtype=np.float32), 16000)
+        assert os.stat(f"{d}/wavs").st_mtime_ns == dir_mtime and AudioManifest.scan(patterns, manifest_dir=f"{d}/manifests").frames[0] == 800
+        sf.write(f"{d}/wavs/{0:06d}.wav", np.zeros(1600, dtype=np.float32), 16000)
+        sf.write(f"{d}/wavs/new.wav", np.zeros(16000, dtype=np.float32), 16000)
+        ts = time.perf_counter()
+        m = AudioManifest.scan(patterns, manifest_dir=f"{d}/manifests")
+        t_inc = time.perf_counter() - ts
+        assert m.paths[:-1] == files and abs(m.duration()[:-1].sum() / 3600 - hours) < 1e-9 and len(m) == args.num + 1
+        print(f"{args.num} files: sf.info={t_info:.3f}s, manifest cold={t_cold:.3f}s, warm={t_warm * 1e3:.2f}ms, one new file={t_inc:.3f}s")
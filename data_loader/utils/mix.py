@@ -21,9 +21,11 @@ hms: headtail, mid or startend
 fhms: full, headtail, mid or startend
 """
 
+from collections import OrderedDict
 from typing import *
 
 import numpy as np
+import scipy.fft as sfft
 from numpy import ndarray
 from numpy.random import Generator
 from scipy.signal import fftconvolve
@@ -135,6 +137,32 @@ def pad_or_cut_sample(wav, length, rng):
             start = rng.integers(low=0, high=len(wav) - length + 1)
             wav = wav[start:start + length]
     return wav
+
+
+def crop_window(num_frames: int, length: int, rng: Generator) -> Optional[int]:
+    """the start of the window of `length` samples that `pad_or_cut_sample` cuts from a wav of `num_frames` samples, drawn from rng
+    as `pad_or_cut_sample` does, so that only the window needs to be read. None (and nothing is drawn) if the window depends on the
+    samples, i.e. for a repeated wav or the max-energy chunk: then read the whole wav and call `pad_or_cut_sample`.
+    """
+    if length == num_frames:
+        return 0
+    if length < num_frames and (num_frames - length) <= length // 4:
+        return rng.integers(low=0, high=num_frames - length + 1)
+    return None
+
+
+
+def max_energy_starts(num_frames: int, length: int) -> range:
+    """the starts of the chunks compared by `pad_or_cut_sample` to cut the max-energy chunk of a wav of `num_frames` > length samples"""
+    return range(0, num_frames - length + 1, (num_frames - length) // 10)
+
+
+def max_energy_chunk(wav: ndarray, length: int, starts: Sequence[int], offset: int = 0) -> int:
+    """the start of the max-energy chunk among the chunks [start, start + length) of `starts` (the first one if tied), the energies
+    computed as in `pad_or_cut_sample`; `wav` is the segment of the wav from `offset`, which contains the chunks"""
+    chunk_energies = [np.sum(chunk**2) / np.prod(chunk.shape) for chunk in [wav[i - offset:i - offset + length] for i in starts]]
+    return starts[int(np.argmax(chunk_energies))]
+
 # np.sum(wav1**2) / np.prod(wav1.shape)
 def pad_or_cut_sample_with_st(wav, length, st):
     while length > len(wav):
@@ -159,6 +187,73 @@ def convolve(wav: ndarray, rir: ndarray, rir_target: ndarray, ref_channel: Optio
     return rvbt, target
 
 
+
+class RIRConvolver:
+    """FFT convolution of a wav with a few filters (e.g. the RIR and its direct-path target), which only computes the first
+    `out_len` output samples, and caches the filter spectra.
+
+    The output is computed by overlap-save with blocks of `block_size` output samples: the filters are truncated to the first
+    `out_len` taps (the later ones do not reach the output), the FFT size is fixed per filter length (so the spectra of the RIRs of
+    a fixed pool, at a fixed audio_time_len, are computed once), and all the filters are applied with one stacked transform of the
+    wav. The spectra are kept in an LRU cache of at most `max_cache_mb` MB.
+
+    The output is the one of `convolve(wav, rir, rir_target, align=False)` cut to `out_len`, up to the FFT round-off.
+    """
+
+    def __init__(self, block_size: int, max_cache_mb: float = 128) -> None:
+        self.block_size = block_size
+        self.max_cache_bytes = max_cache_mb * 1e6
+        self.cache: 'OrderedDict[Hashable, ndarray]' = OrderedDict()
+        self.cache_bytes = 0
+        self.hits, self.misses = 0, 0
+
+    def spectra(self, key: Optional[Hashable], filters: ndarray, fft_size: int) -> ndarray:
+        """the rfft of the filters [K, L] at fft_size, cached by (key, fft_size, L) if key is given"""
+        if key is None:
+            return sfft.rfft(filters, fft_size, axis=-1)
+        key = (key, fft_size, filters.shape[-1])
+        if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.misses += 1
+        H = sfft.rfft(filters, fft_size, axis=-1)
+        self.cache[key] = H
+        self.cache_bytes += H.nbytes
+        while self.cache_bytes > self.max_cache_bytes and len(self.cache) > 1:
+            self.cache_bytes -= self.cache.popitem(last=False)[1].nbytes
+        return H
+
+    def convolve(self, wav: ndarray, filters: List[ndarray], out_len: Optional[int] = None, key: Optional[Hashable] = None) -> List[ndarray]:
+        """the first `out_len` (default len(wav)) samples of the convolution of wav [T] with each of the filters [1, L_k]
+
+        Args:
+            key: the key of the filters in the cache (e.g. the RIR id and channel), not cached if None
+
+        Returns:
+            the outputs [1, out_len] of the filters
+        """
+        assert wav.ndim == 1, wav.shape
+        N = wav.shape[-1] if out_len is None else out_len
+        dtype = np.result_type(wav, *filters)
+        Lh = min(max(f.shape[-1] for f in filters), N)
+        h = np.zeros((len(filters), Lh), dtype=dtype)
+        for k, f in enumerate(filters):
+            h[k, :min(f.shape[-1], Lh)] = f[0, :Lh]
+        B = min(self.block_size, N)
+        fft_size = sfft.next_fast_len(B + Lh - 1, real=True)
+        hop = fft_size - Lh + 1  # the valid output samples per block, >= B
+        num_blocks = -(-N // hop)
+        # the input blocks: the Lh-1 previous samples and hop new ones
+        x = np.zeros(num_blocks * hop + Lh - 1, dtype=dtype)
+        x[Lh - 1:Lh - 1 + min(N, wav.shape[-1])] = wav[:N]
+        blocks = np.lib.stride_tricks.sliding_window_view(x, fft_size)[::hop][:num_blocks]  # [num_blocks, fft_size]
+        H = self.spectra(key, h, fft_size)  # [K, F]
+        y = sfft.irfft(sfft.rfft(blocks, axis=-1)[np.newaxis] * H[:, np.newaxis], fft_size, axis=-1)[..., Lh - 1:]  # [K, num_blocks, hop]
+        y = y.reshape(len(filters), -1)[:, :N].astype(dtype, copy=False)
+        return [y[k:k + 1] for k in range(len(filters))]
+
+
 def convolve_traj(wav: np.ndarray, traj_rirs: np.ndarray, traj_rirs_tar: np.ndarray, samples_per_rir: Union[np.ndarray, int], ref_channel: Optional[int] = 0, align: bool = True) -> np.ndarray:
     """Convolve wav by using a set of trajectory rirs (Note: the generated audio signal using this method has click noise)
 
@@ -0,0 +1,101 @@
+import json
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import soundfile as sf
+from numpy import ndarray
+from numpy.random import Generator
+
+# the direct-path window of the target RIR: [peak - DP_HALF, peak + DP_HALF)
+DP_HALF = 32
+
+
+def store_path(rir_csv: str) -> str:
+    """the prefix of the packed store of a RIR csv, e.g. train.csv -> train.rirs"""
+    return os.path.splitext(rir_csv)[0] + '.rirs'
+
+
+def pack_rirs(rir_csv: str, save_to: Optional[str] = None) -> str:
+    """pack the RIRs listed in `rir_csv` (columns filename and t60) into one memory-mappable store
+
+    Every channel of every RIR file is written to a flat float32 array `<save_to>.data.npy`, and `<save_to>.index.npy` records per
+    channel: the file, the channel, the offset and length in the flat array, the peak index, the direct-path window, and the T60.
+    The files are sorted by filename (the order of `CleanMelDataset.rirs`).
+
+    Returns:
+        the prefix `save_to` of the store
+    """
+    save_to = save_to or store_path(rir_csv)
+    csv = pd.read_csv(rir_csv)
+    t60s = {x.split("/")[-1]: y for x, y in zip(csv["filename"], csv["t60"])}
+    filenames = sorted(csv["filename"].tolist())
+
+    # the number of samples of every channel, to write the flat array in place
+    infos = [sf.info(filename) for filename in filenames]
+    data = np.lib.format.open_memmap(f"{save_to}.data.npy", mode='w+', dtype=np.float32, shape=(sum(i.frames * i.channels for i in infos),))
+    entries, offset = [], 0
+    for fid, filename in enumerate(filenames):
+        rir, fs = sf.read(filename, always_2d=True)
+        assert fs == 16000, f"Wrong rir sampling rate! {fs}"
+        for ch in range(rir.shape[1]):
+            peak = int(np.argmax(np.abs(rir[:, ch])))
+            data[offset:offset + rir.shape[0]] = rir[:, ch]
+            entries.append((fid, ch, offset, rir.shape[0], peak, max(0, peak - DP_HALF), peak + DP_HALF, t60s[filename.split("/")[-1]]))
+            offset += rir.shape[0]
+    data.flush()
+    del data
+    dtype = [('file', np.int32), ('channel', np.int16), ('offset', np.int64), ('length', np.int64), ('peak', np.int64), ('dp_start', np.int64), ('dp_end', np.int64),
+             ('t60', np.float64)]
+    np.save(f"{save_to}.index.npy", np.array(entries, dtype=dtype))
+    json.dump({'rir_csv': rir_csv, 'filenames': filenames}, open(f"{save_to}.json", 'w'), indent=4)
+    return save_to
+
+
+class RIRStore:
+    """The RIRs packed by `pack_rirs`, memory-mapped (read-only, shared by the workers); the RIRs are slices of the flat array,
+    no file is opened per item."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.data = np.load(f"{path}.data.npy", mmap_mode='r')
+        self.index = np.load(f"{path}.index.npy")
+        self.filenames: List[str] = json.load(open(f"{path}.json", 'r'))['filenames']
+        # the entries of file i are index[file_entries[i]:file_entries[i + 1]]
+        self.file_entries = np.searchsorted(self.index['file'], np.arange(len(self.filenames) + 1))
+
+    @classmethod
+    def for_csv(cls, rir_csv: str) -> Optional['RIRStore']:
+        """the packed store of `rir_csv` if it exists and is up to date, else None"""
+        path = store_path(rir_csv)
+        if not os.path.exists(f"{path}.json") or os.path.getmtime(f"{path}.json") < os.path.getmtime(rir_csv):
+            return None
+        return cls(path)
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    def get(self, file: int, rng: Generator) -> Tuple[ndarray, ndarray, float, int]:
+        """the RIR of file `file` starting at its direct path [1, T], the direct-path RIR [1, dp], the T60, and the entry (the
+        file and channel) id; the channel of a multi-channel file is drawn from rng"""
+        st, ed = self.file_entries[file], self.file_entries[file + 1]
+        i = st if ed - st == 1 else st + rng.integers(low=0, high=ed - st)
+        e = self.index[i]
+        rir = self.data[e['offset']:e['offset'] + e['length']]
+        return rir[np.newaxis, e['dp_start']:], rir[np.newaxis, e['dp_start']:e['dp_end']], float(e['t60']), int(i)
+
+
+if __name__ == '__main__':
+    """To pack the RIRs of the train/val/test csvs in rir_dir:
+        python -m data_loader.utils.rir_store --rir_dir YOUR_RIR_DIR/"""
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rir_dir', type=str, required=True, help='a dir contains [train.csv, val.csv, test.csv]')
+    args = parser.parse_args()
+    for split in ['train', 'val', 'test']:
+        rir_csv = os.path.join(args.rir_dir, f"{split}.csv")
+        if os.path.exists(rir_csv):
+            store = RIRStore(pack_rirs(rir_csv))
+            print(f"{rir_csv}: {len(store)} files, {len(store.index)} channels, {store.data.nbytes / 1e6:.1f} MB -> {store.path}.*")
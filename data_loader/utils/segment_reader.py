@@ -0,0 +1,19 @@
+from typing import Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+from numpy import ndarray
+
+
+def read_segment(path: str, start: int = 0, frames: int = -1, channel: Optional[int] = None, dtype: str = 'float32') -> Tuple[ndarray, int]:
+    """decode only the frames [start, start + frames) of an audio file (all the frames to the end if frames = -1), by seeking to
+    `start`, instead of the whole file
+
+    Args:
+        channel: the channel to keep, i.e. a [frames] wav is returned; else the wav of `sf.read` (1-D for mono files)
+
+    Returns:
+        the wav and the sample rate
+    """
+    wav, sr = sf.read(path, start=start, frames=frames, dtype=dtype, always_2d=channel is not None)
+    return (wav if channel is None else wav[:, channel]), sr
@@ -13,12 +13,15 @@ import matplotlib.pyplot as plt
 import torch.nn.functional as F
 import model.utils.general_steps as GS
 
-from tqdm import tqdm
 from typing import *
 from torch import Tensor
 from glob import glob
 from pytorch_lightning.cli import LightningArgumentParser
 from pytorch_lightning.callbacks import ModelCheckpoint
+from model.arch.chunk import chunked_forward
+from model.utils.async_writer import AsyncWriter
+from model.utils.ckpt_store import load_checkpoint
+from model.utils.metric_executor import CpuMetricExecutor
 from model.utils.metrics import cal_metrics_functional
 from model.utils.my_save_config_callback import MySaveConfigCallback as SaveConfigCallback
 import warnings
@@ -51,7 +54,10 @@ class TrainModule(pl.LightningModule):
         output_path: Optional[str] = None, # use only for inference
         arch_ckpt: Optional[str] = None,
         vocos_ckpt: Optional[str] = None,
-        vocos_config: Optional[str] = None
+        vocos_config: Optional[str] = None,
+        arch_onnx: Optional[str] = None, # use only for inference, an onnxruntime CleanMel exported by model.arch.export
+        compile_model: bool = False, # use only for inference, torch.compile the arch with the frame count bucketed, see model.arch.compile
+        num_writers: int = 2, # use only for inference, the threads writing the predictions (synchronous writes if 0), see model.utils.async_writer
     ):
         super().__init__()
 
@@ -65,24 +71,12 @@ class TrainModule(pl.LightningModule):
         self.online = arch.online
         self.name = self.exp_name
 
-        # Load pretrained model
+        # Load pretrained model, a local path or `HF!<filename>` of the HuggingFace Hub, memory-mapped from the local checkpoint store
         # CleanMel
         if arch_ckpt is not None:
-            if "HF" in vocos_ckpt:
-                # Load pretrained model by HuggingFace Hub
-                from huggingface_hub import hf_hub_download
-                REPO_ID = "WestlakeAudioLab/CleanMel"
-                arch_id = arch_ckpt.split("!")[-1]
-                arch_ckpt = hf_hub_download(repo_id=REPO_ID, filename=arch_id)
-            self.arch.load_state_dict(torch.load(arch_ckpt, map_location='cpu'), strict=True)
+            self.arch.load_state_dict(load_checkpoint(arch_ckpt), strict=True, assign=True)
         # Vocos
         if vocos_config is not None:
-            if "HF" in vocos_ckpt:
-                # Load pretrained model by HuggingFace Hub
-                from huggingface_hub import hf_hub_download
-                REPO_ID = "WestlakeAudioLab/CleanMel"
-                vocos_id = vocos_ckpt.split("!")[-1]
-                vocos_ckpt = hf_hub_download(repo_id=REPO_ID, filename=vocos_id)
             if self.online:
                 from model.vocos.online.pretrained import Vocos
             else:
@@ -91,53 +85,95 @@ class TrainModule(pl.LightningModule):
             self.vocos = Vocos.from_pretrained(None, model_path=vocos_ckpt, model=self.vocos)
             self.vocos.requires_grad_(False)
     
+        # ONNX CleanMel, used in place of `arch` if given
+        self.onnx_arch = None
+        if arch_onnx is not None:
+            from model.arch.export import OnnxCleanMel
+            self.onnx_arch = OnnxCleanMel(arch_onnx)
+        # compiled CleanMel, used in place of `arch` out of training if compile_model
+        self.compiled_arch = None
+        if compile_model:
+            from model.arch.compile import CompiledCleanMel
+            self.compiled_arch = CompiledCleanMel(self.arch)
+
         self.val_cpu_metric_input = []
         self.val_wavs = []
         self.test_wavs = []
         self.sample_rate = self.target_stft.sample_rate  
+        # the noisy target mel is computed from the input STFT, if the STFTs are the same
+        self.share_stft = self.target_stft.shares_stft(self.input_stft)
         
     def on_train_start(self):
         """Called by PytorchLightning automatically at the start of training"""
         GS.on_train_start(self=self, exp_name=self.exp_name, model_name=self.name, num_chns=1, nfft=self.target_stft.n_fft, model_class_path=self.import_path)
          
+    def _arch(self) -> Callable:
+        """the CleanMel used by `forward`"""
+        if self.onnx_arch is not None:
+            return self.onnx_arch
+        if self.compiled_arch is not None and not self.training:
+            return self.compiled_arch
+        return self.arch
+
     def safe_log(self, x):           
         return torch.log(torch.clip(x, min=self.log_eps))  
     
-    def get_mrm_target(self, yr, x, X_norm=None):
-        Y_target = self.target_stft(yr, X_norm)
-        X_noisy = self.target_stft(x, X_norm)
+    def get_mrm_target(self, yr, x, X_norm=None, lengths=None, Y_target=None, X_noisy=None):
+        """the MRM target; the target mels `Y_target` of yr and `X_noisy` of x are computed if not given"""
+        Y_target = self.target_stft(yr, X_norm, lengths) if Y_target is None else Y_target
+        X_noisy = self.target_stft(x, X_norm, lengths) if X_noisy is None else X_noisy
         mrm = torch.sqrt(Y_target) / (torch.sqrt(X_noisy) + 1e-10)
         mrm = mrm.clamp(max=1)
         assert mrm.abs().max() <= 1, f"MRM max value: {mrm.abs().max()}"
         return mrm
 
-    def get_mrm_pred(self, Y_hat, x, X_norm=None):
-        X_noisy = self.target_stft(x, X_norm)
+    def get_mrm_pred(self, Y_hat, x, X_norm=None, lengths=None, X_noisy=None):
+        """apply the MRM to the noisy mel; the target mel `X_noisy` of x is computed if not given"""
+        X_noisy = self.target_stft(x, X_norm, lengths) if X_noisy is None else X_noisy
         Y_hat = Y_hat.squeeze()
         Y_hat = torch.square(Y_hat * (torch.sqrt(X_noisy) + 1e-10))
         return Y_hat
     
-    def forward(self, x: Tensor, y: Tensor, inference=False):
+    def forward(self, x: Tensor, y: Tensor, inference=False, lengths: Optional[Tensor] = None):
         # STFT for noisy and clean waveform + normalization
-        X, X_norm = self.input_stft(x)
-        Y = self.target_stft(y, X_norm)
-        # Target Mel-spectrogram
-        Y = self.safe_log(Y)
-        # Model Forward
-        MRM_hat = self.arch(X, inference=inference)
+        X, X_norm = self.input_stft(x, lengths)
+        # Target Mel-spectrograms of the clean and noisy waveforms, computed once and shared by the MRM target and prediction
+        Y_target = self.target_stft(y, X_norm, lengths)
+        X_noisy = self.target_stft.from_input_stft(X, X_norm) if self.share_stft else self.target_stft(x, X_norm, lengths)
+        # Model Forward, the padded frames of a zero-padded batch are masked
+        mask = None if lengths is None else self.input_stft.frame_mask(lengths, X.shape[2])
+        return self._forward_mels(X, X_norm, Y_target, X_noisy, inference=inference, mask=mask)
+
+    def forward_features(self, X: Tensor, X_norm: Tensor, Y: Tensor, inference=False):
+        """`forward` on the pre-computed features of `data_loader.feature_shards`: the input STFT X, X_norm and the target log-mel Y"""
+        assert self.share_stft, "the noisy mel is computed from the input STFT, which needs the same STFT configs for input_stft and target_stft"
+        X, Y_target = X.float(), torch.exp(Y.float())
+        X_noisy = self.target_stft.from_input_stft(X, X_norm)
+        return self._forward_mels(X, X_norm, Y_target, X_noisy, inference=inference)
+
+    def _forward_mels(self, X: Tensor, X_norm: Tensor, Y_target: Tensor, X_noisy: Tensor, inference=False, mask: Optional[Tensor] = None):
+        """the MRM forward given the input STFT X, and the target mels of the clean (Y_target) and noisy (X_noisy) waveforms"""
+        MRM_hat = self._arch()(X, inference=inference, mask=mask)
         # Apply sigmoid for masking
         MRM_hat = torch.sigmoid(MRM_hat)
         # Obtain MRM prediction/target
-        MRM_target = self.get_mrm_target(y, x, X_norm)
-        Y_hat = self.get_mrm_pred(MRM_hat, x, X_norm)
-        Y = self.get_mrm_pred(MRM_target, x, X_norm)    # ideal logMel target
+        MRM_target = self.get_mrm_target(None, None, Y_target=Y_target, X_noisy=X_noisy)
+        Y_hat = self.get_mrm_pred(MRM_hat, None, X_noisy=X_noisy)
+        Y = self.get_mrm_pred(MRM_target, None, X_noisy=X_noisy)    # ideal logMel target
         return MRM_hat, MRM_target, self.safe_log(Y_hat), self.safe_log(Y), X_norm
 
+    def _forward_batch(self, batch):
+        """`forward` on a batch of waveforms (x, ys, paras), or `forward_features` on a batch of features (X, X_norm, Y, paras)"""
+        if len(batch) == 4:
+            X, X_norm, ys, paras = batch
+            return self.forward_features(X, X_norm, ys), ys
+        x, ys, paras = batch  # x: [B,T], ys: [B,T]
+        return self.forward(x, ys), ys
+
     def training_step(self, batch, batch_idx):
         """training step on self.device, called automaticly by PytorchLightning"""
-        x, ys, paras = batch  # x: [B,T], ys: [B,T]
         # Model forward
-        MRM_hat, MRM_target, Y_hat, Y, _ = self.forward(x, ys)
+        (MRM_hat, MRM_target, Y_hat, Y, _), ys = self._forward_batch(batch)
         mrm_loss = F.mse_loss(MRM_hat, MRM_target)
         logmel_mse = F.mse_loss(Y_hat, Y)
         logmel_l1 = F.l1_loss(Y_hat, Y)
@@ -148,9 +184,8 @@ class TrainModule(pl.LightningModule):
 
     def validation_step(self, batch, batch_idx):
         """validation step on self.device, called automaticly by PytorchLightning"""
-        x, ys, paras = batch
         # forward & loss
-        MRM_hat, MRM_target, Y_hat, Y, _ = self.forward(x, ys)
+        (MRM_hat, MRM_target, Y_hat, Y, _), ys = self._forward_batch(batch)
         mrm_loss = F.mse_loss(MRM_hat, MRM_target)
         logmel_mse = F.mse_loss(Y_hat, Y)
         logmel_l1 = F.l1_loss(Y_hat, Y)
@@ -166,31 +201,35 @@ class TrainModule(pl.LightningModule):
     def on_test_epoch_start(self):
         self.exp_save_path = self.trainer.logger.log_dir
         os.makedirs(self.exp_save_path, exist_ok=True)
-        self.results, self.cpu_metric_input = [], []
+        # the cpu metrics are computed in a process pool during the test steps
+        num_workers = torch.multiprocessing.cpu_count() // (self.trainer.world_size * 2)
+        self.results, self.cpu_metric_input = [], CpuMetricExecutor(num_workers=num_workers)
 
     def on_test_epoch_end(self):
         GS.on_test_epoch_end(self=self, results=self.results, cpu_metric_input=self.cpu_metric_input, exp_save_path=self.exp_save_path)
 
-    def chunk_forward(self, x: Tensor, y: Tensor, chunk_len=20, overlap=5):
-        chunk_len = chunk_len * self.sample_rate
-        overlap = overlap * self.sample_rate
-        chunk_Y, chunk_Y_hat = [], []
-        start_pos = None
-        for st in tqdm(range(0, x.shape[-1], chunk_len - overlap)):
-            ed = min(st + chunk_len, x.shape[-1])
-            x_chunk = x[..., st:ed]
-            y_chunk = y[..., st:ed]
-            _, _, Y_hat, Y_target, _ = self.forward(x_chunk, y_chunk)
-            if start_pos is None:
-                start_pos = int(overlap / self.stft.hop_length) + 1
-                chunk_Y_hat.append(Y_hat)
-                chunk_Y.append(Y_target)
-            else:
-                chunk_Y_hat.append(Y_hat[..., start_pos:])
-                chunk_Y.append(Y_target[..., start_pos:])
-        chunk_Y_hat = torch.cat(chunk_Y_hat, dim=-1)
-        chunk_Y = torch.cat(chunk_Y, dim=-1)
-        return chunk_Y_hat, chunk_Y
+    def chunk_forward(self, x: Tensor, y: Tensor, chunk_len=20, overlap=5, max_batch_len: Union[float, str, None] = 'auto'):
+        """long-form offline inference: CleanMel runs on overlapping windows (`chunk_len` seconds, `overlap` seconds) of the STFT of the
+        whole utterance, in batches of at most `max_batch_len` seconds (all the windows at once if None), and the log-mels of the windows
+        are cross-faded (see `model.arch.chunk`). X_norm is the one of the whole utterance, as for `forward`. 'auto': one window per
+        call on CPU, where the batched windows were measured slower (`python -m model.arch.chunk`), 80 seconds on other devices.
+
+        Returns:
+            Y_hat, Y, X_norm
+        """
+        frames = lambda seconds: int(seconds * self.sample_rate / self.input_stft.stft.hop_length)
+        chunk_frames, overlap_frames = frames(chunk_len), frames(overlap)
+        if max_batch_len == 'auto':
+            max_batch_len = chunk_len if x.device.type == 'cpu' else 80
+        max_batch_frames = None if max_batch_len is None else frames(max_batch_len)
+        X, X_norm = self.input_stft(x)
+        Y_target = self.target_stft(y, X_norm)
+        X_noisy = self.target_stft.from_input_stft(X, X_norm) if self.share_stft else self.target_stft(x, X_norm)
+        fn = lambda X_chunk, mask, X_noisy_chunk: self.safe_log(self.get_mrm_pred(torch.sigmoid(self._arch()(X_chunk, mask=mask)), None, X_noisy=X_noisy_chunk))
+        Y_hat = chunked_forward(fn, X, chunk_frames, overlap_frames, max_batch_frames, aux=[X_noisy])
+        MRM_target = self.get_mrm_target(None, None, Y_target=Y_target, X_noisy=X_noisy)
+        Y = self.safe_log(self.get_mrm_pred(MRM_target, None, X_noisy=X_noisy))    # ideal logMel target
+        return Y_hat, Y, X_norm
 
     def test_step(self, batch, batch_idx):
         x, ys, paras = batch
@@ -227,8 +266,7 @@ class TrainModule(pl.LightningModule):
         result_dict.update(input_metrics)
         result_dict.update(imp_metrics)
         result_dict.update(metrics)
-        self.cpu_metric_input.append((
-            self.metrics, y_hat[0].detach().cpu(), ys[0].detach().cpu(), x[0].detach().cpu(), sample_rate, 'cpu'))
+        self.cpu_metric_input.submit(result_dict['id'], self.metrics, y_hat[0], ys[0], x[0], sample_rate, 'cpu')
         # write examples
         if self.write_examples < 0 or paras[0]['index'] < self.write_examples:
             GS.test_setp_write_example(
@@ -267,24 +305,41 @@ class TrainModule(pl.LightningModule):
         self.exp_save_path = self.trainer.logger.log_dir
         os.makedirs(self.exp_save_path + "/logmel/", exist_ok=True)
         os.makedirs(self.exp_save_path + "/wav/", exist_ok=True)
+        # the predictions are written in the background, overlapped with the next batches
+        self.writer = AsyncWriter(num_workers=self.num_writers)
+
+    def on_predict_epoch_end(self):
+        self.writer.close()
+        s = self.writer.stats()
+        self.print(f"predictions: {s['files']} files, {s['MB']:.1f} MB written at {s['write_MB/s']:.1f} MB/s in {s['wall_s']:.1f}s")
 
     def predict_step(self, batch, batch_idx):
-        x, wavename = batch
+        # x: [B,T], zero-padded to the longest utterance when the lengths are given (see `pad_collate_func`)
+        x, wavename = batch[:2]
+        lengths = batch[2] if len(batch) > 2 else None
         # Enhanced Mel-spectrogram + waveform
         if (x.shape[1] / self.sample_rate) > 20 and not self.online:
-            Y_hat, Y, X_norm = self.chunk_forward(x, x)
-        else:
-            MRM_hat, MRM_target, Y_hat, Y, X_norm = self.forward(x, x)
-        y_hat = self.vocos(Y_hat, X_norm).clamp(min=-1, max=1)
-        # Save result
+            # long utterances: chunked inference, one utterance at a time
+            for i in range(len(x)):
+                xi = x[i:i + 1] if lengths is None else x[i:i + 1, :lengths[i]]
+                Y_hat, Y, X_norm = self.chunk_forward(xi, xi)
+                y_hat = self.vocos(Y_hat, X_norm).clamp(min=-1, max=1)
+                self._save_prediction(wavename[i], y_hat[0], Y_hat[0])
+            return
+        MRM_hat, MRM_target, Y_hat, Y, X_norm = self.forward(x, x, lengths=lengths)
+        mask = None if lengths is None else self.input_stft.frame_mask(lengths, Y_hat.shape[-1])
+        y_hat = self.vocos(Y_hat, X_norm, mask=mask).clamp(min=-1, max=1)
+        # Save result, the outputs of the padded frames are trimmed
+        hop_length = self.input_stft.stft.hop_length
         for i in range(len(x)):
-            sf.write(
-                f"{self.exp_save_path}/wav/{wavename[i].split('/')[-1]}", 
-                y_hat[i].detach().cpu().squeeze().numpy(), 
-                self.sample_rate)
-            np.save(
-                f"{self.exp_save_path}/logmel/{wavename[i].split('/')[-1].replace('.wav', '.npy')}", 
-                Y_hat[i].cpu().numpy())
+            num_pad = 0 if mask is None else Y_hat.shape[-1] - int(mask[i].sum())
+            self._save_prediction(wavename[i], y_hat[i, :y_hat.shape[-1] - num_pad * hop_length], Y_hat[i, ..., :Y_hat.shape[-1] - num_pad])
+
+    def _save_prediction(self, wavename: str, y_hat: Tensor, Y_hat: Tensor):
+        """save the enhanced waveform and log-mel of an utterance; the outputs are copied to CPU here and written by `self.writer`"""
+        wav, logmel = y_hat.detach().cpu().squeeze().numpy(), Y_hat.detach().cpu().numpy()
+        self.writer.submit(sf.write, f"{self.exp_save_path}/wav/{wavename.split('/')[-1]}", wav, self.sample_rate, num_bytes=wav.nbytes)
+        self.writer.submit(np.save, f"{self.exp_save_path}/logmel/{wavename.split('/')[-1].replace('.wav', '.npy')}", logmel, num_bytes=logmel.nbytes)
     
     def on_load_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
         GS.on_load_checkpoint(self=self, checkpoint=checkpoint, weightavg_opts=False, compile=self.compile_model)
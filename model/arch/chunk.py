@@ -0,0 +1,108 @@
+from typing import *
+
+import torch
+from torch import Tensor
+
+
+def chunk_windows(num_frames: int, chunk_frames: int, overlap_frames: int) -> Tuple[int, int]:
+    """the number of windows of `chunk_frames` frames (hop `chunk_frames - overlap_frames`) covering `num_frames` frames, and the padded frame count"""
+    assert 0 <= overlap_frames < chunk_frames, (overlap_frames, chunk_frames)
+    hop = chunk_frames - overlap_frames
+    num_windows = max(1, -(-(num_frames - overlap_frames) // hop))
+    return num_windows, (num_windows - 1) * hop + chunk_frames
+
+
+def crossfade_weights(chunk_frames: int, overlap_frames: int, device=None) -> Tensor:
+    """the [chunk_frames] weights of a window: linear fade-in/out over the overlapping frames, 1 elsewhere (never 0)"""
+    w = torch.ones(chunk_frames, device=device)
+    if overlap_frames > 0:
+        ramp = torch.arange(1, overlap_frames + 1, device=device) / (overlap_frames + 1)
+        w[:overlap_frames], w[-overlap_frames:] = ramp, ramp.flip(0)
+    return w
+
+
+def chunked_forward(
+    fn: Callable[..., Tensor],
+    X: Tensor,
+    chunk_frames: int,
+    overlap_frames: int,
+    max_batch_frames: Optional[int] = None,
+    aux: Sequence[Tensor] = (),
+) -> Tensor:
+    """Long-form inference: the frames of X are cut into overlapping windows, which are stacked into batches and fed to `fn`, and
+    the outputs of the windows are cross-faded (weighted overlap-add, normalized by the summed weights).
+
+    The windows are frame slices of the STFT of the whole utterance, so the normalization (X_norm) is the one of the whole utterance,
+    as for a single forward, and the stitched output can be vocoded with it. The last window is zero-padded and its padded frames are
+    masked.
+
+    Args:
+        fn: fn(X_chunks [N,F,W,2], mask [N,W], *aux_chunks) -> [N,M,W], e.g. CleanMel and the log-mel of its output
+        X: [B,F,T,2], the input STFT
+        chunk_frames: W, the frames per window
+        overlap_frames: the overlapping frames of adjacent windows
+        max_batch_frames: the memory budget, i.e. the max number of frames (windows x W) per call of fn; all windows at once if None
+        aux: other inputs of fn, [B,...,T], windowed along the last dim like X, e.g. the noisy mel of the MRM
+
+    Returns:
+        [B,M,T]
+    """
+    B, F, T, H = X.shape
+    W, hop = chunk_frames, chunk_frames - overlap_frames
+    N, Tp = chunk_windows(T, W, overlap_frames)
+    valid = torch.arange(Tp, device=X.device) < T
+    Xw = torch.nn.functional.pad(X, (0, 0, 0, Tp - T)).unfold(2, W, hop)  # [B,F,N,H,W]
+    Xw = Xw.permute(0, 2, 1, 4, 3).reshape(B * N, F, W, H)
+    mask = valid.unfold(0, W, hop)[None].expand(B, N, W).reshape(B * N, W)
+    aux = [torch.nn.functional.pad(a, (0, Tp - T)).unfold(-1, W, hop).movedim(-2, 1).reshape(B * N, *a.shape[1:-1], W) for a in aux]
+
+    n = B * N if max_batch_frames is None else max(1, max_batch_frames // W)
+    Y = torch.cat([fn(Xw[i:i + n], mask[i:i + n], *[a[i:i + n] for a in aux]) for i in range(0, B * N, n)])  # [B*N,M,W]
+    M = Y.shape[1]
+
+    # weighted overlap-add, the padded frames have zero weight
+    w = crossfade_weights(W, overlap_frames, device=X.device) * mask.to(Y.dtype)  # [B*N,W]
+    Y = (Y * w[:, None, :]).reshape(B, N, M * W).transpose(1, 2)
+    w = w.reshape(B, N, W).transpose(1, 2)
+    Y = torch.nn.functional.fold(Y, output_size=(1, Tp), kernel_size=(1, W), stride=(1, hop))[:, :, 0]  # [B,M,Tp]
+    w = torch.nn.functional.fold(w, output_size=(1, Tp), kernel_size=(1, W), stride=(1, hop))[:, :, 0]  # [B,1,Tp]
+    return (Y / w.clamp(min=1e-8))[..., :T]
+
+
+if __name__ == '__main__':
+    # compare the batched chunked inference with the sequential chunks and the full forward of CleanMel
+    # python -m model.arch.chunk --seconds 30 --chunk 10 --overlap 2
+    import argparse
+    import time
+
+    from model.arch.cleanmel import CleanMel
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_layers', type=int, default=2)
+    parser.add_argument('--dim_hidden', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--chunk', type=float, default=10)
+    parser.add_argument('--overlap', type=float, default=2)
+    parser.add_argument('--max_batch_seconds', type=float, default=None)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = CleanMel(dim_input=2, dim_output=1, n_layers=args.n_layers, dim_hidden=args.dim_hidden, n_freqs=257, online=False, mamba_backend='torch').eval()
+    frames = lambda s: int(s * 16000 / 128)
+    X = torch.randn(1, 257, frames(args.seconds) + 1, 2)
+    W, O = frames(args.chunk), frames(args.overlap)
+    with torch.no_grad():
+        fn = lambda Xc, mask: model(Xc, mask=mask).reshape(Xc.shape[0], -1, Xc.shape[2])
+        ts = time.perf_counter()
+        Y_full = fn(X, torch.ones(1, X.shape[2], dtype=torch.bool))
+        t_full = time.perf_counter() - ts
+        ts = time.perf_counter()
+        # the sequential chunks, one forward per window
+        Y_seq = chunked_forward(fn, X, W, O, max_batch_frames=W)
+        t_seq = time.perf_counter() - ts
+        ts = time.perf_counter()
+        Y = chunked_forward(fn, X, W, O, max_batch_frames=None if args.max_batch_seconds is None else frames(args.max_batch_seconds))
+        t_batched = time.perf_counter() - ts
+    print(f"{chunk_windows(X.shape[2], W, O)[0]} windows: max abs diff batched vs sequential={(Y - Y_seq).abs().max().item():.2e}, "
+          f"mean abs diff vs full forward={(Y - Y_full).abs().mean().item():.2e}")
+    print(f"full={t_full:.2f}s, sequential={t_seq:.2f}s, batched={t_batched:.2f}s")
@@ -1,18 +1,64 @@
 from typing import *
+from dataclasses import dataclass
 
 import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import pytorch_lightning
-import librosa
 
 from torch import Tensor
 from torch.nn import Parameter, init
 from torch.nn.common_types import _size_1_t
 
-from mamba_ssm import Mamba
-from mamba_ssm.utils.generation import InferenceParams
+from model.arch.mamba import Mamba as TorchMamba
+from model.arch.mamba import mamba_chunk_forward
+from model.io.mel import MelProjection, mel_filterbank
+
+try:
+    from mamba_ssm import Mamba as CudaMamba
+except ImportError:
+    # CPU-only environments: the pure-PyTorch Mamba is used
+    CudaMamba = None
+
+MAMBA_BACKENDS = ['auto', 'cuda', 'torch']
+# the peak memory of one Mamba call (incl. the LayerNorm before it) in units of its input size, measured for the torch backend
+MAMBA_ACTIVATION_FACTOR = 26
+
+
+def build_mamba(backend: str = 'auto', **kwargs) -> nn.Module:
+    """build a Mamba block with the given backend
+
+    Args:
+        backend: 'cuda' for the mamba_ssm CUDA kernels, 'torch' for the pure-PyTorch implementation (runs on any device),
+            'auto' for 'cuda' if mamba_ssm is installed and a GPU is available else 'torch'.
+            The parameters of both backends are identical, i.e. the checkpoints can be loaded by either of them.
+        kwargs: the init args of Mamba
+    """
+    assert backend in MAMBA_BACKENDS, backend
+    if backend == 'auto':
+        backend = 'cuda' if CudaMamba is not None and torch.cuda.is_available() else 'torch'
+    if backend == 'cuda':
+        assert CudaMamba is not None, "mamba_ssm is not installed, please use mamba_backend='torch'"
+        return CudaMamba(**kwargs)
+    return TorchMamba(**kwargs)
+
+
+def reverse_index(mask: Tensor) -> Tensor:
+    """the frame index [B, T] reversing each utterance of a padded batch within its own length, the padded frames at the end
+    (False in mask [B, T]) staying in place. The reversal is its own inverse."""
+    t = torch.arange(mask.shape[1], device=mask.device)[None, :]
+    lengths = mask.sum(dim=1, keepdim=True)
+    return torch.where(t < lengths, lengths - 1 - t, t)
+
+
+def reverse_frames(x: Tensor, index: Optional[Tensor] = None) -> Tensor:
+    """reverse x [B, F, T, H] in time: flip if index is None, else the per-utterance reversal of `reverse_index`"""
+    if index is None:
+        return x.flip(dims=[2])
+    batch = torch.arange(x.shape[0], device=x.device)[:, None]
+    return x.transpose(1, 2)[batch, index].transpose(1, 2)
+
 
 class LinearGroup(nn.Module):
 
@@ -97,6 +143,30 @@ class CausalConv1d(nn.Conv1d):
         x = super().forward(x)
         return x
 
+    def step(self, x: Tensor, state: Tensor) -> Tuple[Tensor, Tensor]:
+        """causal convolution on new frames given the history of the previous ones
+
+        Args:
+            x: [B,H,T]
+            state: [B,H,kernel_size-1], the last inputs (zeros at the beginning)
+
+        Returns:
+            output [B,H',T], and the new state
+        """
+        assert self.look_ahead == 0, "streaming with look ahead is not supported"
+        x = torch.concat([state, x], dim=-1)
+        state = x[..., x.shape[-1] - state.shape[-1]:]
+        return super().forward(x), state
+
+
+@dataclass
+class CleanMelState:
+    """The streaming state of an online CleanMel, see `CleanMel.init_state` and `CleanMel.step`"""
+    encoder: Tensor  # [B*F, H0, encoder_kernel_size-1], the input history of the encoder
+    mamba: List[Tuple[Tensor, Tensor]]  # (conv_state, ssm_state) of the Mamba block in each layer
+    num_frames: int = 0  # the number of processed frames
+
+
 class CleanMelLayer(nn.Module):
 
     def __init__(
@@ -112,9 +182,16 @@ class CleanMelLayer(nn.Module):
             mamba_state: int = None,
             mamba_conv_kernel: int = None,
             online: bool = False,
+            mamba_backend: str = 'auto',
+            inference_chunk_size: int = 64,
+            channels_last: bool = False,
+            mamba_memory_budget: float = None,
     ) -> None:
         super().__init__()
         self.online = online
+        self.inference_chunk_size = inference_chunk_size
+        self.channels_last = channels_last
+        self.mamba_memory_budget = mamba_memory_budget
         # cross-band block
         # frequency-convolutional module
         self.fconv1 = nn.ModuleList([
@@ -139,43 +216,123 @@ class CleanMelLayer(nn.Module):
         # narrow-band block
         self.norm_mamba = LayerNorm(seq_last=False, normalized_shape=dim_hidden)
         if online:
-            self.mamba = Mamba(d_model=dim_hidden, d_state=mamba_state, d_conv=mamba_conv_kernel, layer_idx=0)
+            self.mamba = build_mamba(mamba_backend, d_model=dim_hidden, d_state=mamba_state, d_conv=mamba_conv_kernel, layer_idx=0)
         else:
             self.mamba = nn.ModuleList([
-                Mamba(d_model=dim_hidden, d_state=mamba_state, d_conv=mamba_conv_kernel, layer_idx=0),
-                Mamba(d_model=dim_hidden, d_state=mamba_state, d_conv=mamba_conv_kernel, layer_idx=1),
+                build_mamba(mamba_backend, d_model=dim_hidden, d_state=mamba_state, d_conv=mamba_conv_kernel, layer_idx=0),
+                build_mamba(mamba_backend, d_model=dim_hidden, d_state=mamba_state, d_conv=mamba_conv_kernel, layer_idx=1),
             ])
         
         self.dropout_mamba = nn.Dropout(dropout[0])
 
-    def forward(self, x: Tensor, inference: bool = False) -> Tensor:
-        x = x + self._fconv(self.fconv1, x)
-        x = x + self._full(x)
-        x = x + self._fconv(self.fconv2, x)        
+    def forward(self, x: Tensor, inference: bool = False, mask: Optional[Tensor] = None) -> Tensor:
+        x = self._cross_band(x)
         if self.online:
             x = x + self._mamba(x, self.mamba, self.norm_mamba, self.dropout_mamba, inference)
         else:
+            # the padded frames are at the end, so the causal forward direction needs no mask, and the backward direction reverses
+            # each utterance within its own length, which keeps the padded frames at the end
+            index = None if mask is None else reverse_index(mask)
             x_fw = x + self._mamba(x, self.mamba[0], self.norm_mamba, self.dropout_mamba, inference)
-            x_bw = x.flip(dims=[2]) + self._mamba(x.flip(dims=[2]), self.mamba[1], self.norm_mamba, self.dropout_mamba, inference)
-            x = (x_fw + x_bw.flip(dims=[2])) / 2 
+            x_rev = reverse_frames(x, index)
+            x_bw = x_rev + self._mamba(x_rev, self.mamba[1], self.norm_mamba, self.dropout_mamba, inference)
+            x = (x_fw + reverse_frames(x_bw, index)) / 2 
         return x
 
-    def _mamba(self, x: Tensor, mamba: Mamba, norm: nn.Module, dropout: nn.Module, inference: bool = False):
+    def step(self, x: Tensor, state: Tuple[Tensor, Tensor]) -> Tensor:
+        """streaming forward of the online layer on new frames, the Mamba state is updated inplace
+
+        Args:
+            x: [B,F,T,H]
+            state: (conv_state, ssm_state) of the Mamba block
+        """
+        assert self.online, "streaming is only supported for online models"
+        x = self._cross_band(x)
+        B, F, T, H = x.shape
+        y = self.norm_mamba(x).reshape(B * F, T, H)
+        y = mamba_chunk_forward(self.mamba, y, *state)
+        x = x + self.dropout_mamba(y.reshape(B, F, T, H))
+        return x
+
+    def _mamba(self, x: Tensor, mamba: nn.Module, norm: nn.Module, dropout: nn.Module, inference: bool = False):
         B, F, T, H = x.shape
-        x = norm(x)
         x = x.reshape(B * F, T, H)
+        n = B * F if self.mamba_memory_budget is None else self._mamba_slice_size(B * F, T, H, x.element_size(), inference)
+        if n >= B * F:
+            y = self._mamba_seqs(norm(x), mamba, inference)
+        else:
+            # the sequences are independent: run them slice by slice so that only one slice of Mamba intermediates is alive
+            y = torch.empty_like(x)
+            for st in range(0, B * F, n):
+                y[st:st + n] = self._mamba_seqs(norm(x[st:st + n]), mamba, inference)
+        y = y.reshape(B, F, T, H)
+        return dropout(y)
+
+    def _mamba_seqs(self, x: Tensor, mamba: nn.Module, inference: bool) -> Tensor:
+        # x: [N,T,H]
         if inference:
-            inference_params = InferenceParams(T, B * F)
+            # recurrent inference: blocks of `inference_chunk_size` frames, the states are carried between blocks
+            conv_state, ssm_state = mamba.allocate_inference_cache(x.shape[0], x.shape[1])
             xs = []
-            for i in range(T):
-                inference_params.seqlen_offset = i
-                xi = mamba.forward(x[:, [i], :], inference_params)
+            for st in range(0, x.shape[1], self.inference_chunk_size):
+                xi = mamba_chunk_forward(mamba, x[:, st:st + self.inference_chunk_size, :], conv_state, ssm_state)
                 xs.append(xi)
-            x = torch.concat(xs, dim=1)
+            return torch.concat(xs, dim=1)
         else:
-            x = mamba.forward(x)
-        x = x.reshape(B, F, T, H)
-        return dropout(x)
+            return mamba.forward(x)
+
+    def _mamba_slice_size(self, N: int, T: int, H: int, element_size: int, inference: bool) -> int:
+        """the number of sequences per Mamba call that fits in `mamba_memory_budget`, at least 1"""
+        # the intermediates are proportional to the number of frames in one call; the outputs of the blocks are kept until concatenated
+        frames = T + min(T, self.inference_chunk_size) * MAMBA_ACTIVATION_FACTOR if inference else T * MAMBA_ACTIVATION_FACTOR
+        per_seq = frames * H * element_size
+        return max(1, int(self.mamba_memory_budget * 1e6 // per_seq))
+
+    def _cross_band(self, x: Tensor) -> Tensor:
+        if self.channels_last:
+            return self._cross_band_channels_last(x)
+        x = x + self._fconv(self.fconv1, x)
+        x = x + self._full(x)
+        x = x + self._fconv(self.fconv2, x)
+        return x
+
+    def _cross_band_channels_last(self, x: Tensor) -> Tensor:
+        """the cross-band block computed in one layout [B*T,F,H], numerically equivalent to the default path.
+
+        The input is converted once from [B,F,T,H], and the output is converted back once (and made contiguous for
+        the narrow-band block). Inside, the LayerNorms work on the last dim without transposes, the 1x1 convolutions
+        are linear layers on the last dim, and only the frequency convolutions and the full-band linear see a
+        (transposed) view of their input.
+        """
+        B, T = x.shape[0], x.shape[2]
+        x = x.transpose(1, 2).reshape(B * T, x.shape[1], x.shape[3])  # [B*T,F,H]
+        x = x + self._fconv_channels_last(self.fconv1, x)
+        x = x + self._full_channels_last(x, B, T)
+        x = x + self._fconv_channels_last(self.fconv2, x)
+        return x.reshape(B, T, x.shape[1], x.shape[2]).transpose(1, 2).contiguous()  # [B,F,T,H]
+
+    def _fconv_channels_last(self, ml: nn.ModuleList, x: Tensor) -> Tensor:
+        norm, conv, prelu = ml
+        x = F.layer_norm(x, norm.normalized_shape, norm.weight, norm.bias, norm.eps)
+        x = prelu(conv(x.transpose(1, 2)))  # [B*T,H,F]
+        return x.transpose(1, 2)
+
+    def _full_channels_last(self, x: Tensor, B: int, T: int) -> Tensor:
+        x = F.layer_norm(x, self.norm_full.normalized_shape, self.norm_full.weight, self.norm_full.bias, self.norm_full.eps)
+        x = self.squeeze[1](self._pointwise(self.squeeze[0], x))  # [B*T,F,H']
+        if self.dropout_full:
+            x = x.reshape(B, T, x.shape[1], x.shape[2]).permute(0, 2, 3, 1)  # [B,F,H',T]
+            x = self.dropout_full(x)  # dropout some frequencies in one utterance
+            x = x.permute(0, 3, 1, 2).reshape(B * T, x.shape[1], x.shape[2])
+        x = self.full(x.transpose(1, 2))  # [B*T,H',F]
+        x = self.unsqueeze[1](self._pointwise(self.unsqueeze[0], x.transpose(1, 2)))  # [B*T,F,H]
+        return x
+
+    def _pointwise(self, conv: nn.Module, x: Tensor) -> Tensor:
+        """a 1x1 convolution applied on the last dim of x"""
+        if isinstance(conv, nn.Conv1d):
+            return F.linear(x, conv.weight.squeeze(-1), conv.bias)
+        return conv.linear(x)  # model.arch.quantize.DynamicQuantConv1x1
 
     def _fconv(self, ml: nn.ModuleList, x: Tensor) -> Tensor:
         B, F, T, H = x.shape
@@ -230,10 +387,31 @@ class CleanMel(nn.Module):
         online: bool = True,
         sr: int = 16000,
         n_fft: int = 512,
+        mamba_backend: str = 'auto',
+        inference_chunk_size: int = 64,
+        channels_last: bool = False,
+        mamba_memory_budget: float = None,
     ):
+        """
+        Args:
+            mamba_backend: 'auto', 'cuda' or 'torch', see `build_mamba`
+            inference_chunk_size: the number of frames processed per Mamba call when `forward(inference=True)`.
+                1 runs frame by frame (the lowest latency, one call per frame); larger values give a higher throughput
+                as the per-call overhead is amortized over more frames, at the cost of K frames of delay before the first output.
+            channels_last: compute the cross-band blocks in one [B*T,F,H] layout, i.e. one layout conversion at each
+                narrow-band/cross-band boundary instead of the permutes/transposes around every sub-module.
+                Numerically equivalent; the time and peak memory saved can be measured by `python -m model.utils.benchmark layout`.
+            mamba_memory_budget: the memory (MB) allowed for the Mamba intermediates of one narrow-band block. If given, the B*F
+                sequences are split into slices that fit in the budget and run through Mamba one slice after another (the
+                sequences are independent, so the outputs are the same). None processes all sequences at once.
+                Only the peak memory of the forward pass without grad is bounded, as autograd keeps the intermediates of all slices.
+                Can be changed at runtime with `set_mamba_memory_budget`.
+        """
         super().__init__()
         self.layer_linear_freq = layer_linear_freq
         self.online = online
+        self.n_freqs = n_freqs
+        self.n_mels = n_mels
         # encoder
         self.encoder = CausalConv1d(in_channels=dim_input, out_channels=dim_hidden, kernel_size=encoder_kernel_size, look_ahead=0)
         # cleanmel layers
@@ -252,19 +430,38 @@ class CleanMel(nn.Module):
                 online=online,
                 mamba_conv_kernel=mamba_conv_kernel,
                 mamba_state=mamba_state,    
+                mamba_backend=mamba_backend,
+                inference_chunk_size=inference_chunk_size,
+                channels_last=channels_last,
+                mamba_memory_budget=mamba_memory_budget,
             )
             if hasattr(layer, 'full'):
                 full = layer.full
             layers.append(layer)
         self.layers = nn.ModuleList(layers)
         # Mel filterbank
-        linear2mel = librosa.filters.mel(**{"sr": sr, "n_fft": n_fft, "n_mels": n_mels})
+        linear2mel = mel_filterbank(**{"sr": sr, "n_fft": n_fft, "n_mels": n_mels})
         self.register_buffer("linear2mel", torch.nn.Parameter(torch.tensor(linear2mel.T, dtype=torch.float32)))
+        # the projection by linear2mel (passed at each call, as linear2mel is loaded from the checkpoints)
+        self.mel_projection = MelProjection(self.linear2mel)
         # decoder
         self.decoder = nn.Linear(in_features=dim_hidden, out_features=dim_output)
 
-    def forward(self, x: Tensor, inference: bool = False) -> Tensor:
-        # x: [Batch, Freq, Time, Feature]
+    def forward(self, x: Tensor, inference: bool = False, mask: Optional[Tensor] = None) -> Tensor:
+        """
+        Args:
+            x: [Batch, Freq, Time, Feature]
+            inference: the recurrent inference of the Mamba blocks, see `inference_chunk_size`
+            mask: [Batch, Time], False for the padded frames at the end of an utterance. The padded frames do not change the outputs
+                of the valid ones, i.e. the outputs equal the ones of the unpadded utterance (only needed for offline models,
+                as the online models are causal). The backward Mamba of the offline models reverses each utterance within its
+                own length, so the Mamba blocks run unmasked, i.e. with the fused kernels of the CUDA backend.
+
+        Returns:
+            [Batch, Mel, Time]
+        """
+        if mask is not None and (self.online or (not torch._dynamo.is_compiling() and bool(mask.all()))):
+            mask = None
         B, F, T, H0 = x.shape
         x = self.encoder(x.reshape(B * F, T, H0).permute(0, 2, 1)).permute(0, 2, 1)
         
@@ -273,18 +470,57 @@ class CleanMel(nn.Module):
         # First Cross-Narrow band block in Linear Frequency
         for i in range(self.layer_linear_freq):
             m = self.layers[i]
-            x = m(x, inference).contiguous()
+            x = m(x, inference, mask).contiguous()
         
         # Mel-filterbank
-        x = torch.einsum("bfth,fm->bmth", x, self.linear2mel)
+        x = self.mel_projection(x, dim=1, fb=self.linear2mel)
 
         for i in range(self.layer_linear_freq, len(self.layers)):
             m = self.layers[i]
-            x = m(x, inference).contiguous()
+            x = m(x, inference, mask).contiguous()
         
         y = self.decoder(x).squeeze(-1)
         return y.contiguous()
 
+    def set_mamba_memory_budget(self, mamba_memory_budget: float = None) -> None:
+        """set the memory budget (MB) of the narrow-band blocks, see `__init__`"""
+        for m in self.layers:
+            m.mamba_memory_budget = mamba_memory_budget
+
+    def init_state(self, batch: int, device: torch.device = None) -> CleanMelState:
+        """initial streaming state for `step`, i.e. the zero-paddings of `forward`"""
+        assert self.online, "streaming is only supported for online models"
+        device = self.linear2mel.device if device is None else device
+        encoder = torch.zeros(batch * self.n_freqs, self.encoder.in_channels, self.encoder.kernel_size[0] - 1, device=device)
+        mamba = []
+        for i, m in enumerate(self.layers):
+            n_freqs = self.n_freqs if i < self.layer_linear_freq else self.n_mels
+            conv_state, ssm_state = m.mamba.allocate_inference_cache(batch * n_freqs, 1)
+            mamba.append((conv_state.to(device), ssm_state.to(device)))
+        return CleanMelState(encoder=encoder, mamba=mamba)
+
+    def step(self, x: Tensor, state: CleanMelState) -> Tuple[Tensor, CleanMelState]:
+        """streaming forward of the online model, the cost of each call only depends on the number of new frames
+
+        Args:
+            x: [Batch, Freq, Time, Feature], the new frames (any number >= 1)
+            state: the state returned by `init_state` or the previous call
+
+        Returns:
+            the outputs for the new frames [Batch, Mel, Time] (same as `forward` on the whole sequence), and the updated state
+        """
+        B, F, T, H0 = x.shape
+        x, state.encoder = self.encoder.step(x.reshape(B * F, T, H0).permute(0, 2, 1), state.encoder)
+        x = x.permute(0, 2, 1)
+        x = x.reshape(B, F, T, x.shape[-1])
+        for i, m in enumerate(self.layers):
+            if i == self.layer_linear_freq:
+                x = self.mel_projection(x, dim=1, fb=self.linear2mel)
+            x = m.step(x, state.mamba[i])
+        y = self.decoder(x).squeeze(-1)
+        state.num_frames += T
+        return y, state
+
 if __name__ == '__main__':
     # a quick demo here for the CleanMel model
     # input: wavs
@@ -298,6 +534,8 @@ if __name__ == '__main__':
     from torch.utils.flop_counter import FlopCounterMode
     
     online=False
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    mamba_backend = "auto"  # "torch" for the pure-PyTorch Mamba
     # Define input STFT and target Mel
     stft = InputSTFT(
         n_fft=512, 
@@ -306,7 +544,7 @@ if __name__ == '__main__':
         center=True, 
         normalize=False, 
         onesided=True, 
-        online=online).to("cuda")
+        online=online).to(device)
     
     target_mel = TargetMel(
         sample_rate=16000,
@@ -323,7 +561,7 @@ if __name__ == '__main__':
         mel_norm="slaney",
         mel_scale="slaney",
         librosa_mel=True,
-        online=online).to("cuda")
+        online=online).to(device)
 
     def customize_soxnorm(wav, gain=-3, factor=None):
         wav = np.clip(wav, a_max=1, a_min=-1)
@@ -344,7 +582,7 @@ if __name__ == '__main__':
     noisy, fs = sf.read(wav)
     dur = len(noisy) / fs
     noisy, factor = customize_soxnorm(noisy, gain=-3)
-    noisy = torch.tensor(noisy).unsqueeze(0).float().to("cuda")
+    noisy = torch.tensor(noisy).unsqueeze(0).float().to(device)
     # vocos norm
     x = stft(noisy)
     # Load the model
@@ -363,11 +601,12 @@ if __name__ == '__main__':
         mamba_conv_kernel=4,
         online=online,
         sr=16000,
-        n_fft=512
-    ).to("cuda")
+        n_fft=512,
+        mamba_backend=mamba_backend,
+    ).to(device)
 
     # Load the pretrained model
-    state_dict = torch.load("./pretrained/CleanMel_S_L1.ckpt")
+    state_dict = torch.load("./pretrained/CleanMel_S_L1.ckpt", map_location=device)
     model.load_state_dict(state_dict)
     
     model.eval()
@@ -383,7 +622,11 @@ if __name__ == '__main__':
     
     # sanity check
     if wavname == "noisy_CHIME-real_F05_442C020S_STR_REAL":
-        assert np.allclose(y_hat, np.load("./src/inference/check_CHIME-real_F05_442C020S_STR_REAL.npy"), atol=1e-5)
+        # the pure-PyTorch scan accumulates in a different order than the CUDA kernel
+        atol = 1e-5 if isinstance(model.layers[0].mamba[0], CudaMamba or ()) else 1e-4
+        y_check = np.load("./src/inference_example/check_CHIME-real_F05_442C020S_STR_REAL.npy")
+        print(f"max abs error to the reference: {np.abs(y_hat - y_check).max():.2e}")
+        assert np.allclose(y_hat, y_check, atol=atol)
     
     # plot the enhanced mel spectrogram
     noisy_mel = target_mel(noisy)
@@ -398,4 +641,4 @@ if __name__ == '__main__':
     plt.imshow(y_hat, aspect='auto', origin='lower', cmap='jet', vmax=vmax, vmin=vmin)
     plt.colorbar()
     plt.tight_layout()
-    plt.savefig(f"./src/inference/{wavname}.png")
+    plt.savefig(f"./src/inference_example/{wavname}.png")
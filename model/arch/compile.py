@@ -0,0 +1,108 @@
+import time
+from typing import *
+
+import torch
+from torch import Tensor
+
+from model.arch.cleanmel import CleanMel
+
+# the padded frame counts (8 ms hop: about 2, 4, 8, 16 and 33 seconds)
+DEFAULT_BUCKETS = [256, 512, 1024, 2048, 4096]
+
+
+class CompiledCleanMel:
+    """torch.compile'd CleanMel inference with the frame count bucketed to a few padded lengths.
+
+    An input of T frames is padded at the end to the smallest bucket >= T (or to a multiple of the largest bucket), the padded
+    frames are given by the frame mask of `CleanMel.forward` (so the Mamba blocks run unmasked, see `CleanMelLayer.forward`), and
+    the outputs are cut back to T frames. So only one graph per bucket is compiled, whatever the utterance lengths. The compiled
+    graphs are cached per (bucket, inference), and the compile time (the first call) is recorded in `compile_times`. The selective
+    scans are not compiled (see `model.arch.mamba.selective_scan`).
+
+    All the graphs share the dynamo caches of the same code (`CleanMel.forward`, and the forward of each submodule class resumed
+    after the graph breaks around the selective scans), so the dynamo `cache_size_limit` is raised to fit them during the calls
+    only, and restored after.
+
+    It is not a Module: the parameters (and the state_dict) stay the ones of the wrapped model.
+    """
+
+    def __init__(self, model: CleanMel, buckets: List[int] = DEFAULT_BUCKETS, **compile_kwargs) -> None:
+        """
+        Args:
+            model: the CleanMel to compile
+            buckets: the padded frame counts
+            compile_kwargs: the kwargs of `torch.compile`, e.g. mode='max-autotune'
+        """
+        self.model = model
+        self.buckets = sorted(buckets)
+        self.compile_kwargs = {'dynamic': False, **compile_kwargs}
+        self.compiled: Dict[Tuple[int, bool], Callable] = dict()
+        self.compile_times: Dict[Tuple[int, bool], float] = dict()
+
+    def bucket(self, num_frames: int) -> int:
+        """the padded frame count of an input of `num_frames` frames"""
+        for b in self.buckets:
+            if num_frames <= b:
+                return b
+        return -(-num_frames // self.buckets[-1]) * self.buckets[-1]
+
+    def __call__(self, x: Tensor, inference: bool = False, mask: Optional[Tensor] = None) -> Tensor:
+        return self.forward(x, inference=inference, mask=mask)
+
+    def forward(self, x: Tensor, inference: bool = False, mask: Optional[Tensor] = None) -> Tensor:
+        """same as `CleanMel.forward`"""
+        B, F, T, H0 = x.shape
+        Tb = self.bucket(T)
+        x = torch.nn.functional.pad(x, (0, 0, 0, Tb - T))
+        if self.model.online:
+            valid = None  # the online model is causal: the padding at the end does not change the valid frames
+        else:
+            valid = torch.arange(Tb, device=x.device)[None, :] < T
+            if mask is not None:
+                valid = valid & torch.nn.functional.pad(mask, (0, Tb - T), value=False)
+
+        key = (Tb, inference)
+        compiling = key not in self.compiled
+        if compiling:
+            self.compiled[key] = torch.compile(self.model, **self.compile_kwargs)
+        # each graph adds at most one cache entry per submodule to the code of its forward
+        limit = max(torch._dynamo.config.cache_size_limit, len(self.compiled) * len(list(self.model.modules())))
+        with torch._dynamo.config.patch(cache_size_limit=limit):
+            ts = time.perf_counter()
+            y = self.compiled[key](x, inference, valid)
+        if compiling:
+            self.compile_times[key] = time.perf_counter() - ts
+        return y[..., :T]
+
+    def __repr__(self) -> str:
+        return f"CompiledCleanMel(buckets={self.buckets}, compiled={sorted(self.compiled.keys())})"
+
+
+if __name__ == '__main__':
+    # report the compile time of each bucket against the steady-state speedup on CPU
+    # python -m model.arch.compile --n_layers 8 --dim_hidden 96 --seconds 3 7 12
+    import argparse
+
+    from model.utils.benchmark import timeit
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_layers', type=int, default=8)
+    parser.add_argument('--dim_hidden', type=int, default=96)
+    parser.add_argument('--online', action='store_true')
+    parser.add_argument('--seconds', type=float, nargs='+', default=[3, 7, 12])
+    parser.add_argument('--buckets', type=int, nargs='+', default=DEFAULT_BUCKETS)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    model = CleanMel(dim_input=2, dim_output=1, n_layers=args.n_layers, dim_hidden=args.dim_hidden, n_freqs=257, online=args.online, mamba_backend='torch').eval()
+    compiled = CompiledCleanMel(model, buckets=args.buckets)
+    with torch.no_grad():
+        for seconds in args.seconds:
+            x = torch.randn(1, 257, int(seconds * 16000 / 128) + 1, 2)
+            y = model(x)
+            y_c = compiled(x)
+            Tb = compiled.bucket(x.shape[2])
+            t_eager = timeit(lambda: model(x), repeat=args.repeat)
+            t_compiled = timeit(lambda: compiled(x), repeat=args.repeat)
+            print(f"{seconds}s ({x.shape[2]} frames -> bucket {Tb}): max abs diff={(y - y_c).abs().max().item():.2e}, "
+                  f"compile={compiled.compile_times.get((Tb, False), 0):.1f}s, eager={t_eager:.3f}s, compiled={t_compiled:.3f}s, speedup={t_eager / t_compiled:.2f}x")
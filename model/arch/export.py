@@ -0,0 +1,255 @@
+import json
+from typing import *
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+from model.arch.cleanmel import CleanMel, CleanMelLayer
+from model.arch.mamba import mamba_chunk
+
+
+@torch.jit.script
+def _scan_loop(delta_u: Tensor, delta: Tensor, A: Tensor, B: Tensor, C: Tensor, h: Tensor) -> Tuple[Tensor, Tensor]:
+    # delta_u, delta: [L,B,D]; A: [D,N]; B, C: [L,B,N]; h: [B,D,N]
+    ys = []
+    for t in range(delta.shape[0]):
+        h = torch.exp(delta[t].unsqueeze(-1) * A) * h + delta_u[t].unsqueeze(-1) * B[t].unsqueeze(1)
+        ys.append(torch.matmul(h, C[t].unsqueeze(-1)).squeeze(-1))
+    return torch.stack(ys, dim=0), h
+
+
+def selective_scan_loop(
+    u: Tensor,
+    delta: Tensor,
+    A: Tensor,
+    B: Tensor,
+    C: Tensor,
+    D: Optional[Tensor] = None,
+    z: Optional[Tensor] = None,
+    delta_bias: Optional[Tensor] = None,
+    delta_softplus: bool = False,
+    return_last_state: bool = False,
+    initial_state: Optional[Tensor] = None,
+) -> Union[Tensor, Tuple[Tensor, Tensor]]:
+    """the selective scan as a scripted loop over time, which is exported to an ONNX Loop with a dynamic trip count.
+
+    Same arguments and results as `model.arch.mamba.selective_scan`.
+    """
+    dtype_in = u.dtype
+    u = u.float()
+    delta = delta.float()
+    if delta_bias is not None:
+        delta = delta + delta_bias[..., None].float()
+    if delta_softplus:
+        delta = F.softplus(delta)
+    h = torch.zeros(u.shape[0], u.shape[1], A.shape[1], dtype=torch.float32, device=u.device) if initial_state is None else initial_state.float()
+    y, h = _scan_loop((delta * u).permute(2, 0, 1), delta.permute(2, 0, 1), A.float(), B.float().permute(2, 0, 1), C.float().permute(2, 0, 1), h)
+    y = y.permute(1, 2, 0)  # [B,D,L]
+    out = y if D is None else y + u * D[:, None].float()
+    if z is not None:
+        out = out * F.silu(z.float())
+    out = out.to(dtype=dtype_in)
+    return out if not return_last_state else (out, h)
+
+
+def _narrow_band(layer: CleanMelLayer, mamba: nn.Module, x: Tensor, conv_state: Tensor, ssm_state: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+    # x: [B,F,T,H]
+    B, F, T, H = x.shape
+    y = layer.norm_mamba(x).reshape(B * F, T, H)
+    y, conv_state, ssm_state = mamba_chunk(mamba, y, conv_state, ssm_state, scan=selective_scan_loop)
+    return layer.dropout_mamba(y.reshape(B, F, T, H)), conv_state, ssm_state
+
+
+def _zero_states(mamba: nn.Module, batch: Tensor, like: Tensor) -> Tuple[Tensor, Tensor]:
+    conv_state = torch.zeros(batch, mamba.d_inner, mamba.d_conv, dtype=like.dtype, device=like.device)
+    ssm_state = torch.zeros(batch, mamba.d_inner, mamba.d_state, dtype=torch.float32, device=like.device)
+    return conv_state, ssm_state
+
+
+class CleanMelOfflineExport(nn.Module):
+    """the traceable `CleanMel.forward`, i.e. x [B,F,T,H0] -> y [B,M,T], for both offline and online models"""
+
+    def __init__(self, model: CleanMel) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: Tensor) -> Tensor:
+        model = self.model
+        B, F, T, H0 = x.shape
+        x = model.encoder(x.reshape(B * F, T, H0).permute(0, 2, 1)).permute(0, 2, 1)
+        x = x.reshape(B, F, T, x.shape[-1])
+        for i, m in enumerate(model.layers):
+            if i == model.layer_linear_freq:
+                x = model.mel_projection(x, dim=1, fb=model.linear2mel)
+            x = m._cross_band(x)
+            if m.online:
+                x = x + _narrow_band(m, m.mamba, x, *_zero_states(m.mamba, x.shape[0] * x.shape[1], x))[0]
+            else:
+                x_fw = x + _narrow_band(m, m.mamba[0], x, *_zero_states(m.mamba[0], x.shape[0] * x.shape[1], x))[0]
+                x_bw = x.flip(dims=[2]) + _narrow_band(m, m.mamba[1], x.flip(dims=[2]), *_zero_states(m.mamba[1], x.shape[0] * x.shape[1], x))[0]
+                x = (x_fw + x_bw.flip(dims=[2])) / 2
+        return model.decoder(x).squeeze(-1)
+
+
+class CleanMelOnlineExport(nn.Module):
+    """the traceable `CleanMel.step` with explicit states:
+    (x [B,F,T,H0], encoder_state, conv_state_0, ssm_state_0, conv_state_1, ...) -> (y [B,M,T], new encoder_state, new conv_state_0, ...)
+    """
+
+    def __init__(self, model: CleanMel) -> None:
+        super().__init__()
+        assert model.online, "only online models can be streamed"
+        self.model = model
+
+    def forward(self, x: Tensor, encoder_state: Tensor, *mamba_states: Tensor) -> Tuple[Tensor, ...]:
+        model = self.model
+        B, F, T, H0 = x.shape
+        x, encoder_state = model.encoder.step(x.reshape(B * F, T, H0).permute(0, 2, 1), encoder_state)
+        x = x.permute(0, 2, 1)
+        x = x.reshape(B, F, T, x.shape[-1])
+        states = [encoder_state]
+        for i, m in enumerate(model.layers):
+            if i == model.layer_linear_freq:
+                x = model.mel_projection(x, dim=1, fb=model.linear2mel)
+            x = m._cross_band(x)
+            y, conv_state, ssm_state = _narrow_band(m, m.mamba, x, mamba_states[2 * i], mamba_states[2 * i + 1])
+            x = x + y
+            states += [conv_state, ssm_state]
+        return (model.decoder(x).squeeze(-1), *states)
+
+
+def export_onnx(model: CleanMel, path: str, streaming: Optional[bool] = None, opset_version: int = 17, num_frames: int = 8) -> None:
+    """export a CleanMel to ONNX
+
+    The Mamba blocks are exported with the torch Mamba's parameters only (so models using mamba_ssm can be exported too), and the
+    selective scan is exported as an ONNX Loop over the frames, so that the number of frames is dynamic.
+
+    Args:
+        model: the model
+        path: the .onnx file
+        streaming: export `step` with the states as explicit inputs/outputs (online models only), or `forward`. Defaults to `model.online`.
+        opset_version: the ONNX opset
+        num_frames: the number of frames of the example input used for tracing
+    """
+    streaming = model.online if streaming is None else streaming
+    model = model.eval()
+    device = model.linear2mel.device
+    x = torch.randn(1, model.n_freqs, num_frames, model.encoder.in_channels, device=device)
+    meta = {'online': model.online, 'streaming': streaming, 'n_freqs': model.n_freqs, 'n_mels': model.n_mels}
+    if streaming:
+        state = model.init_state(1, device=device)
+        states = [state.encoder] + [s for ms in state.mamba for s in ms]
+        state_names = ['encoder_state'] + [f'{n}_{i}' for i in range(len(state.mamba)) for n in ['conv_state', 'ssm_state']]
+        new_state_names = ['new_' + n for n in state_names]
+        # the first dim of a state is batch*n_freqs (or batch*n_mels); the shapes are recorded for batch=1
+        meta['states'] = {n: list(s.shape) for n, s in zip(state_names, states)}
+        dynamic_axes = {'x': {0: 'batch', 2: 'frames'}, 'y': {0: 'batch', 2: 'frames'}}
+        dynamic_axes.update({n: {0: f'batch_{n}'} for n in state_names + new_state_names})
+        args = (x, *states)
+        module = CleanMelOnlineExport(model)
+        input_names, output_names = ['x'] + state_names, ['y'] + new_state_names
+    else:
+        dynamic_axes = {'x': {0: 'batch', 2: 'frames'}, 'y': {0: 'batch', 2: 'frames'}}
+        args = (x,)
+        module = CleanMelOfflineExport(model)
+        input_names, output_names = ['x'], ['y']
+
+    with torch.no_grad():
+        torch.onnx.export(module, args, path, input_names=input_names, output_names=output_names, dynamic_axes=dynamic_axes, opset_version=opset_version)
+
+    import onnx
+    onnx_model = onnx.load(path)
+    onnx.helper.set_model_props(onnx_model, {'cleanmel': json.dumps(meta)})
+    onnx.save(onnx_model, path)
+
+
+class OnnxCleanMel:
+    """an onnxruntime CleanMel exported by `export_onnx`, with the same `forward`/`init_state`/`step` interface as CleanMel.
+
+    The inputs can be on any device; the outputs are returned on the device of the input.
+    """
+
+    def __init__(self, path: str, num_threads: Optional[int] = None, providers: List[str] = ['CPUExecutionProvider']) -> None:
+        import onnxruntime as ort
+        opts = ort.SessionOptions()
+        if num_threads is not None:
+            opts.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, providers=providers, sess_options=opts)
+        meta = json.loads(self.session.get_modelmeta().custom_metadata_map['cleanmel'])
+        self.online, self.streaming = meta['online'], meta['streaming']
+        self.n_freqs, self.n_mels = meta['n_freqs'], meta['n_mels']
+        self.state_shapes = meta.get('states', {})
+
+    def __call__(self, x: Tensor, inference: bool = False, mask: Optional[Tensor] = None) -> Tensor:
+        return self.forward(x, inference=inference, mask=mask)
+
+    def forward(self, x: Tensor, inference: bool = False, mask: Optional[Tensor] = None) -> Tensor:
+        """same as `CleanMel.forward`, `inference` is ignored as the exported graph is already recurrent"""
+        if mask is not None and not self.online and not bool(mask.all()):
+            # the exported graph has no mask input: run the utterances of a padded batch one by one, unpadded
+            y = x.new_zeros(x.shape[0], self.n_mels, x.shape[2])
+            for i, num_frames in enumerate(mask.sum(dim=1).tolist()):
+                y[i:i + 1, :, :num_frames] = self.forward(x[i:i + 1, :, :num_frames], inference)
+            return y
+        if self.streaming:
+            y, _ = self.step(x, self.init_state(x.shape[0]))
+            return y
+        y, = self.session.run(['y'], {'x': x.detach().float().cpu().numpy()})
+        return torch.from_numpy(y).to(x.device)
+
+    def init_state(self, batch: int) -> Dict[str, np.ndarray]:
+        assert self.streaming, "the model is not exported for streaming"
+        return {n: np.zeros([shape[0] * batch] + shape[1:], dtype=np.float32) for n, shape in self.state_shapes.items()}
+
+    def step(self, x: Tensor, state: Dict[str, np.ndarray]) -> Tuple[Tensor, Dict[str, np.ndarray]]:
+        """same as `CleanMel.step`, but the state is a dict of numpy arrays (not updated inplace)"""
+        names = list(state.keys())
+        outputs = self.session.run(['y'] + ['new_' + n for n in names], {'x': x.detach().float().cpu().numpy(), **state})
+        return torch.from_numpy(outputs[0]).to(x.device), dict(zip(names, outputs[1:]))
+
+
+if __name__ == '__main__':
+    # export a CleanMel checkpoint, and compare the onnxruntime outputs with the PyTorch ones
+    # python -m model.arch.export --config ./configs/model/cleanmel_online.yaml --n_layers 16 --dim_hidden 96 --arch_ckpt ./pretrained/enhancement/online_CleanMel_S_map.ckpt --save_to ./pretrained/enhancement/online_CleanMel_S_map.onnx
+    import argparse
+    import time
+
+    import yaml
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', type=str, default='./configs/model/cleanmel_offline.yaml')
+    parser.add_argument('--n_layers', type=int, default=None)
+    parser.add_argument('--dim_hidden', type=int, default=None)
+    parser.add_argument('--arch_ckpt', type=str, default=None, help='random weights if not given')
+    parser.add_argument('--save_to', type=str, required=True)
+    parser.add_argument('--no_streaming', action='store_true', help='export `forward` for online models')
+    parser.add_argument('--seconds', type=float, default=4)
+    args = parser.parse_args()
+
+    init_args = yaml.safe_load(open(args.config, 'r'))['model']['arch']['init_args']
+    init_args.update({k: getattr(args, k) for k in ['n_layers', 'dim_hidden'] if getattr(args, k) is not None})
+    init_args['mamba_backend'] = 'torch'
+    model = CleanMel(**init_args).eval()
+    if args.arch_ckpt is not None:
+        model.load_state_dict(torch.load(args.arch_ckpt, map_location='cpu'), strict=True)
+    export_onnx(model, args.save_to, streaming=False if args.no_streaming else None)
+
+    runner = OnnxCleanMel(args.save_to)
+    x = torch.randn(1, model.n_freqs, int(args.seconds * 16000 / 128) + 1, model.encoder.in_channels)
+    with torch.no_grad():
+        ts = time.perf_counter()
+        y = model(x, inference=True)
+        t_torch = time.perf_counter() - ts
+    ts = time.perf_counter()
+    y_ort = runner(x)
+    t_ort = time.perf_counter() - ts
+    print(f"max abs diff={(y - y_ort).abs().max().item():.2e}, torch: {t_torch:.2f}s, onnxruntime: {t_ort:.2f}s")
+    if runner.streaming:
+        T = x.shape[2] // 2
+        state = runner.init_state(1)
+        y1, state = runner.step(x[:, :, :T], state)
+        y2, state = runner.step(x[:, :, T:], state)
+        print(f"streaming max abs diff={(y - torch.cat([y1, y2], dim=-1)).abs().max().item():.2e}")
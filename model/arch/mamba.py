@@ -0,0 +1,368 @@
+from typing import *
+from dataclasses import dataclass, field
+
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from torch import Tensor
+
+# A pure-PyTorch port of `mamba_ssm.Mamba` (mamba_ssm==1.2.0.post1, https://github.com/state-spaces/mamba).
+# The parameter names and shapes are kept identical to the CUDA implementation, so the
+# `offline_/online_CleanMel_*` checkpoints can be loaded into either implementation unchanged.
+
+
+@dataclass
+class InferenceParams:
+    """Same as `mamba_ssm.utils.generation.InferenceParams`, used when mamba_ssm is not installed."""
+
+    max_seqlen: int
+    max_batch_size: int
+    seqlen_offset: int = 0
+    batch_size_offset: int = 0
+    key_value_memory_dict: dict = field(default_factory=dict)
+    lengths_per_sample: Optional[Tensor] = None
+
+    def reset(self, max_seqlen, max_batch_size):
+        self.max_seqlen = max_seqlen
+        self.max_batch_size = max_batch_size
+        self.seqlen_offset = 0
+        if self.lengths_per_sample is not None:
+            self.lengths_per_sample.zero_()
+
+
+@torch.compiler.disable
+def selective_scan(
+    u: Tensor,
+    delta: Tensor,
+    A: Tensor,
+    B: Tensor,
+    C: Tensor,
+    D: Optional[Tensor] = None,
+    z: Optional[Tensor] = None,
+    delta_bias: Optional[Tensor] = None,
+    delta_softplus: bool = False,
+    return_last_state: bool = False,
+    initial_state: Optional[Tensor] = None,
+    chunk_size: int = 16,
+) -> Union[Tensor, Tuple[Tensor, Tensor]]:
+    """Chunked selective scan, numerically equivalent to `mamba_ssm.ops.selective_scan_interface.selective_scan_ref`.
+
+    The sequence is processed in chunks of `chunk_size` steps. For each chunk, the discretization
+    exp(delta * A), delta * B * u and the read-out with C are computed in parallel over all the steps,
+    and only the state update h_t = dA_t * h_{t-1} + dBu_t is run step by step (in-place, on contiguous
+    [Batch, Dim, DState] slices, or out-of-place when the gradient is required). The last state of a chunk is carried to the next one, so the memory is
+    bounded by [chunk_size, Batch, Dim, DState] whatever the sequence length. The step loop is left out of `torch.compile`.
+
+    Args:
+        u: [B, D, L]
+        delta: [B, D, L]
+        A: [D, N]
+        B: [B, N, L]
+        C: [B, N, L]
+        D: [D]
+        z: [B, D, L]
+        delta_bias: [D]
+        initial_state: [B, D, N], zeros if not given
+        chunk_size: the number of time steps processed together
+
+    Returns:
+        out: [B, D, L], and last_state: [B, D, N] if return_last_state
+    """
+    dtype_in = u.dtype
+    u = u.float()
+    delta = delta.float()
+    if delta_bias is not None:
+        delta = delta + delta_bias[..., None].float()
+    if delta_softplus:
+        delta = F.softplus(delta)
+    A = A.float()
+    batch, dim, L = u.shape
+
+    # time-major layouts so that the slices of each step are contiguous
+    delta_u = (delta * u).permute(2, 0, 1).contiguous()  # [L,B,D]
+    delta_t = delta.permute(2, 0, 1).contiguous()  # [L,B,D]
+    B = B.float().permute(2, 0, 1).contiguous()  # [L,B,N]
+    C = C.float().permute(2, 0, 1).unsqueeze(-1).contiguous()  # [L,B,N,1]
+
+    h = A.new_zeros((batch, dim, A.shape[1])) if initial_state is None else initial_state.float()
+    ys = []
+    for st in range(0, L, chunk_size):
+        ed = min(st + chunk_size, L)
+        dA = torch.exp(delta_t[st:ed, :, :, None] * A)  # [K,B,D,N]
+        states = delta_u[st:ed, :, :, None] * B[st:ed, :, None, :]  # [K,B,D,N]
+        if states.requires_grad:
+            # autograd does not allow to update the states inplace, as each step needs the previous one for backward
+            hs = []
+            for k in range(ed - st):
+                h = torch.addcmul(states[k], dA[k], h)
+                hs.append(h)
+            states = torch.stack(hs, dim=0)
+        else:
+            states[0].addcmul_(dA[0], h)
+            for k in range(1, ed - st):
+                states[k].addcmul_(dA[k], states[k - 1])
+            h = states[-1]
+        ys.append(torch.matmul(states, C[st:ed]).squeeze(-1))  # [K,B,D]
+    y = torch.cat(ys, dim=0).permute(1, 2, 0)  # [B,D,L]
+    out = y if D is None else y + u * D[:, None].float()
+    if z is not None:
+        out = out * F.silu(z.float())
+    out = out.to(dtype=dtype_in)
+    return out if not return_last_state else (out, h.clone())
+
+
+def mamba_chunk_forward(mamba: nn.Module, hidden_states: Tensor, conv_state: Tensor, ssm_state: Tensor, chunk_size: int = 16) -> Tensor:
+    """Run a Mamba block on a chunk of frames, starting from (and updating inplace) the cached states.
+
+    Only the parameters of the block are used, so it works for both `mamba_ssm.Mamba` and the Mamba here.
+    The result equals the one of the full-sequence forward for the same frames.
+
+    Args:
+        mamba: the Mamba block
+        hidden_states: [B, L, D]
+        conv_state: [B, D_inner, d_conv], the last d_conv inputs of the short convolution, see `allocate_inference_cache`
+        ssm_state: [B, D_inner, d_state]
+        chunk_size: the chunk size of the selective scan
+
+    Returns:
+        Tensor: [B, L, D]
+    """
+    # not a functools.partial, which dynamo (torch 2.2) fails to trace around the compile-disabled selective_scan
+    scan = lambda *args, **kwargs: selective_scan(*args, chunk_size=chunk_size, **kwargs)
+    out, new_conv_state, new_ssm_state = mamba_chunk(mamba, hidden_states, conv_state, ssm_state, scan=scan)
+    conv_state.copy_(new_conv_state)
+    ssm_state.copy_(new_ssm_state)
+    return out
+
+
+def mamba_chunk(mamba: nn.Module, hidden_states: Tensor, conv_state: Tensor, ssm_state: Tensor, scan: Callable = selective_scan) -> Tuple[Tensor, Tensor, Tensor]:
+    """The functional version of `mamba_chunk_forward`: the states are not modified, the new ones are returned.
+
+    Args:
+        scan: the selective scan, called like `selective_scan(..., delta_softplus=True, return_last_state=True, initial_state=ssm_state)`
+
+    Returns:
+        the output [B, L, D], the new conv_state and the new ssm_state
+    """
+    xz = mamba.in_proj(hidden_states).transpose(1, 2)  # [B,2D,L]
+    x, z = xz.chunk(2, dim=1)
+    # short convolution with the history kept in conv_state
+    x = torch.cat([conv_state.to(x.dtype), x], dim=-1)
+    conv_state = x[..., x.shape[-1] - mamba.d_conv:]
+    x = F.conv1d(x[..., 1:], mamba.conv1d.weight, mamba.conv1d.bias, groups=mamba.d_inner)
+    x = F.silu(x)
+
+    x_dbl = mamba.x_proj(x.transpose(1, 2))  # [B,L,dt_rank+2N]
+    dt, B, C = torch.split(x_dbl, [mamba.dt_rank, mamba.d_state, mamba.d_state], dim=-1)
+    dt = F.linear(dt, mamba.dt_proj.weight).transpose(1, 2)  # [B,D,L]
+    A = -torch.exp(mamba.A_log.float())  # [D,N]
+    y, ssm_state = scan(
+        x,
+        dt,
+        A,
+        B.transpose(1, 2),
+        C.transpose(1, 2),
+        mamba.D.float(),
+        z=z,
+        delta_bias=mamba.dt_proj.bias.float(),
+        delta_softplus=True,
+        return_last_state=True,
+        initial_state=ssm_state,
+    )
+    return mamba.out_proj(y.transpose(1, 2)), conv_state, ssm_state
+
+
+class Mamba(nn.Module):
+
+    def __init__(
+        self,
+        d_model: int,
+        d_state: int = 16,
+        d_conv: int = 4,
+        expand: int = 2,
+        dt_rank: Union[int, str] = "auto",
+        dt_min: float = 0.001,
+        dt_max: float = 0.1,
+        dt_init: str = "random",
+        dt_scale: float = 1.0,
+        dt_init_floor: float = 1e-4,
+        conv_bias: bool = True,
+        bias: bool = False,
+        layer_idx: int = None,
+        scan_chunk_size: int = 16,
+        device=None,
+        dtype=None,
+    ) -> None:
+        factory_kwargs = {"device": device, "dtype": dtype}
+        super().__init__()
+        self.d_model = d_model
+        self.d_state = d_state
+        self.d_conv = d_conv
+        self.expand = expand
+        self.d_inner = int(self.expand * self.d_model)
+        self.dt_rank = math.ceil(self.d_model / 16) if dt_rank == "auto" else dt_rank
+        self.layer_idx = layer_idx
+        self.scan_chunk_size = scan_chunk_size
+
+        self.in_proj = nn.Linear(self.d_model, self.d_inner * 2, bias=bias, **factory_kwargs)
+        self.conv1d = nn.Conv1d(
+            in_channels=self.d_inner,
+            out_channels=self.d_inner,
+            bias=conv_bias,
+            kernel_size=d_conv,
+            groups=self.d_inner,
+            padding=d_conv - 1,
+            **factory_kwargs,
+        )
+        self.act = nn.SiLU()
+        self.x_proj = nn.Linear(self.d_inner, self.dt_rank + self.d_state * 2, bias=False, **factory_kwargs)
+        self.dt_proj = nn.Linear(self.dt_rank, self.d_inner, bias=True, **factory_kwargs)
+
+        # Initialize special dt projection to preserve variance at initialization
+        dt_init_std = self.dt_rank**-0.5 * dt_scale
+        if dt_init == "constant":
+            nn.init.constant_(self.dt_proj.weight, dt_init_std)
+        elif dt_init == "random":
+            nn.init.uniform_(self.dt_proj.weight, -dt_init_std, dt_init_std)
+        else:
+            raise NotImplementedError
+        # Initialize dt bias so that F.softplus(dt_bias) is between dt_min and dt_max
+        dt = torch.exp(torch.rand(self.d_inner, **factory_kwargs) * (math.log(dt_max) - math.log(dt_min)) + math.log(dt_min)).clamp(min=dt_init_floor)
+        inv_dt = dt + torch.log(-torch.expm1(-dt))  # inverse of softplus
+        with torch.no_grad():
+            self.dt_proj.bias.copy_(inv_dt)
+        self.dt_proj.bias._no_reinit = True
+
+        # S4D real initialization
+        A = torch.arange(1, self.d_state + 1, dtype=torch.float32, device=device).repeat(self.d_inner, 1).contiguous()
+        self.A_log = nn.Parameter(torch.log(A))  # Keep A_log in fp32
+        self.A_log._no_weight_decay = True
+        # D "skip" parameter
+        self.D = nn.Parameter(torch.ones(self.d_inner, device=device))  # Keep in fp32
+        self.D._no_weight_decay = True
+
+        self.out_proj = nn.Linear(self.d_inner, self.d_model, bias=bias, **factory_kwargs)
+
+    def forward(self, hidden_states: Tensor, inference_params: InferenceParams = None) -> Tensor:
+        """
+        hidden_states: [B, L, D]
+        Returns: same shape as hidden_states
+        """
+        batch, seqlen, dim = hidden_states.shape
+
+        conv_state, ssm_state = None, None
+        if inference_params is not None:
+            conv_state, ssm_state = self._get_states_from_cache(inference_params, batch)
+            if inference_params.seqlen_offset > 0:
+                # The states are updated inplace
+                out, _, _ = self.step(hidden_states, conv_state, ssm_state)
+                return out
+
+        xz = self.in_proj(hidden_states).transpose(1, 2)  # [B,2D,L]
+        x, z = xz.chunk(2, dim=1)
+        # Compute short convolution
+        if conv_state is not None:
+            # F.pad pads with zeros if seqlen < self.d_conv, and truncates otherwise
+            conv_state.copy_(F.pad(x, (self.d_conv - x.shape[-1], 0)))
+        x = self.act(self.conv1d(x)[..., :seqlen])
+
+        x_dbl = self.x_proj(x.transpose(1, 2))  # [B,L,dt_rank+2N]
+        dt, B, C = torch.split(x_dbl, [self.dt_rank, self.d_state, self.d_state], dim=-1)
+        dt = F.linear(dt, self.dt_proj.weight).transpose(1, 2)  # [B,D,L], dt_bias is added in the scan
+        A = -torch.exp(self.A_log.float())  # [D,N]
+        y = selective_scan(
+            x,
+            dt,
+            A,
+            B.transpose(1, 2),
+            C.transpose(1, 2),
+            self.D.float(),
+            z=z,
+            delta_bias=self.dt_proj.bias.float(),
+            delta_softplus=True,
+            return_last_state=ssm_state is not None,
+            chunk_size=self.scan_chunk_size,
+        )
+        if ssm_state is not None:
+            y, last_state = y
+            ssm_state.copy_(last_state)
+        out = self.out_proj(y.transpose(1, 2))
+        return out
+
+    def step(self, hidden_states: Tensor, conv_state: Tensor, ssm_state: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        dtype = hidden_states.dtype
+        assert hidden_states.shape[1] == 1, "Only support decoding with 1 token at a time for now"
+        xz = self.in_proj(hidden_states.squeeze(1))  # [B,2D]
+        x, z = xz.chunk(2, dim=-1)  # [B,D]
+
+        # Conv step
+        conv_state.copy_(torch.roll(conv_state, shifts=-1, dims=-1))  # Update state [B,D,W]
+        conv_state[:, :, -1] = x
+        x = torch.sum(conv_state * self.conv1d.weight[:, 0, :], dim=-1)  # [B,D]
+        if self.conv1d.bias is not None:
+            x = x + self.conv1d.bias
+        x = self.act(x).to(dtype=dtype)
+
+        x_db = self.x_proj(x)  # [B,dt_rank+2N]
+        dt, B, C = torch.split(x_db, [self.dt_rank, self.d_state, self.d_state], dim=-1)
+        dt = F.linear(dt, self.dt_proj.weight)  # [B,D]
+        A = -torch.exp(self.A_log.float())  # [D,N]
+
+        # SSM step
+        dt = F.softplus(dt + self.dt_proj.bias.to(dtype=dt.dtype))
+        dA = torch.exp(torch.einsum("bd,dn->bdn", dt, A))
+        dB = torch.einsum("bd,bn->bdn", dt, B)
+        ssm_state.copy_(ssm_state * dA + x.unsqueeze(-1) * dB)
+        y = torch.einsum("bdn,bn->bd", ssm_state.to(dtype), C)
+        y = y + self.D.to(dtype) * x
+        y = y * self.act(z)  # [B,D]
+
+        out = self.out_proj(y)
+        return out.unsqueeze(1), conv_state, ssm_state
+
+    def allocate_inference_cache(self, batch_size: int, max_seqlen: int, dtype=None, **kwargs) -> Tuple[Tensor, Tensor]:
+        device = self.A_log.device
+        conv_dtype = self.conv1d.weight.dtype if dtype is None else dtype
+        conv_state = torch.zeros(batch_size, self.d_model * self.expand, self.d_conv, device=device, dtype=conv_dtype)
+        ssm_dtype = self.dt_proj.weight.dtype if dtype is None else dtype
+        ssm_state = torch.zeros(batch_size, self.d_model * self.expand, self.d_state, device=device, dtype=ssm_dtype)
+        return conv_state, ssm_state
+
+    def _get_states_from_cache(self, inference_params: InferenceParams, batch_size: int, initialize_states: bool = False) -> Tuple[Tensor, Tensor]:
+        assert self.layer_idx is not None
+        if self.layer_idx not in inference_params.key_value_memory_dict:
+            conv_state, ssm_state = self.allocate_inference_cache(batch_size, inference_params.max_seqlen)
+            inference_params.key_value_memory_dict[self.layer_idx] = (conv_state, ssm_state)
+        else:
+            conv_state, ssm_state = inference_params.key_value_memory_dict[self.layer_idx]
+            if initialize_states:
+                conv_state.zero_()
+                ssm_state.zero_()
+        return conv_state, ssm_state
+
+    def extra_repr(self) -> str:
+        return f"d_model={self.d_model}, d_state={self.d_state}, d_conv={self.d_conv}, expand={self.expand}, scan_chunk_size={self.scan_chunk_size}"
+
+
+if __name__ == '__main__':
+    # sanity check: chunked parallel scan vs. step-by-step recurrence; and the real-time factor on CPU
+    # python -m model.arch.mamba
+    import time
+    torch.manual_seed(0)
+    d_model, frames_per_sec = 96, 16000 / 128
+    mamba = Mamba(d_model=d_model, d_state=16, d_conv=4, layer_idx=0).eval()
+    x = torch.randn(257, 500, d_model)  # [B*F,T,H], 4s with 257 frequencies
+    with torch.no_grad():
+        ts = time.time()
+        y = mamba(x)
+        dur = time.time() - ts
+        inference_params = InferenceParams(x.shape[1], x.shape[0])
+        ys = []
+        for i in range(x.shape[1]):
+            inference_params.seqlen_offset = i
+            ys.append(mamba(x[:, [i], :], inference_params))
+        y_ref = torch.concat(ys, dim=1)
+    print(f"max abs diff={(y - y_ref).abs().max().item():.2e}")
+    print(f"RTF of one Mamba block on {torch.get_num_threads()} threads: {dur / (x.shape[1] / frames_per_sec):.4f}")
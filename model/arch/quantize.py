@@ -0,0 +1,239 @@
+from typing import *
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.ao.nn.quantized.dynamic as nnqd
+from torch import Tensor
+
+from model.arch.cleanmel import CausalConv1d, CleanMel, LinearGroup
+from model.arch.mamba import Mamba as TorchMamba
+
+# the modules that can be quantized by `quantize_cleanmel`
+QUANTIZABLE_MODULES = ['encoder', 'full', 'squeeze', 'mamba', 'decoder']
+# 'full' is not quantized by default: with one small int8 GEMM per group (e.g. 96 groups of 80x80 in the mel layers), it is slower than the float einsum
+DEFAULT_QUANTIZED_MODULES = ['encoder', 'squeeze', 'mamba', 'decoder']
+
+
+def _quantize_linear(weight: Tensor, bias: Optional[Tensor]) -> nnqd.Linear:
+    linear = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None)
+    linear.weight.data.copy_(weight)
+    if bias is not None:
+        linear.bias.data.copy_(bias)
+    linear.qconfig = torch.ao.quantization.default_dynamic_qconfig
+    return nnqd.Linear.from_float(linear)
+
+
+class DynamicQuantLinearGroup(nn.Module):
+    """int8 `LinearGroup`: one dynamically quantized linear per group"""
+
+    def __init__(self, m: LinearGroup) -> None:
+        super().__init__()
+        self.in_features = m.in_features
+        self.out_features = m.out_features
+        self.num_groups = m.num_groups
+        bias = [None] * m.num_groups if m.bias is None else m.bias.detach()
+        self.linears = nn.ModuleList([_quantize_linear(m.weight.detach()[g], bias[g]) for g in range(m.num_groups)])
+
+    def forward(self, x: Tensor) -> Tensor:
+        """shape [..., group, feature]"""
+        shape = x.shape
+        x = x.reshape(-1, self.num_groups, self.in_features).transpose(0, 1).contiguous()  # [G,N,H], each group contiguous
+        x = torch.stack([linear(x[g]) for g, linear in enumerate(self.linears)], dim=1)  # [N,G,K]
+        return x.reshape(*shape[:-1], self.out_features)
+
+    def extra_repr(self) -> str:
+        return f"{self.in_features}, {self.out_features}, num_groups={self.num_groups}"
+
+
+class DynamicQuantConv1x1(nn.Module):
+    """int8 1x1 `nn.Conv1d`, i.e. a dynamically quantized linear on the channel dim"""
+
+    def __init__(self, m: nn.Conv1d) -> None:
+        super().__init__()
+        assert m.kernel_size == (1,) and m.groups == 1, m
+        self.linear = _quantize_linear(m.weight.detach().squeeze(-1), None if m.bias is None else m.bias.detach())
+
+    def forward(self, x: Tensor) -> Tensor:
+        # x [B,H,T]
+        return self.linear(x.transpose(-1, -2)).transpose(-1, -2)
+
+
+class DynamicQuantCausalConv1d(nn.Module):
+    """int8 `CausalConv1d`: the input is unfolded to [B,T,H*kernel_size] and fed to a dynamically quantized linear"""
+
+    def __init__(self, m: CausalConv1d) -> None:
+        super().__init__()
+        assert m.stride == (1,) and m.dilation == (1,) and m.groups == 1 and m.padding == (0,), m
+        self.in_channels = m.in_channels
+        self.out_channels = m.out_channels
+        self.kernel_size = m.kernel_size
+        self.look_ahead = m.look_ahead
+        self.linear = _quantize_linear(m.weight.detach().reshape(m.out_channels, -1), None if m.bias is None else m.bias.detach())
+
+    def _conv(self, x: Tensor) -> Tensor:
+        # x [B,H,T+kernel_size-1]
+        x = x.unfold(-1, self.kernel_size[0], 1).transpose(1, 2)  # [B,T,H,kernel_size]
+        x = self.linear(x.reshape(x.shape[0], x.shape[1], -1))  # [B,T,H']
+        return x.transpose(1, 2)
+
+    def forward(self, x: Tensor, state: Dict[int, Any] = None) -> Tensor:
+        if state is None or id(self) not in state:
+            x = F.pad(x, pad=(self.kernel_size[0] - 1 - self.look_ahead, self.look_ahead))
+        else:
+            x = torch.concat([state[id(self)], x], dim=-1)
+        if state is not None:
+            state[id(self)] = x[..., -self.kernel_size[0] + 1:]
+        return self._conv(x)
+
+    def step(self, x: Tensor, state: Tensor) -> Tuple[Tensor, Tensor]:
+        """see `CausalConv1d.step`"""
+        assert self.look_ahead == 0, "streaming with look ahead is not supported"
+        x = torch.concat([state, x], dim=-1)
+        state = x[..., x.shape[-1] - state.shape[-1]:]
+        return self._conv(x), state
+
+    def extra_repr(self) -> str:
+        return f"{self.in_channels}, {self.out_channels}, kernel_size={self.kernel_size}, look_ahead={self.look_ahead}"
+
+
+def quantize_cleanmel(model: CleanMel, modules: List[str] = DEFAULT_QUANTIZED_MODULES, inplace: bool = False) -> CleanMel:
+    """dynamic int8 quantization of a CleanMel for CPU inference
+
+    The weights of the selected modules are quantized to int8 (per tensor), and their inputs are quantized on the fly.
+    The norms, the frequency convolutions, the selective scans and the mel projection stay in float. As the selective scans
+    take most of the CPU time, the speedup is bounded; check it (and the accuracy) with `python -m model.arch.quantize`.
+    The activation scales are computed per call, so `step` on chunks is close to, but not the same as, `forward` on the whole input.
+
+    Args:
+        model: a float CleanMel using the torch Mamba backend
+        modules: the modules to quantize, a subset of QUANTIZABLE_MODULES:
+            'encoder': the input CausalConv1d; 'full': the (shared) full-band LinearGroups; 'squeeze': the 1x1 squeeze/unsqueeze
+            convolutions; 'mamba': the in/out projections of the Mamba blocks; 'decoder': the output linear
+        inplace: quantize the given model inplace, otherwise a copy is quantized
+
+    Returns:
+        the quantized model, in eval mode and on cpu
+    """
+    import copy
+    assert set(modules) <= set(QUANTIZABLE_MODULES), (modules, QUANTIZABLE_MODULES)
+    model = model if inplace else copy.deepcopy(model)
+    model = model.eval().cpu()
+
+    if 'encoder' in modules:
+        model.encoder = DynamicQuantCausalConv1d(model.encoder)
+    if 'decoder' in modules:
+        model.decoder = _quantize_linear(model.decoder.weight.detach(), model.decoder.bias.detach())
+    quantized = dict()  # the full-band linears are shared by layers
+    for layer in model.layers:
+        if 'full' in modules:
+            if id(layer.full) not in quantized:
+                quantized[id(layer.full)] = DynamicQuantLinearGroup(layer.full)
+            layer.full = quantized[id(layer.full)]
+        if 'squeeze' in modules:
+            layer.squeeze[0] = DynamicQuantConv1x1(layer.squeeze[0])
+            layer.unsqueeze[0] = DynamicQuantConv1x1(layer.unsqueeze[0])
+        if 'mamba' in modules:
+            for mamba in (layer.mamba if isinstance(layer.mamba, nn.ModuleList) else [layer.mamba]):
+                assert isinstance(mamba, TorchMamba), "the quantized inference needs mamba_backend='torch'"
+                mamba.in_proj = _quantize_linear(mamba.in_proj.weight.detach(), None if mamba.in_proj.bias is None else mamba.in_proj.bias.detach())
+                mamba.out_proj = _quantize_linear(mamba.out_proj.weight.detach(), None if mamba.out_proj.bias is None else mamba.out_proj.bias.detach())
+    model.quantized_modules = list(modules)
+    return model
+
+
+def save_quantized(model: CleanMel, path: str) -> None:
+    """save the state_dict of a quantized CleanMel, separately from the float checkpoint"""
+    torch.save({'quantized_modules': model.quantized_modules, 'state_dict': model.state_dict()}, path)
+
+
+def load_quantized(path: str, **init_args) -> CleanMel:
+    """load a quantized CleanMel saved by `save_quantized`
+
+    Args:
+        path: the quantized checkpoint
+        init_args: the init args of the float CleanMel (mamba_backend is set to 'torch')
+    """
+    ckpt = torch.load(path, map_location='cpu')
+    model = CleanMel(**{**init_args, 'mamba_backend': 'torch'})
+    model = quantize_cleanmel(model, modules=ckpt['quantized_modules'], inplace=True)
+    model.load_state_dict(ckpt['state_dict'])
+    return model
+
+
+if __name__ == '__main__':
+    # compare the quantized log-mel with the float one on the demo wavs, and gate on the accuracy
+    # python -m model.arch.quantize --config ./configs/model/cleanmel_offline.yaml --n_layers 8 --dim_hidden 96 --arch_ckpt ./pretrained/enhancement/offline_CleanMel_S_map.ckpt --output map --save_to ./pretrained/enhancement/offline_CleanMel_S_map.int8.ckpt
+    import argparse
+    import glob
+    import os
+    import sys
+    import time
+
+    import soundfile as sf
+    import yaml
+
+    from model.io.stft import InputSTFT, TargetMel
+
+    parser = argparse.ArgumentParser(description='The int8 model is opt-in for CleanMel: the measured CPU speedup is only 1.02-1.08x, as the '
+                                     'selective scans (about 90% of the CPU time) stay in float. The int8 checkpoint is about 1/3 '
+                                     'of the float one.')
+    parser.add_argument('--config', type=str, default='./configs/model/cleanmel_offline.yaml')
+    parser.add_argument('--n_layers', type=int, default=None)
+    parser.add_argument('--dim_hidden', type=int, default=None)
+    parser.add_argument('--arch_ckpt', type=str, default=None, help='the float checkpoint, random weights if not given')
+    parser.add_argument('--output', type=str, default='map', choices=['map', 'mask'])
+    parser.add_argument('--modules', type=str, nargs='+', default=DEFAULT_QUANTIZED_MODULES, choices=QUANTIZABLE_MODULES)
+    parser.add_argument('--wavs', type=str, default='./src/demos/*.wav')
+    parser.add_argument('--max_err', type=float, default=0.15, help='the gate on the mean absolute (natural) log-mel error of each wav, '
+                        '0.08-0.14 on 15 of the 16 demos with random weights (S offline), 0.24 on the last one')
+    parser.add_argument('--max_peak_err', type=float, default=1.5, help='the gate on the max absolute log-mel error of each wav, '
+                        '0.6-1.5 on 15 of the 16 demos with random weights (S offline), 2.6 on the last one')
+    parser.add_argument('--save_to', type=str, default=None, help='where to save the quantized checkpoint if the gate is passed')
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    config = yaml.safe_load(open(args.config, 'r'))['model']
+    init_args = config['arch']['init_args']
+    init_args.update({k: getattr(args, k) for k in ['n_layers', 'dim_hidden'] if getattr(args, k) is not None})
+    init_args['mamba_backend'] = 'torch'
+    model = CleanMel(**init_args).eval()
+    if args.arch_ckpt is not None:
+        model.load_state_dict(torch.load(args.arch_ckpt, map_location='cpu'), strict=True)
+    qmodel = quantize_cleanmel(model, modules=args.modules)
+    input_stft = InputSTFT(**config['input_stft']['init_args']).eval()
+    target_mel = TargetMel(**config['target_stft']['init_args']).eval()
+    log_eps = float(config.get('log_eps', 1e-5))
+
+    def logmel(m: CleanMel, x: Tensor, X: Tensor, X_norm: Tensor) -> Tensor:
+        Y_hat = m(X, inference=True)
+        if args.output == 'mask':
+            Y_hat = torch.sigmoid(Y_hat) * target_mel(x, X_norm)
+        else:
+            Y_hat = torch.exp(Y_hat)
+        return torch.log(torch.clip(Y_hat, min=log_eps))
+
+    passed, t_float, t_quant = True, 0, 0
+    with torch.no_grad():
+        for path in sorted(glob.glob(args.wavs)):
+            wav, sr = sf.read(path, dtype='float32', always_2d=True)
+            assert sr == target_mel.sample_rate, (path, sr)
+            x = torch.from_numpy(wav[:, 0])[None]
+            X, X_norm = input_stft(x)
+            ts = time.perf_counter()
+            Y = logmel(model, x, X, X_norm)
+            t_float += time.perf_counter() - ts
+            ts = time.perf_counter()
+            Y_q = logmel(qmodel, x, X, X_norm)
+            t_quant += time.perf_counter() - ts
+            err = (Y_q - Y).abs()
+            passed = passed and err.mean().item() <= args.max_err and err.max().item() <= args.max_peak_err
+            print(f"{os.path.basename(path)}: max_err={err.max().item():.4f}, mean_err={err.mean().item():.4f}")
+    print(f"float: {t_float:.2f}s, int8: {t_quant:.2f}s, speedup={t_float / t_quant:.2f}x, {'passed' if passed else 'FAILED'} (mean_err <= {args.max_err}, max_err <= {args.max_peak_err})")
+    if not passed:
+        sys.exit(1)
+    if args.save_to is not None:
+        save_quantized(qmodel, args.save_to)
+        print('quantized checkpoint saved to', args.save_to)
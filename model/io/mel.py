@@ -0,0 +1,102 @@
+from functools import lru_cache
+from typing import *
+
+import librosa
+import numpy as np
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+
+@lru_cache(maxsize=32)
+def _mel_filterbank(**mel_options) -> np.ndarray:
+    fb = librosa.filters.mel(**mel_options)
+    fb.flags.writeable = False
+    return fb
+
+
+def mel_filterbank(**mel_options) -> np.ndarray:
+    """`librosa.filters.mel(**mel_options)`, memoized per process (keyed by the options) as the filterbank is rebuilt by every
+    mel frontend and CleanMel; a writable copy is returned, as the callers may keep and load checkpoints into it"""
+    return _mel_filterbank(**mel_options).copy()
+
+
+class MelProjection(nn.Module):
+    """Sparse linear-frequency to mel projection.
+
+    Each mel band of a (slaney/htk) mel filterbank only covers a few adjacent frequency bins, e.g. 500 non-zeros out of 257x80 for
+    16 kHz, 512-point FFT, 80 mels. The transposed filterbank is stored in CSR format (as plain index/value buffers, so that the
+    module can be moved/broadcast like a dense one) and applied with a sparse-dense matmul on CPU. On other devices or dtypes that
+    the sparse kernels do not support (e.g. half), and when traced or compiled, the dense filterbank is used.
+
+    The buffers are not persistent, i.e. the state_dict of the parent module is unchanged. A parent owning the filterbank as a
+    (persistent) buffer of its own, e.g. `CleanMel.linear2mel`, passes it to `forward` instead, so that the projection follows the
+    filterbank loaded from a checkpoint: its CSR format is then rebuilt whenever the tensor or its values change.
+    """
+
+    def __init__(self, fb: Tensor) -> None:
+        """
+        Args:
+            fb: the filterbank [Freq, Mel], i.e. `librosa.filters.mel(...).T`
+        """
+        super().__init__()
+        fb = torch.as_tensor(fb, dtype=torch.float32).detach()
+        self.n_freqs, self.n_mels = fb.shape
+        csr = fb.T.contiguous().to_sparse_csr()
+        self.register_buffer('fb', fb, persistent=False)
+        self.register_buffer('crow_indices', csr.crow_indices(), persistent=False)
+        self.register_buffer('col_indices', csr.col_indices(), persistent=False)
+        self.register_buffer('values', csr.values(), persistent=False)
+        self._csr_key, self._csr = None, None
+
+    def _csr_of(self, fb: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """the CSR (crow_indices, col_indices, values) of the transposed `fb`, cached by the storage and the version of `fb`"""
+        key = (fb.data_ptr(), fb._version, fb.device, fb.dtype, tuple(fb.shape))
+        if key != self._csr_key:
+            csr = fb.detach().T.contiguous().to_sparse_csr()
+            self._csr_key, self._csr = key, (csr.crow_indices(), csr.col_indices(), csr.values())
+        return self._csr
+
+    def forward(self, x: Tensor, dim: int = -2, fb: Optional[Tensor] = None) -> Tensor:
+        """project the frequency dimension `dim` of x to the mel scale
+
+        Args:
+            x: [..., Freq, ...]
+            dim: the frequency dimension
+            fb: the filterbank [Freq, Mel] to use instead of the one given at construction, e.g. the buffer of the parent module
+
+        Returns:
+            [..., Mel, ...]
+        """
+        assert x.shape[dim] == self.n_freqs, (x.shape, dim, self.n_freqs)
+        assert fb is None or tuple(fb.shape) == (self.n_freqs, self.n_mels), (fb.shape, self.n_freqs, self.n_mels)
+        if x.device.type != 'cpu' or x.dtype not in [torch.float32, torch.float64] or torch.jit.is_tracing() or torch._dynamo.is_compiling():
+            dim, last = dim % x.ndim, x.ndim - 1  # non-negative dims for the ONNX export of movedim
+            return torch.matmul(x.movedim(dim, last), (self.fb if fb is None else fb).to(x.dtype)).movedim(last, dim)
+
+        xf = x.movedim(dim, 0)
+        shape = xf.shape
+        crow_indices, col_indices, values = (self.crow_indices, self.col_indices, self.values) if fb is None else self._csr_of(fb)
+        fb = torch.sparse_csr_tensor(crow_indices, col_indices, values.to(x.dtype), size=(self.n_mels, self.n_freqs))
+        y = fb @ xf.reshape(self.n_freqs, -1)
+        return y.reshape(self.n_mels, *shape[1:]).movedim(0, dim)
+
+    def extra_repr(self) -> str:
+        return f"n_freqs={self.n_freqs}, n_mels={self.n_mels}, nnz={self.values.numel()}"
+
+
+if __name__ == '__main__':
+    # check the equivalence with the dense projection and compare the speed on CPU
+    # python -m model.io.mel
+    from model.utils.benchmark import compare
+
+    fb = torch.tensor(librosa.filters.mel(sr=16000, n_fft=512, n_mels=80).T)
+    mel = MelProjection(fb)
+    print(mel)
+    x = torch.randn(1, 257, 500, 96)
+    y = mel(x, dim=1)
+    print('max abs diff:', (y - torch.einsum("bfth,fm->bmth", x, fb)).abs().max().item())
+    compare({
+        'dense': lambda: torch.einsum("bfth,fm->bmth", x, fb),
+        'sparse': lambda: mel(x, dim=1),
+    }, repeat=10)
@@ -3,13 +3,14 @@ from torch import Tensor
 from typing import *
 
 import torch
+from torchaudio.functional import lfilter
 
 # The function is identical to `forgetting_normalization` in
 # https://github.com/Audio-WestlakeU/NBSS/blob/main/models/io/norm.py
 
 # I changed the name of the function to `recursive_normalization` to better reflect
 # the implementation of the function.
-def recursive_normalization(XrMag: Tensor, sliding_window_len: int = 250) -> Tensor:
+def recursive_normalization_loop(XrMag: Tensor, sliding_window_len: int = 250) -> Tensor:
     alpha = (sliding_window_len - 1) / (sliding_window_len + 1)
     mu = 0
     mu_list = []
@@ -24,4 +25,69 @@ def recursive_normalization(XrMag: Tensor, sliding_window_len: int = 250) -> Ten
         mu_list.append(mu)
 
     XrMM = torch.stack(mu_list, dim=-1).to(XrMag.device)
-    return XrMM
\ No newline at end of file
+    return XrMM
+
+
+def recursive_normalization(XrMag: Tensor, sliding_window_len: int = 250) -> Tensor:
+    """The same running mean as `recursive_normalization_loop`, computed on the device of XrMag without the loop over frames.
+
+    mu_t = alpha_t * mu_{t-1} + (1 - alpha_t) * x_t, where x_t is the mean magnitude of frame t, and alpha_t = (t-1)/(t+1) for
+    the first `sliding_window_len` frames (the warm-up) and (L-1)/(L+1) afterwards. As alpha_1 = 0 and the product of the
+    warm-up alphas telescopes, the warm-up has the closed form mu_t = 2 / (t(t+1)) * sum_{s=1..t} s x_s (t >= 1, mu_0 = 2 x_0),
+    i.e. a cumsum. The time-invariant part is a one-pole IIR filter (`lfilter`) started from the last warm-up value.
+
+    Args:
+        XrMag: the STFT magnitude [B,F,T]
+        sliding_window_len: L
+
+    Returns:
+        the running mean [B,1,T]
+    """
+    return recursive_normalization_chunk(XrMag, 0, 0, sliding_window_len)
+
+
+def recursive_normalization_chunk(XrMag: Tensor, mu: Union[Tensor, float], t0: int, sliding_window_len: int = 250) -> Tensor:
+    """`recursive_normalization` of the frames t0, t0+1, ... of a stream, given the running mean mu [B,1,1] of frame t0-1
+
+    Returns:
+        the running mean [B,1,T], whose last frame is the mu of the next chunk
+    """
+    alpha = (sliding_window_len - 1) / (sliding_window_len + 1)
+    x = XrMag.mean(dim=1, keepdim=True).detach()  # [B,1,T]
+    T = x.shape[-1]
+    W = min(max(sliding_window_len - t0, 0), T)  # the warm-up frames in this chunk
+    mus = []
+
+    if W > 0:
+        # prod_{k=t0..t} alpha_k = (t0-1)t0 / (t(t+1))
+        t = torch.arange(t0, t0 + W, device=x.device, dtype=x.dtype)
+        mu = (mu * ((t0 - 1) * t0) + 2 * torch.cumsum(t * x[..., :W], dim=-1)) / (t * (t + 1)).clamp(min=1)
+        if t0 == 0:
+            mu = torch.cat([2 * x[..., :1], mu[..., 1:]], dim=-1)
+        mus.append(mu)
+        mu = mu[..., -1:]
+
+    if T > W:
+        # mu_t = alpha * mu_{t-1} + (1 - alpha) * x_t
+        a = torch.tensor([1, -alpha], device=x.device, dtype=x.dtype)
+        b = torch.tensor([1 - alpha, 0], device=x.device, dtype=x.dtype)
+        decay = alpha ** torch.arange(1, T - W + 1, device=x.device, dtype=x.dtype)
+        mus.append(lfilter(x[..., W:], a_coeffs=a, b_coeffs=b, clamp=False) + decay * mu)
+    return torch.cat(mus, dim=-1)
+
+
+if __name__ == '__main__':
+    # check the equivalence with the loop implementation and compare the speed across T
+    # python -m model.io.norm
+    from model.utils.benchmark import timeit
+
+    for T in [10, 250, 251, 1000, 4000, 16000]:
+        XrMag = torch.rand(4, 257, T) * torch.logspace(-3, 1, T)  # varying level over time
+        mu_loop = recursive_normalization_loop(XrMag)
+        mu = recursive_normalization(XrMag)
+        assert mu.shape == mu_loop.shape, (mu.shape, mu_loop.shape)
+        rel_err = ((mu - mu_loop).abs() / mu_loop.abs()).max().item()
+        assert rel_err < 1e-4, (T, rel_err)
+        t_loop = timeit(lambda: recursive_normalization_loop(XrMag), repeat=3)
+        t_vec = timeit(lambda: recursive_normalization(XrMag), repeat=3)
+        print(f"T={T}: max rel err={rel_err:.2e}, loop={t_loop * 1e3:.2f}ms, vectorized={t_vec * 1e3:.2f}ms, speedup={t_loop / t_vec:.1f}x")
@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+from typing import *
+
+import torch
+import torch.nn as nn
+
+
+def _freeze(value: Any) -> Hashable:
+    """a hashable version of a config value"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class FrontendRegistry:
+    """A process-wide cache of frontend modules (e.g. `InputSTFT`, `TargetMel`), keyed by their class, init args and device.
+
+    Building a frontend computes its window and mel filterbank and moves them to the device, which is wasted work when the
+    same frontend is rebuilt for every request (e.g. in app.py). `get` returns the cached module in eval mode, building it on
+    the first request. At most `max_size` modules are kept, the least recently used one is evicted first.
+
+    The cached modules are shared: do not change their mode or device, nor their buffers.
+    """
+
+    def __init__(self, max_size: int = 8) -> None:
+        self.max_size = max_size
+        self.modules: 'OrderedDict[Hashable, nn.Module]' = OrderedDict()
+        self.hits, self.misses = 0, 0
+        self._lock = threading.Lock()
+
+    def get(self, cls: Type[nn.Module], device: Union[str, torch.device] = 'cpu', **init_args) -> nn.Module:
+        """the cached `cls(**init_args).eval().to(device)`"""
+        key = (f"{cls.__module__}.{cls.__qualname__}", _freeze(init_args), str(torch.device(device)))
+        with self._lock:
+            if key in self.modules:
+                self.hits += 1
+                self.modules.move_to_end(key)
+                return self.modules[key]
+            self.misses += 1
+            module = cls(**init_args).eval().to(device)
+            self.modules[key] = module
+            while len(self.modules) > self.max_size:
+                self.modules.popitem(last=False)
+            return module
+
+    def clear(self) -> None:
+        with self._lock:
+            self.modules.clear()
+
+    def __len__(self) -> int:
+        return len(self.modules)
+
+    def __repr__(self) -> str:
+        return f"FrontendRegistry(size={len(self)}, max_size={self.max_size}, hits={self.hits}, misses={self.misses})"
+
+
+# the default registry of the process
+FRONTENDS = FrontendRegistry()
+
+
+def get_frontend(cls: Type[nn.Module], device: Union[str, torch.device] = 'cpu', **init_args) -> nn.Module:
+    """the cached frontend `cls(**init_args)` on device, from the default registry `FRONTENDS`"""
+    return FRONTENDS.get(cls, device=device, **init_args)
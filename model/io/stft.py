@@ -1,11 +1,13 @@
 import torch
-import librosa
 import torch.nn as nn
 import random
+import torchaudio
+from dataclasses import dataclass
 from torch import Tensor
-from typing import Optional
+from typing import Optional, Tuple
 from torchaudio.transforms import Spectrogram
-from model.io.norm import recursive_normalization
+from model.io.norm import recursive_normalization, recursive_normalization_chunk
+from model.io.mel import MelProjection, mel_filterbank
 from torchaudio.transforms import Spectrogram, MelScale
 
 def soxnorm(wav: torch.Tensor, gain, factor=None):
@@ -23,6 +25,52 @@ def soxnorm(wav: torch.Tensor, gain, factor=None):
     return wav, factor
 
 
+def soxnorm_batch(wav: Tensor, gain=None, factor: Optional[Tensor] = None) -> Tuple[Tensor, Tensor]:
+    """`soxnorm` with one factor per utterance and no host sync
+
+    Args:
+        wav: [B,T], the utterances (may be zero-padded at the end, which does not change their peaks)
+        gain: the target peak level (dB), used if factor is None
+        factor: [B,1], the factors of the noisy utterances, used for the clean ones
+
+    Returns:
+        the normalized waveforms [B,T], and the factors [B,1]
+    """
+    wav = torch.clip(wav, max=1, min=-1).float()
+    if factor is None:
+        factor = 10 ** (gain / 20) / torch.abs(wav).amax(dim=-1, keepdim=True)
+    wav = wav * factor
+    # checked on the device, without waiting for the result
+    torch._assert_async(torch.all(wav.abs() <= 1))
+    return wav, factor
+
+
+def reflect_pad_end(x: Tensor, lengths: Tensor, pad: int) -> Tensor:
+    """for a zero-padded batch [B,T] of utterances of `lengths` samples, reflect the `pad` samples after the end of each utterance
+    (as the reflect padding of a centered STFT does at the end of the unpadded utterance), so that the frames of the utterance are
+    the same as the ones of the unpadded utterance"""
+    idx = torch.arange(x.shape[-1], device=x.device)[None, :]
+    lengths = lengths.to(x.device)[:, None]
+    src = torch.where(idx < lengths, idx, 2 * (lengths - 1) - idx)  # the reflection of idx at the end
+    valid = (idx < lengths + pad) & (src >= 0)
+    return torch.where(valid, x.gather(-1, src.clamp(min=0)), torch.zeros_like(x))
+
+
+def frame_mask(lengths: Tensor, num_frames: int, hop_length: int, center: bool = True, n_fft: int = None) -> Tensor:
+    """the frame mask [B,T] of a padded batch, False for the frames after the end of each utterance"""
+    frames = lengths // hop_length + 1 if center else (lengths - n_fft) // hop_length + 1
+    return torch.arange(num_frames, device=lengths.device)[None, :] < frames[:, None]
+
+
+@dataclass
+class InputSTFTState:
+    """The streaming state of an online InputSTFT, see `InputSTFT.init_state` and `InputSTFT.step`"""
+    buffer: Tensor  # [B, N], the samples (of the reflect-padded waveform) from the start of the next frame, or the input samples before the first frame
+    tail: Tensor  # [B, <= n_fft//2+1], the last input samples, for the reflect padding at the end
+    mu: Tensor  # [B,1,1], the running mean of the recursive normalization of the last frame
+    num_frames: int = 0  # the number of emitted frames
+
+
 class InputSTFT(nn.Module):
     """
     The STFT of the input signal of CleanMel (STFT coefficients);
@@ -50,9 +98,19 @@ class InputSTFT(nn.Module):
             power=None
         )
     
-    def forward(self, x):
+    def forward(self, x, lengths: Optional[Tensor] = None):
+        """
+        Args:
+            x: the waveforms [B,T]
+            lengths: the lengths of the utterances in a zero-padded batch [B], see `data_loader.utils.collate_func.pad_collate_func`
+
+        Returns:
+            the normalized STFT [B,F,T,2] and the normalization factor
+        """
+        if lengths is not None and self.stft.center:
+            x = reflect_pad_end(x, lengths, self.stft.n_fft // 2)
         if self.online:
-            # recursive normalization
+            # recursive normalization (causal, so the padded frames at the end do not change the normalization of the valid ones)
             x = self.stft(x)
             x_mag = x.abs()
             x_norm = recursive_normalization(x_mag)
@@ -60,11 +118,68 @@ class InputSTFT(nn.Module):
             x = torch.view_as_real(x)
         else:
             # vocos dBFS normalization
-            x, x_norm = soxnorm(x, random.randint(-6, -1) if self.training else -3)
+            # one factor per utterance, [B,1]
+            x, x_norm = soxnorm_batch(x, random.randint(-6, -1) if self.training else -3)
             x = self.stft(x)
             x = torch.view_as_real(x)
         return x , x_norm
 
+    def init_state(self, batch: int, device: torch.device = None) -> InputSTFTState:
+        """initial streaming state for `step`"""
+        assert self.online, "streaming is only supported for the online (recursive) normalization"
+        device = self.stft.window.device if device is None else device
+        empty = torch.zeros(batch, 0, device=device)
+        return InputSTFTState(buffer=empty, tail=empty, mu=torch.zeros(batch, 1, 1, device=device))
+
+    def step(self, x: Tensor, state: InputSTFTState, last: bool = False) -> Tuple[Tensor, Tensor, InputSTFTState]:
+        """streaming forward on a chunk of samples: emits the frames whose analysis windows are complete, the same (frame for
+        frame) as `forward` on the whole waveform. With `last`, the remaining frames at the end of the waveform are emitted
+        (the reflect padding of the centered STFT needs the end).
+
+        Args:
+            x: [B, N], the new samples (any number, including 0)
+            state: the state returned by `init_state` or the previous call
+
+        Returns:
+            the new normalized frames [B,F,T,2] and the normalization X_norm [B,1,T] (T >= 0), and the updated state
+        """
+        assert self.online, "streaming is only supported for the online (recursive) normalization"
+        n_fft, hop = self.stft.n_fft, self.stft.hop_length
+        pad = n_fft // 2 if self.stft.center else 0
+        buffer = torch.cat([state.buffer, x], dim=-1)
+        state.tail = torch.cat([state.tail, x], dim=-1)[:, -(pad + 1):]
+        if state.num_frames == 0 and pad > 0:
+            if buffer.shape[-1] <= pad:
+                # waiting for the samples of the reflect padding at the start
+                assert not last, f"the waveform is too short ({buffer.shape[-1]} samples) for the reflect padding"
+                state.buffer = buffer
+                return self._empty_output(buffer), buffer.new_zeros(buffer.shape[0], 1, 0), state
+            buffer = torch.cat([buffer[:, 1:pad + 1].flip(-1), buffer], dim=-1)
+        if last and pad > 0:
+            buffer = torch.cat([buffer, state.tail.flip(-1)[:, 1:pad + 1]], dim=-1)
+
+        num_frames = (buffer.shape[-1] - n_fft) // hop + 1 if buffer.shape[-1] >= n_fft else 0
+        state.buffer = buffer[:, num_frames * hop:]
+        if num_frames == 0:
+            return self._empty_output(buffer), buffer.new_zeros(buffer.shape[0], 1, 0), state
+        X = torchaudio.functional.spectrogram(
+            buffer[:, :(num_frames - 1) * hop + n_fft], pad=self.stft.pad, window=self.stft.window, n_fft=n_fft, hop_length=hop,
+            win_length=self.stft.win_length, power=None, normalized=self.stft.normalized, center=False, onesided=self.stft.onesided,
+        )
+        X_norm = recursive_normalization_chunk(X.abs(), state.mu, state.num_frames)
+        state.mu = X_norm[..., -1:]
+        state.num_frames += num_frames
+        X = X / X_norm.clamp(min=1e-8)
+        return torch.view_as_real(X), X_norm, state
+
+    def _empty_output(self, x: Tensor) -> Tensor:
+        n_freqs = self.stft.n_fft // 2 + 1 if self.stft.onesided else self.stft.n_fft
+        return x.new_zeros(x.shape[0], n_freqs, 0, 2)
+
+    def frame_mask(self, lengths: Tensor, num_frames: int) -> Tensor:
+        """the frame mask [B,T] of a padded batch, False for the padded frames"""
+        return frame_mask(lengths, num_frames, self.stft.hop_length, self.stft.center, self.stft.n_fft)
+
 
 class LibrosaMelScale(nn.Module):
     r"""Pytorch implementation of librosa mel scale to align with common ESPNet ASR models; 
@@ -83,11 +198,12 @@ class LibrosaMelScale(nn.Module):
             norm=norm
         )
         
-        fb = torch.from_numpy(librosa.filters.mel(**_mel_options).T).float()
+        fb = torch.from_numpy(mel_filterbank(**_mel_options).T).float()
         self.register_buffer("fb", fb)
+        self.projection = MelProjection(fb)
     
     def forward(self, specgram):
-        mel_specgram = torch.matmul(specgram.transpose(-1, -2), self.fb).transpose(-1, -2)
+        mel_specgram = self.projection(specgram, dim=-2, fb=self.fb)  # fb may be loaded from a checkpoint
         return mel_specgram
 
 
@@ -140,7 +256,9 @@ class TargetMel(nn.Module):
             mel_scale=mel_scale,
         )
         
-    def forward(self, x: Tensor, x_norm=None):      
+    def forward(self, x: Tensor, x_norm=None, lengths: Optional[Tensor] = None):      
+        if lengths is not None and self.stft.center:
+            x = reflect_pad_end(x, lengths, self.stft.n_fft // 2)
         if self.online:
             # apply recursive normalization to target waveform
             spectrogram = self.stft(x)
@@ -148,8 +266,53 @@ class TargetMel(nn.Module):
             spectrogram = spectrogram.abs().pow(2)  # to power spectrogram
         else:
             # apply vocos dBFS normalization to target waveform
-            x, _ = soxnorm(x, None, x_norm)
+            x, _ = soxnorm_batch(x, None, x_norm)
             spectrogram = self.stft(x)
         # mel spectrogram
         mel_specgram = self.mel_scale(spectrogram)
         return mel_specgram
+
+    def shares_stft(self, input_stft: InputSTFT) -> bool:
+        """whether the STFT of `input_stft` is the one of this module, i.e. `from_input_stft` can be used"""
+        a, b = self.stft, input_stft.stft
+        return self.online == input_stft.online and self.stft.power in [None, 2] and \
+            all(getattr(a, k) == getattr(b, k) for k in ['n_fft', 'win_length', 'hop_length', 'pad', 'normalized', 'center', 'pad_mode', 'onesided']) and \
+            torch.equal(a.window, b.window)
+
+    def from_input_stft(self, X: Tensor, x_norm) -> Tensor:
+        """the target mel of the input waveform, from the output (X, x_norm) of an InputSTFT sharing the STFT (see `shares_stft`),
+        without computing the STFT again
+
+        Args:
+            X: the normalized STFT [B,F,T,2]
+            x_norm: the normalization factor
+
+        Returns:
+            the same as `forward(x, x_norm)` with x the input waveform of the InputSTFT
+        """
+        X = torch.view_as_complex(X)
+        if self.online:
+            # X = STFT(x) / clamp(x_norm), while the target is STFT(x) / (x_norm + 1e-8)
+            X = X * (x_norm.clamp(min=1e-8) / (x_norm + 1e-8))
+        # offline: X is the STFT of the same soxnormed waveform
+        return self.mel_scale(X.abs().pow(2))
+
+
+if __name__ == '__main__':
+    # check the streaming frontend of the online InputSTFT against the batch one, on random chunk sizes
+    # python -m model.io.stft
+    import yaml
+
+    input_stft = InputSTFT(**yaml.safe_load(open('./configs/model/cleanmel_online.yaml'))['model']['input_stft']['init_args']).eval()
+    x = torch.randn(2, 16000 * 3 + 77) * torch.linspace(0.01, 1, 16000 * 3 + 77)
+    X, X_norm = input_stft(x)
+    state, frames, norms, pos = input_stft.init_state(batch=2), [], [], 0
+    while pos < x.shape[-1]:
+        n = random.randint(1, 1000)
+        X_chunk, X_norm_chunk, state = input_stft.step(x[:, pos:pos + n], state, last=pos + n >= x.shape[-1])
+        frames.append(X_chunk)
+        norms.append(X_norm_chunk)
+        pos += n
+    X_s, X_norm_s = torch.cat(frames, dim=2), torch.cat(norms, dim=2)
+    assert X_s.shape == X.shape and X_norm_s.shape == X_norm.shape, (X_s.shape, X.shape)
+    print(f"{X.shape[2]} frames from {len(frames)} chunks: max abs diff={(X_s - X).abs().max().item():.2e}, X_norm max rel diff={((X_norm_s - X_norm).abs() / X_norm).max().item():.2e}")
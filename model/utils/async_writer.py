@@ -0,0 +1,101 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import *
+
+
+class AsyncWriter:
+    """Writes files in a thread pool, so that the writes (e.g. `sf.write`, `np.save` of the predictions) overlap with the compute.
+
+    At most `max_pending` writes are queued: `submit` blocks when the queue is full, which bounds the memory held by the pending
+    outputs. `flush` waits for the pending writes and raises the first error of a failed write. With `num_workers` = 0, the writes
+    are done synchronously in `submit`.
+
+    The written bytes and the time spent in the writes are recorded for the throughput report (see `stats`).
+    """
+
+    def __init__(self, num_workers: int = 2, max_pending: int = 16) -> None:
+        self.num_workers = num_workers
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='writer') if num_workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max(1, max_pending))
+        self.futures: List[Future] = []
+        self.num_files, self.num_bytes, self.write_time = 0, 0, 0.0
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _write(self, fn: Callable[..., Any], args: Tuple, num_bytes: int) -> None:
+        try:
+            ts = time.perf_counter()
+            fn(*args)
+            with self._lock:
+                self.write_time += time.perf_counter() - ts
+                self.num_files += 1
+                self.num_bytes += num_bytes
+        finally:
+            if self.executor is not None:
+                self.slots.release()
+
+    def submit(self, fn: Callable[..., Any], *args, num_bytes: int = 0) -> None:
+        """write with fn(*args); `num_bytes` is the size of the output, for the throughput"""
+        if self.executor is None:
+            return self._write(fn, args, num_bytes)
+        self.slots.acquire()
+        self.futures = [f for f in self.futures if not f.done() or f.exception() is not None]
+        self.futures.append(self.executor.submit(self._write, fn, args, num_bytes))
+
+    def flush(self) -> None:
+        """wait for the pending writes"""
+        futures, self.futures = self.futures, []
+        for f in futures:
+            f.result()
+
+    def close(self) -> None:
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def stats(self) -> Dict[str, float]:
+        """the number of files and MB written, the write throughput (MB per second of writing, summed over the workers), and the
+        wall time since the start"""
+        mb = self.num_bytes / 1e6
+        return {
+            'files': self.num_files,
+            'MB': mb,
+            'write_MB/s': mb / self.write_time if self.write_time > 0 else 0.0,
+            'wall_s': time.perf_counter() - self.start_time,
+        }
+
+    def __repr__(self) -> str:
+        s = self.stats()
+        return f"AsyncWriter(num_workers={self.num_workers}, files={s['files']}, MB={s['MB']:.1f}, write_MB/s={s['write_MB/s']:.1f}, wall_s={s['wall_s']:.1f})"
+
+
+if __name__ == '__main__':
+    # compare the synchronous and the asynchronous writes of predictions interleaved with some compute
+    # python -m model.utils.async_writer --num 50
+    import argparse
+    import tempfile
+
+    import numpy as np
+    import soundfile as sf
+    import torch
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--num_workers', type=int, default=2)
+    args = parser.parse_args()
+
+    wav = np.random.randn(int(args.seconds * 16000)).astype(np.float32) * 0.1
+    logmel = np.random.randn(80, int(args.seconds * 125)).astype(np.float32)
+    a = torch.randn(256, 256)
+    with tempfile.TemporaryDirectory() as d:
+        for num_workers in [0, args.num_workers]:
+            writer = AsyncWriter(num_workers=num_workers)
+            for i in range(args.num):
+                for _ in range(20):
+                    a = torch.tanh(a @ a)  # the compute of a batch
+                writer.submit(sf.write, f"{d}/{i}.wav", wav, 16000, num_bytes=wav.nbytes)
+                writer.submit(np.save, f"{d}/{i}.npy", logmel, num_bytes=logmel.nbytes)
+            writer.close()
+            print(writer)
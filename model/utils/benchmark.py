@@ -0,0 +1,96 @@
+import time
+from typing import *
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+
+def peak_memory(fn: Callable[[], Any], device: Union[str, torch.device] = 'cpu') -> float:
+    """the peak memory (MB) allocated by torch during `fn()`
+
+    Args:
+        fn: the function to measure
+        device: on cuda, `torch.cuda.max_memory_allocated` is used; on cpu, the allocations/frees recorded by the profiler are accumulated in time order.
+    """
+    device = torch.device(device)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        base = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return (torch.cuda.max_memory_allocated(device) - base) / 1e6
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    mem, peak = 0, 0
+    for e in sorted(prof.events(), key=lambda e: e.time_range.start):
+        mem += e.self_cpu_memory_usage
+        peak = max(peak, mem)
+    return peak / 1e6
+
+
+def timeit(fn: Callable[[], Any], device: Union[str, torch.device] = 'cpu', repeat: int = 3, warmup: int = 1) -> float:
+    """the mean wall time (seconds) of `fn()` over `repeat` runs after `warmup` runs"""
+    device = torch.device(device)
+    for _ in range(warmup):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    ts = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - ts) / repeat
+
+
+def compare(fns: Dict[str, Callable[[], Any]], device: Union[str, torch.device] = 'cpu', repeat: int = 3, warmup: int = 1, baseline: str = None) -> Dict[str, Dict[str, float]]:
+    """measure the time and the peak memory of several implementations of the same computation, and print them
+
+    Args:
+        fns: name -> function
+        baseline: the name of the reference implementation for the speedup, the first one by default
+
+    Returns:
+        name -> {'time': seconds, 'peak_mem': MB, 'speedup': x}
+    """
+    baseline = list(fns.keys())[0] if baseline is None else baseline
+    results = {}
+    for name, fn in fns.items():
+        results[name] = {'time': timeit(fn, device=device, repeat=repeat, warmup=warmup), 'peak_mem': peak_memory(fn, device=device)}
+    for name, r in results.items():
+        r['speedup'] = results[baseline]['time'] / r['time']
+        print(f"{name}: time={r['time']*1000:.1f}ms, peak_mem={r['peak_mem']:.1f}MB, speedup={r['speedup']:.2f}x")
+    return results
+
+
+if __name__ == '__main__':
+    # compare the execution modes of CleanMel on random input
+    # python -m model.utils.benchmark layout --seconds 10
+    import argparse
+    from model.arch.cleanmel import CleanMel
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('what', choices=['layout'])
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--online', action='store_true')
+    parser.add_argument('--n_layers', type=int, default=8)
+    parser.add_argument('--dim_hidden', type=int, default=96)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    def build(**kwargs) -> CleanMel:
+        torch.manual_seed(0)
+        model = CleanMel(dim_input=2, dim_output=1, n_layers=args.n_layers, dim_hidden=args.dim_hidden, n_freqs=257, online=args.online, **kwargs)
+        return model.eval().to(args.device)
+
+    x = torch.randn(1, 257, int(args.seconds * 16000 / 128) + 1, 2, device=args.device)
+    if args.what == 'layout':
+        models = {'default': build(), 'channels_last': build(channels_last=True)}
+    with torch.no_grad():
+        ys = {name: m(x) for name, m in models.items()}
+        for name, y in ys.items():
+            print(f"{name}: max abs diff to default={(y - ys['default']).abs().max().item():.2e}")
+        compare({name: (lambda m=m: m(x)) for name, m in models.items()}, device=args.device, repeat=args.repeat)
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from typing import *
+
+import torch
+
+# the HuggingFace repo of the `HF!<filename>` checkpoints
+HF_REPO_ID = "WestlakeAudioLab/CleanMel"
+
+
+def file_digest(path: str, chunk_size: int = 1 << 22) -> str:
+    """the sha256 of a file"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CheckpointStore:
+    """A local, content-addressed store of checkpoints (state dicts), loaded with memory mapping.
+
+    A checkpoint `ckpt` is either a local path or `HF!<filename>` (a file of the HuggingFace repo `HF_REPO_ID`). The first `resolve`
+    copies it into `<root>/objects/<sha256>.pt` (re-saved in the zip format of torch.save if needed, as mmap loading requires it) and
+    records `<root>/refs/<sha1 of ckpt>.json` -> sha256. Later resolves are served from the store without network access, and the
+    local paths are only re-hashed if their size or mtime changed.
+
+    `load` memory-maps the tensors of the stored file (`torch.load(..., mmap=True)`): the processes loading the same checkpoint share
+    the pages of the page cache instead of keeping private copies, especially with `load_state_dict(..., assign=True)`.
+
+    The objects are read-only, and their size and mtime are recorded at insertion: `verify` checks them with a stat, or re-hashes the
+    file with deep=True.
+    """
+
+    def __init__(self, root: Optional[str] = None) -> None:
+        self.root = os.path.expanduser(root or os.environ.get('CLEANMEL_CKPT_STORE', '~/.cache/cleanmel/ckpts'))
+        os.makedirs(f"{self.root}/objects", exist_ok=True)
+        os.makedirs(f"{self.root}/refs", exist_ok=True)
+
+    def object_path(self, digest: str) -> str:
+        return f"{self.root}/objects/{digest}.pt"
+
+    def _ref_path(self, ckpt: str) -> str:
+        return f"{self.root}/refs/{hashlib.sha1(ckpt.encode()).hexdigest()}.json"
+
+    @staticmethod
+    def _write_json(path: str, obj: Dict[str, Any]) -> None:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.replace(tmp, path)
+
+    def put(self, path: str) -> str:
+        """add the checkpoint file `path` to the store, return its sha256"""
+        digest = file_digest(path)
+        obj = self.object_path(digest)
+        if os.path.exists(obj) and self.verify(digest):
+            return digest
+        fd, tmp = tempfile.mkstemp(dir=f"{self.root}/objects", suffix='.tmp')
+        os.close(fd)
+        if zipfile.is_zipfile(path):
+            shutil.copyfile(path, tmp)
+            obj_digest = digest
+        else:  # the legacy format can not be memory-mapped
+            torch.save(torch.load(path, map_location='cpu'), tmp)
+            obj_digest = file_digest(tmp)
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, obj)
+        st = os.stat(obj)
+        self._write_json(f"{obj}.json", {'sha256': obj_digest, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns})
+        return digest
+
+    def verify(self, digest: str, deep: bool = False) -> bool:
+        """whether the stored object is intact: its size and mtime are the recorded ones (a stat), or its content is re-hashed if deep"""
+        obj = self.object_path(digest)
+        if not os.path.exists(obj) or not os.path.exists(f"{obj}.json"):
+            return False
+        meta, st = json.load(open(f"{obj}.json", 'r')), os.stat(obj)
+        if (st.st_size, st.st_mtime_ns) != (meta['size'], meta['mtime_ns']):
+            return False
+        return not deep or file_digest(obj) == meta['sha256']
+
+    def resolve(self, ckpt: str) -> str:
+        """the path of the stored object of `ckpt` (a local path or `HF!<filename>`), which is added to the store if needed"""
+        ref_path = self._ref_path(ckpt)
+        hf = ckpt.startswith('HF!')
+        src = None if hf else os.path.realpath(ckpt)
+        src_stat = None if hf else os.stat(src)
+        if os.path.exists(ref_path):
+            ref = json.load(open(ref_path, 'r'))
+            unchanged = hf or (ref.get('size'), ref.get('mtime_ns')) == (src_stat.st_size, src_stat.st_mtime_ns)
+            if unchanged and self.verify(ref['digest']):
+                return self.object_path(ref['digest'])
+        if hf:
+            from huggingface_hub import hf_hub_download
+            src = hf_hub_download(repo_id=HF_REPO_ID, filename=ckpt.split("!")[-1])
+            src_stat = os.stat(src)
+        digest = self.put(src)
+        self._write_json(ref_path, {'ckpt': ckpt, 'digest': digest, 'size': src_stat.st_size, 'mtime_ns': src_stat.st_mtime_ns})
+        return self.object_path(digest)
+
+    def load(self, ckpt: str, map_location: Any = 'cpu') -> Dict[str, Any]:
+        """the memory-mapped state dict of `ckpt`"""
+        return torch.load(self.resolve(ckpt), map_location=map_location, mmap=True)
+
+
+_STORE: Optional[CheckpointStore] = None
+
+
+def load_checkpoint(ckpt: str, map_location: Any = 'cpu') -> Dict[str, Any]:
+    """the memory-mapped state dict of `ckpt` (a local path or `HF!<filename>`) from the default `CheckpointStore`"""
+    global _STORE
+    if _STORE is None:
+        _STORE = CheckpointStore()
+    return _STORE.load(ckpt, map_location=map_location)
+
+
+if __name__ == '__main__':
+    # compare the resident memory of torch.load and of the memory-mapped load of a checkpoint
+    # python -m model.utils.ckpt_store --ckpt pretrained/enhancement/offline_CleanMel_S_map.ckpt
+    import argparse
+    import subprocess
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt', type=str, default=None, help='a state dict; a random one of --mb MB if not given')
+    parser.add_argument('--mb', type=int, default=200)
+    parser.add_argument('--store', type=str, default=None)
+    parser.add_argument('--mode', type=str, default=None, choices=['torch.load', 'store'], help='(internal) measure one mode')
+    args = parser.parse_args()
+
+    if args.mode is not None:
+        ts = time.perf_counter()
+        if args.mode == 'torch.load':
+            sd = torch.load(args.ckpt, map_location='cpu')
+        else:
+            sd = CheckpointStore(args.store).load(args.ckpt)
+        total = sum(float(v.sum()) for v in sd.values())  # touch all the tensors
+        # the private pages are owned by this process, the clean file-backed ones (the mmap) are shared with the other processes
+        mem = {l.split(':')[0]: int(l.split()[1]) / 1024 for l in open('/proc/self/smaps_rollup') if l.split(':')[0] in ['Rss', 'Private_Dirty']}
+        print(f"{args.mode}: {time.perf_counter() - ts:.2f}s, RSS={mem['Rss']:.0f} MB, private dirty={mem['Private_Dirty']:.0f} MB")
+        sys.exit()
+
+    with tempfile.TemporaryDirectory() as d:
+        store = args.store or f"{d}/store"
+        ckpt = args.ckpt
+        if ckpt is None:
+            ckpt = f"{d}/random.ckpt"
+            torch.save({f"layer{i}.weight": torch.randn(args.mb * 1000 * 1000 // 4 // 10) for i in range(10)}, ckpt)
+        ts = time.perf_counter()
+        path = CheckpointStore(store).resolve(ckpt)
+        print(f"first resolve (hash and copy): {time.perf_counter() - ts:.2f}s")
+        ts = time.perf_counter()
+        CheckpointStore(store).resolve(ckpt)
+        print(f"cached resolve: {(time.perf_counter() - ts) * 1e3:.2f}ms, deep verify: {CheckpointStore(store).verify(os.path.basename(path)[:-3], deep=True)}")
+        for mode in ['torch.load', 'store']:
+            subprocess.run([sys.executable, '-m', 'model.utils.ckpt_store', '--ckpt', ckpt, '--store', store, '--mode', mode])
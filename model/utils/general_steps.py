@@ -14,6 +14,7 @@ from model.utils import MyJsonEncoder
 from model.utils.weightavg import weightavg
 from model.utils.flops import write_FLOPs
 from model.utils.metrics import (cal_metrics_functional)
+from model.utils.metric_executor import CpuMetricExecutor
 
 
 def on_validation_epoch_end(self: pl.LightningModule, cpu_metric_input: List[Tuple[ndarray, ndarray, int]], N: int = 5) -> None:
@@ -47,28 +48,25 @@ def on_validation_epoch_end(self: pl.LightningModule, cpu_metric_input: List[Tup
     cpu_metric_input.clear()
 
 
-def on_test_epoch_end(self: pl.LightningModule, results: List[Dict[str, Any]], cpu_metric_input: List, exp_save_path: str):
-    """ calculate cpu metrics on CPU, collect results, save results to file
+def on_test_epoch_end(self: pl.LightningModule, results: List[Dict[str, Any]], cpu_metric_input: CpuMetricExecutor, exp_save_path: str):
+    """ collect the cpu metrics, collect results, save results to file
 
     Args:
         self: LightningModule
         results: the result list
-        cpu_metric_input: the input list for cal_metrics_functional
+        cpu_metric_input: the executor which the test steps submitted the cpu metrics to, with the ids of their results
         exp_save_path: the path to save result file
     """
 
-    # calculate metrics, input_metrics, improve_metrics on CPU using multiprocessing to speed up
-    torch.multiprocessing.set_sharing_strategy('file_system')
-    num_thread = torch.multiprocessing.cpu_count() // (self.trainer.world_size * 2)
-    p = torch.multiprocessing.Pool(min(num_thread, len(cpu_metric_input)))
-    cpu_metrics = list(p.starmap(cal_metrics_functional, cpu_metric_input))
-    p.close()
-    p.join()
-    for i, m in enumerate(cpu_metrics):
-        metrics, input_metrics, imp_metrics = m
-        results[i].update(input_metrics)
-        results[i].update(imp_metrics)
-        results[i].update(metrics)
+    # the metrics, input_metrics, improve_metrics calculated on CPU during the test steps, merged by id
+    cpu_metrics = cpu_metric_input.gather()
+    cpu_metric_input.close()
+    for r in results:
+        if r['id'] in cpu_metrics:
+            metrics, input_metrics, imp_metrics = cpu_metrics[r['id']]
+            r.update(input_metrics)
+            r.update(imp_metrics)
+            r.update(metrics)
 
     # gather results from all GPUs
     import torch.distributed as dist
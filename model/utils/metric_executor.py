@@ -0,0 +1,62 @@
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import *
+
+import numpy as np
+import torch
+from torch import Tensor
+
+from model.utils.metrics import cal_metrics_functional
+
+
+def _cal_metrics(args: Tuple) -> Tuple[Dict, Dict, Dict]:
+    """`cal_metrics_functional` in a worker, the arrays are turned back into tensors"""
+    return cal_metrics_functional(*[torch.from_numpy(a) if isinstance(a, np.ndarray) else a for a in args])
+
+
+class CpuMetricExecutor:
+    """A persistent process pool computing the CPU metrics (e.g. PESQ, STOI) of `cal_metrics_functional` while the inference goes on.
+
+    The jobs are submitted as the test steps produce them, with an id (e.g. the one of the result dict), and `gather` returns the
+    results by id. The tensors are sent to the workers as numpy arrays. The memory of the pending jobs (the audio waiting for or
+    being evaluated) is capped to `max_pending_mb`: `submit` waits for the running jobs to finish when the cap is reached.
+    The workers are spawned, not forked: the pool is started during the test steps, when the trainer process has CUDA and the
+    dataloader threads running.
+    """
+
+    def __init__(self, num_workers: int = 1, max_pending_mb: float = 512) -> None:
+        self.num_workers = max(1, num_workers)
+        self.max_pending_bytes = max_pending_mb * 1e6
+        self.executor = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=torch.multiprocessing.get_context('spawn'))
+        self.pending: Dict[Future, Tuple[Any, int]] = dict()  # future -> (id, bytes)
+        self.pending_bytes = 0
+        self.results: Dict[Any, Tuple[Dict, Dict, Dict]] = dict()
+
+    def _collect(self, futures: Iterable[Future]) -> None:
+        for f in futures:
+            id, nbytes = self.pending.pop(f)
+            self.pending_bytes -= nbytes
+            self.results[id] = f.result()
+
+    def submit(self, id: Any, *args) -> None:
+        """compute `cal_metrics_functional(*args)` in the pool, e.g. args = (metrics, preds, target, original, fs, 'cpu')"""
+        args = tuple(a.detach().cpu().numpy() if isinstance(a, Tensor) else a for a in args)
+        nbytes = sum(a.nbytes for a in args if isinstance(a, np.ndarray))
+        while len(self.pending) > 0 and self.pending_bytes + nbytes > self.max_pending_bytes:
+            done, _ = wait(list(self.pending), return_when=FIRST_COMPLETED)
+            self._collect(done)
+        self.pending[self.executor.submit(_cal_metrics, args)] = (id, nbytes)
+        self.pending_bytes += nbytes
+        self._collect([f for f in list(self.pending) if f.done()])
+
+    def gather(self) -> Dict[Any, Tuple[Dict, Dict, Dict]]:
+        """wait for the submitted jobs, return their (metrics, input_metrics, imp_metrics) by id; the results are cleared"""
+        self._collect(list(self.pending))
+        results, self.results = self.results, dict()
+        return results
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __len__(self) -> int:
+        """the number of jobs not gathered yet"""
+        return len(self.pending) + len(self.results)
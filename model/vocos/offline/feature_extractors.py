@@ -1,13 +1,13 @@
 from typing import List
 
 import torch
-import librosa
 from encodec import EncodecModel
 from torch import nn
 from torch import Tensor
 from typing import Optional
 from torchaudio.transforms import Spectrogram, MelScale
 from model.vocos.offline.modules import safe_log
+from model.io.mel import MelProjection, mel_filterbank
 
 
 class FeatureExtractor(nn.Module):
@@ -62,11 +62,12 @@ class LibrosaMelScale(nn.Module):
             htk=mel_scale=="htk",
             norm=norm
         )
-        fb = torch.from_numpy(librosa.filters.mel(**_mel_options).T).float()
+        fb = torch.from_numpy(mel_filterbank(**_mel_options).T).float()
         self.register_buffer("fb", fb)
+        self.projection = MelProjection(fb)
     
     def forward(self, specgram):
-        mel_specgram = torch.matmul(specgram.transpose(-1, -2), self.fb).transpose(-1, -2)
+        mel_specgram = self.projection(specgram, dim=-2, fb=self.fb)  # fb may be loaded from a checkpoint
         return mel_specgram
 
 
@@ -41,13 +41,14 @@ class ISTFTHead(FourierHead):
         self.out = torch.nn.Linear(dim, out_dim)
         self.istft = ISTFT(n_fft=n_fft, hop_length=hop_length, win_length=n_fft, padding=padding)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         Forward pass of the ISTFTHead module.
 
         Args:
             x (Tensor): Input tensor of shape (B, L, H), where B is the batch size,
                         L is the sequence length, and H denotes the model dimension.
+            mask (Tensor, optional): Frame mask of shape (B, L), False for the padded frames, see `ISTFT.forward`.
 
         Returns:
             Tensor: Reconstructed time-domain audio signal of shape (B, T), where T is the length of the output signal.
@@ -65,7 +66,7 @@ class ISTFTHead(FourierHead):
         # S = mag * torch.exp(phase * 1j)
         # better directly produce the complex value 
         S = mag * (x + 1j * y)
-        audio = self.istft(S)
+        audio = self.istft(S, mask=mask)
         return audio
 
 
@@ -76,7 +76,11 @@ class VocosBackbone(Backbone):
 
     def forward(self, x: torch.Tensor, **kwargs) -> torch.Tensor:
         bandwidth_id = kwargs.get('bandwidth_id', None)
-        x = self.embed(x)
+        # mask (B, L): False for the padded frames at the end of each item. The padded frames are zeroed before each
+        # convolution, so that the valid frames see the same zero padding as the unpadded item
+        mask = kwargs.get('mask', None)
+        mask = None if mask is None else mask[:, None, :].to(x.dtype)
+        x = self.embed(x if mask is None else x * mask)
         if self.adanorm:
             assert bandwidth_id is not None
             x = self.norm(x.transpose(1, 2), cond_embedding_id=bandwidth_id)
@@ -84,7 +88,7 @@ class VocosBackbone(Backbone):
             x = self.norm(x.transpose(1, 2))
         x = x.transpose(1, 2)
         for conv_block in self.convnext:
-            x = conv_block(x, cond_embedding_id=bandwidth_id)
+            x = conv_block(x if mask is None else x * mask, cond_embedding_id=bandwidth_id)
         x = self.final_layer_norm(x.transpose(1, 2))
         return x
 
@@ -9,6 +9,7 @@ from torch import nn
 from model.vocos.offline.feature_extractors import FeatureExtractor, EncodecFeatures
 from model.vocos.offline.heads import FourierHead
 from model.vocos.offline.models import Backbone
+from model.utils.ckpt_store import load_checkpoint
 
 
 def instantiate_class(args: Union[Any, Tuple[Any, ...]], init: Dict[str, Any]) -> Any:
@@ -63,10 +64,11 @@ class Vocos(nn.Module):
     def from_pretrained(self, config_path: str, model_path: str, model: nn.Module=None) -> "Vocos":
         """
         Class method to create a new Vocos model instance from a pre-trained model stored in the Hugging Face model hub.
+        `model_path` is a local path or `HF!<filename>`, memory-mapped from the local checkpoint store (see `model.utils.ckpt_store`).
         """
         if model is None:
             model = self.from_hparams(config_path)
-        state_dict = torch.load(model_path, map_location="cpu")
+        state_dict = load_checkpoint(model_path)
         prefixes = ("backbone", "feature_extractor", "head")
         state_dict = {
             key: value
@@ -79,7 +81,7 @@ class Vocos(nn.Module):
                 for key, value in model.feature_extractor.encodec.state_dict().items()
             }
             state_dict.update(encodec_parameters)
-        model.load_state_dict(state_dict)
+        model.load_state_dict(state_dict, assign=True)
         model.eval()
         return model
 
@@ -109,12 +111,15 @@ class Vocos(nn.Module):
         Args:
             features_input (Tensor): The input tensor of features of shape (B, C, L), where B is the batch size,
                                      C denotes the feature dimension, and L is the sequence length.
+            mask (Tensor, optional): Frame mask of shape (B, L) of a padded batch, False for the padded frames. The samples of
+                                     each item then equal the ones of the unpadded item, and are zero after its end (see `ISTFT.forward`).
 
         Returns:
             Tensor: The output tensor representing the reconstructed audio waveform of shape (B, T).
         """
         x = self.backbone(features_input, **kwargs)
-        audio_output = self.head(x)
+        mask = kwargs.get('mask', None)
+        audio_output = self.head(x) if mask is None else self.head(x, mask=mask)
         return audio_output
 
     @torch.inference_mode()
@@ -1,3 +1,5 @@
+from typing import Optional
+
 import numpy as np
 import scipy
 import torch
@@ -30,17 +32,23 @@ class ISTFT(nn.Module):
         window = torch.hann_window(win_length)
         self.register_buffer("window", window)
 
-    def forward(self, spec: torch.Tensor) -> torch.Tensor:
+    def forward(self, spec: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         """
         Compute the Inverse Short Time Fourier Transform (ISTFT) of a complex spectrogram.
 
         Args:
             spec (Tensor): Input complex spectrogram of shape (B, N, T), where B is the batch size,
                             N is the number of frequency bins, and T is the number of time frames.
+            mask (Tensor, optional): Frame mask of shape (B, T), False for the padded frames at the end of each item.
+                            The padded frames are left out of the overlap-add and of the window envelope, and the samples
+                            after the end of each item ((T_i - 1) * hop_length samples for "center", T_i * hop_length for
+                            "same", T_i the valid frames) are zero.
 
         Returns:
             Tensor: Reconstructed time-domain signal of shape (B, L), where L is the length of the output signal.
         """
+        if mask is not None:
+            return self._masked_istft(spec, mask)
         if self.padding == "center":
             # Fallback to pytorch native implementation
             return torch.istft(spec, self.n_fft, self.hop_length, self.win_length, self.window, center=True)
@@ -74,6 +82,31 @@ class ISTFT(nn.Module):
 
         return y
 
+    def _masked_istft(self, spec: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+        """The ISTFT of a padded batch: the samples of each item equal the ones of the unpadded item, the samples after
+        the end of each item are zero."""
+        assert spec.dim() == 3, "Expected a 3D tensor as input"
+        B, N, T = spec.shape
+        pad = self.n_fft // 2 if self.padding == "center" else (self.win_length - self.hop_length) // 2
+        mask = mask.to(self.window.dtype)[:, None, :]  # [B, 1, T]
+
+        ifft = torch.fft.irfft(spec, self.n_fft, dim=1, norm="backward")
+        ifft = ifft * self.window[None, :, None] * mask
+
+        output_size = (T - 1) * self.hop_length + self.win_length
+        y = torch.nn.functional.fold(
+            ifft, output_size=(1, output_size), kernel_size=(1, self.win_length), stride=(1, self.hop_length),
+        )[:, 0, 0, pad:output_size - pad]
+        window_envelope = torch.nn.functional.fold(
+            self.window.square()[None, :, None] * mask, output_size=(1, output_size), kernel_size=(1, self.win_length), stride=(1, self.hop_length),
+        )[:, 0, 0, pad:output_size - pad]
+
+        # the samples of an item end with its unpadded ISTFT: the envelope of the last frame's tail is nearly zero
+        frames = mask[:, 0, :].sum(dim=-1, keepdim=True)
+        num_samples = (frames - 1) * self.hop_length if self.padding == "center" else frames * self.hop_length
+        valid = (torch.arange(y.shape[-1], device=y.device)[None, :] < num_samples) & (window_envelope > 1e-11)
+        return torch.where(valid, y / window_envelope.clamp(min=1e-11), torch.zeros_like(y))
+
 
 class MDCT(nn.Module):
     """
@@ -190,3 +223,19 @@ class IMDCT(nn.Module):
 
         audio = audio[:, pad:-pad]
         return audio
+
+
+if __name__ == "__main__":
+    # the ISTFT of a padded batch: the valid samples equal the ones of the unpadded items, the samples after their ends are zero
+    torch.manual_seed(0)
+    lengths = [100, 73, 40]
+    for padding in ["center", "same"]:
+        istft = ISTFT(n_fft=512, hop_length=128, win_length=512, padding=padding)
+        spec = torch.randn(len(lengths), 257, max(lengths), dtype=torch.complex64)
+        mask = torch.arange(max(lengths))[None, :] < torch.tensor(lengths)[:, None]
+        y = istft(spec, mask=mask)
+        for i, T in enumerate(lengths):
+            y_i = istft(spec[i:i + 1, :, :T])[0]
+            err, tail = (y[i, :len(y_i)] - y_i).abs().max().item(), y[i, len(y_i):].abs().max().item() if len(y_i) < y.shape[-1] else 0
+            print(f"{padding}, {T} frames: max abs diff of the valid samples={err:.1e}, max abs of the tail={tail:.1e}")
+            assert err < 1e-5 and tail == 0, (padding, T, err, tail)
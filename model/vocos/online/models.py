@@ -81,7 +81,8 @@ class VocosBackbone(Backbone):
             nn.init.trunc_normal_(m.weight, std=0.02)
             nn.init.constant_(m.bias, 0)
 
-    def forward(self, x: torch.Tensor, bandwidth_id: Optional[torch.Tensor] = None) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, bandwidth_id: Optional[torch.Tensor] = None, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # the convolutions are causal, so the padded frames at the end of each item (False in mask) do not change the valid frames
         x = self.embed(x)
         if self.adanorm:
             assert bandwidth_id is not None